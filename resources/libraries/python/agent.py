@@ -0,0 +1,453 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Remote helper agent for multiplexed command execution on a node.
+
+The agent is a small python3 program started by 'sudo python3' over one
+long-lived SSH channel. It reads JSON requests line by line from stdin, serves
+each of them in its own thread, and writes JSON responses to stdout.
+Commands of exec_cmd() and exec_cmd_batch() of a node with 'use_agent' run
+through its agent, each of them with its own timeout.
+If a node doesn't enable 'use_agent', or the agent cannot be started, all the
+functions of this module fall back to plain SSH commands.
+"""
+
+import json
+import socket
+
+from queue import Queue, Empty
+from shlex import quote
+from threading import Lock, Thread
+from time import time
+
+from paramiko.ssh_exception import SSHException
+from robot.api import logger
+
+from resources.libraries.python.ssh import exec_cmd
+from resources.libraries.python.ssh import kill_process as ssh_kill_process
+from resources.libraries.python.sshpool import ssh_pool
+from resources.libraries.python.sshstats import ssh_stats
+from resources.libraries.python.sshtransport import SSHTimeout, set_ssh_agent, ssh_transport_mode
+
+__all__ = [
+    u"AgentClient",
+    u"get_agent",
+    u"kill_process",
+    u"kill_pidfile",
+    u"read_file",
+    u"write_file",
+]
+
+_AGENT_SCRIPT = r'''
+import json, os, pwd, signal, subprocess, sys, threading
+
+_out_lock = threading.Lock()
+# The login user of SSH, commands see its home as they do under 'sudo -E'
+# of SSH, and the ones without sudo run as the user.
+_USER = pwd.getpwuid(int(os.environ.get("SUDO_UID", os.getuid())))
+
+def send(msg):
+    data = json.dumps(msg) + "\n"
+    with _out_lock:
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
+def _demote():
+    os.initgroups(_USER.pw_name, _USER.pw_gid)
+    os.setgid(_USER.pw_gid)
+    os.setuid(_USER.pw_uid)
+
+def _read(pipe, out, req=None):
+    for line in iter(pipe.readline, b""):
+        chunk = line.decode("utf-8", "ignore")
+        out.append(chunk)
+        if req:
+            send({"id": req["id"], "chunk": chunk})
+
+def op_exec(req):
+    proc = subprocess.Popen(req["cmd"], shell=True, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=dict(os.environ, HOME=_USER.pw_dir),
+                            preexec_fn=None if req.get("sudo", True) else _demote,
+                            start_new_session=True)
+    expired = []
+    def expire():
+        expired.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(req.get("timeout", 600), expire)
+    timer.start()
+    out, err = [], []
+    readers = [threading.Thread(target=_read, daemon=True,
+                                args=(proc.stdout, out, req if req.get("stream") else None)),
+               threading.Thread(target=_read, args=(proc.stderr, err), daemon=True)]
+    for reader in readers:
+        reader.start()
+    ret_code = proc.wait()
+    timer.cancel()
+    # Background processes started by the command may keep its pipes open,
+    # the command is done when it exits as it is with SSH.
+    for reader in readers:
+        reader.join(1)
+    return {"rc": ret_code, "o": "".join(out), "e": "".join(err), "expired": bool(expired)}
+
+def op_read(req):
+    with open(req["path"]) as read_file:
+        return {"rc": 0, "o": read_file.read(), "e": ""}
+
+def op_write_file(req):
+    with open(req["path"], "w") as write_file:
+        write_file.write(req["data"])
+    if req.get("mode") is not None:
+        os.chmod(req["path"], req["mode"])
+    return {"rc": 0, "o": "", "e": ""}
+
+def op_kill_pidfile(req):
+    with open(req["path"]) as pid_file:
+        os.kill(int(pid_file.read().strip()), req.get("sig", signal.SIGKILL))
+    return {"rc": 0, "o": "", "e": ""}
+
+def _ancestors():
+    pids = set()
+    pid = os.getpid()
+    while pid > 1:
+        pids.add(str(pid))
+        with open(f"/proc/{pid}/stat") as stat:
+            pid = int(stat.read().rsplit(")", 1)[1].split()[1])
+    return pids
+
+def op_kill_name(req):
+    # Never kill the agent itself and its parents, e.g. sudo.
+    excluded = _ancestors()
+    killed = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or pid in excluded:
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as cmdline:
+                args = cmdline.read().replace(b"\0", b" ").decode("utf-8", "ignore")
+            if req["name"] in args:
+                os.kill(int(pid), req.get("sig", signal.SIGKILL))
+                killed.append(pid)
+        except OSError:
+            continue
+    return {"rc": 0, "o": " ".join(killed), "e": ""}
+
+def op_ping(req):
+    return {"rc": 0, "o": str(os.getpid()), "e": ""}
+
+def handle(req):
+    try:
+        resp = globals()["op_" + req["op"]](req)
+    except Exception as err:
+        resp = {"rc": 1, "o": "", "e": repr(err)}
+    resp["id"] = req["id"]
+    send(resp)
+
+for line in sys.stdin:
+    if line.strip():
+        threading.Thread(target=handle, args=(json.loads(line),), daemon=True).start()
+'''
+
+
+class AgentClient:
+    """Client of the agent on a node.
+    Requests are multiplexed over one SSH channel and matched with
+    responses by request id, so they can be issued concurrently.
+    """
+
+    __MAX_RECV_BUF = 10 * 1024 * 1024
+    START_TIMEOUT = 10
+
+    def __init__(self, node):
+        self._node = node
+        self._chan = None
+        self._pending = dict()
+        self._lock = Lock()
+        self._next_id = 0
+
+    @property
+    def active(self):
+        """Whether the agent channel is alive. """
+        return self._chan is not None and not self._chan.closed
+
+    def start(self):
+        """Start the agent on the node and wait until it responds.
+
+        :raises RuntimeError: If the agent cannot be started.
+        """
+        # The agent channel is long-lived, so its connection is pinned.
+        client = ssh_pool.pin(self._node)
+        try:
+            self._chan = client.get_transport().open_session(timeout=5)
+        except (SSHException, socket.error):
+            ssh_pool.unpin(self._node)
+            raise
+        self._chan.exec_command(f"sudo -E -S python3 -u -c {quote(_AGENT_SCRIPT)}")
+        Thread(target=self._reader, daemon=True).start()
+        try:
+            resp = self.request(u"ping", timeout=AgentClient.START_TIMEOUT)
+        except SSHTimeout:
+            resp = {u"rc": None}
+        if resp[u"rc"] != 0:
+            self.stop()
+            raise RuntimeError(f"Start agent failed on {self._node[u'host']}")
+        logger.debug(f"Agent started on {self._node[u'host']}:{self._node[u'port']} "
+                     f"pid {resp[u'o']}")
+
+    def stop(self):
+        """Stop the agent, it exits on stdin EOF. """
+        with self._lock:
+            chan, self._chan = self._chan, None
+        if chan:
+            chan.close()
+            ssh_pool.unpin(self._node)
+
+    def _reader(self):
+        chan = self._chan
+        buf = u""
+        while True:
+            try:
+                data = chan.recv(self.__MAX_RECV_BUF)
+            except (socket.error, SSHException):
+                break
+            if not data:
+                break
+            buf += data.decode(encoding=u'utf-8', errors=u'ignore')
+            while u"\n" in buf:
+                line, buf = buf.split(u"\n", 1)
+                msg = json.loads(line)
+                with self._lock:
+                    queue = self._pending.get(msg[u"id"])
+                if queue:
+                    queue.put(msg)
+
+        # Fail all the outstanding requests
+        with self._lock:
+            if self._chan is chan:
+                self._chan = None
+                ssh_pool.unpin(self._node)
+            for queue in self._pending.values():
+                queue.put({u"rc": None, u"o": u"", u"e": u"agent exited"})
+
+    def request(self, op, timeout=600, on_output=None, **args):
+        """Send a request to the agent and wait for its response.
+
+        :param op: Operation, i.e. exec, read, write_file, kill_pidfile,
+            kill_name or ping.
+        :param timeout: Timeout value in seconds.
+        :param on_output: Callback for each streamed stdout line of 'exec'.
+        :param args: Operation arguments.
+        :type op: str
+        :type timeout: int
+        :type on_output: callable
+        :returns: Response with 'rc', 'o' (stdout) and 'e' (stderr).
+        :rtype: dict
+        :raises SSHTimeout: If there is no response in timeout time.
+        """
+        queue = Queue()
+        with self._lock:
+            self._next_id += 1
+            req_id = self._next_id
+            self._pending[req_id] = queue
+        req = dict(args, id=req_id, op=op, timeout=timeout, stream=on_output is not None)
+        try:
+            chan = self._chan
+            if not chan:
+                return {u"rc": None, u"o": u"", u"e": u"agent exited"}
+            chan.sendall(json.dumps(req) + u"\n")
+            while True:
+                # The agent enforces its own timeout of 'exec'
+                msg = queue.get(timeout=timeout + 5)
+                if u"chunk" in msg:
+                    on_output(msg[u"chunk"])
+                    continue
+                return msg
+        except Empty as err:
+            raise SSHTimeout(f"Timeout waiting agent on {self._node[u'host']}: {req}") from err
+        finally:
+            with self._lock:
+                self._pending.pop(req_id)
+
+    def exec_cmd(self, cmd, timeout=600, sudo=True, on_output=None):
+        """Execute a command by the agent, as root with sudo or as the
+        SSH login user without it.
+
+        :param cmd: Command to execute.
+        :param timeout: Timeout value in seconds, the agent kills the
+            command's process group after it.
+        :param sudo: Sudo privilege execution flag.
+        :param on_output: Callback for each stdout line while the command runs.
+        :type cmd: str
+        :type timeout: int
+        :type sudo: bool
+        :type on_output: callable
+        :returns: RC, Stdout, Stderr, None for all of them if the agent exited.
+        :rtype: tuple(int, str, str)
+        :raises SSHTimeout: If the command is not finished in timeout time.
+        """
+        start = time()
+        resp = self.request(u"exec", timeout, on_output, cmd=str(cmd), sudo=sudo)
+        duration = time() - start
+        if resp.get(u"expired"):
+            raise SSHTimeout(f"Timeout exception during execution of command: {cmd}\n"
+                             f"Current contents of stdout buffer: {resp[u'o']}\n"
+                             f"Current contents of stderr buffer: {resp[u'e']}\n")
+        if resp[u"rc"] is None:
+            logger.error(f"Agent failed on {self._node[u'host']}: {resp[u'e']}")
+            return None, None, None
+        ssh_stats.record(self._node, str(cmd), 0, 0, duration,
+                         len(resp[u"o"].encode(u"utf-8")) + len(resp[u"e"].encode(u"utf-8")),
+                         len(str(cmd).encode(u"utf-8")))
+        logger.trace(f"agent exec_cmd on {self._node[u'host']} took {duration} seconds: "
+                     f"{cmd}\nreturn RC {resp[u'rc']}")
+        if resp[u"rc"]:
+            logger.trace(f"return STDOUT {resp[u'o']}")
+            logger.trace(f"return STDERR {resp[u'e']}")
+        return resp[u"rc"], resp[u"o"], resp[u"e"]
+
+    def exec_cmd_batch(self, cmds, timeout=600, sudo=True, stop_on_error=False):
+        """Execute a batch of commands by the agent one after another.
+
+        :param cmds: Commands to execute.
+        :param timeout: Timeout value in seconds of the whole batch.
+        :param sudo: Sudo privilege execution flag.
+        :param stop_on_error: Skip the remaining commands after a failed one.
+        :type cmds: list(str)
+        :type timeout: int
+        :type sudo: bool
+        :type stop_on_error: bool
+        :returns: RC, Stdout, Stderr of each executed command.
+        :rtype: list(tuple(int, str, str))
+        :raises SSHTimeout: If the batch is not finished in timeout time.
+        """
+        deadline = time() + timeout
+        results = list()
+        for cmd in cmds:
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise SSHTimeout(f"Timeout exception during execution of batch: {cmds}")
+            result = self.exec_cmd(cmd, remaining, sudo)
+            results.append(result)
+            if stop_on_error and (result[0] is None or int(result[0]) != 0):
+                break
+        return results
+
+
+_AGENTS = dict()
+_AGENTS_LOCK = Lock()
+
+def get_agent(node):
+    """Get the agent of a node, start it if not running.
+
+    :param node: Node in topology.
+    :type node: dict
+    :returns: Agent client, None if the node doesn't use an agent.
+    :rtype: AgentClient obj
+    """
+    if not node.get(u"use_agent") or ssh_transport_mode() != u"ssh":
+        # Recorded sessions must contain plain commands for replay.
+        return None
+
+    key = (node[u"host"], node[u"port"])
+    with _AGENTS_LOCK:
+        agent = _AGENTS.get(key, False)
+        if agent is None:
+            # Agent is not available on the node, e.g. no python3
+            return None
+        if agent and agent.active:
+            return agent
+        agent = AgentClient(node)
+        try:
+            agent.start()
+        except (RuntimeError, IOError, SSHException) as err:
+            logger.warn(f"Agent is not available on {node[u'host']}:{node[u'port']}, "
+                        f"fall back to SSH: {err}")
+            agent = None
+        _AGENTS[key] = agent
+        return agent
+
+set_ssh_agent(get_agent)
+
+def kill_process(node, proc_name):
+    """Kill processes whose command line contains proc_name on a node.
+
+    :param node: Node in topology.
+    :param proc_name: Process name to be killed.
+    :type node: dict
+    :type proc_name: str
+    """
+    agent = get_agent(node)
+    if not agent:
+        ssh_kill_process(node, proc_name)
+        return
+    resp = agent.request(u"kill_name", name=proc_name)
+    logger.trace(f"Killed {proc_name} on {node[u'host']}: {resp[u'o']}")
+
+def kill_pidfile(node, pidfile):
+    """Kill the process recorded in a pidfile on a node.
+
+    :param node: Node in topology.
+    :param pidfile: Path of the pidfile.
+    :type node: dict
+    :type pidfile: str
+    :returns: RC, Stdout, Stderr.
+    :rtype: tuple(int, str, str)
+    """
+    agent = get_agent(node)
+    if not agent:
+        return exec_cmd(node, f"sh -c 'kill -9 $(cat {pidfile})'", sudo=True)
+    resp = agent.request(u"kill_pidfile", path=pidfile)
+    return resp[u"rc"], resp[u"o"], resp[u"e"]
+
+def read_file(node, path):
+    """Read a file, e.g. in /sys or /proc, on a node.
+
+    :param node: Node in topology.
+    :param path: File path.
+    :type node: dict
+    :type path: str
+    :returns: RC, file content, Stderr.
+    :rtype: tuple(int, str, str)
+    """
+    agent = get_agent(node)
+    if not agent:
+        return exec_cmd(node, f"cat {path}")
+    resp = agent.request(u"read", path=path)
+    return resp[u"rc"], resp[u"o"], resp[u"e"]
+
+def write_file(node, path, data, mode=None):
+    """Write a file on a node.
+
+    :param node: Node in topology.
+    :param path: File path.
+    :param data: File content.
+    :param mode: File permission bits, e.g. 0o744.
+    :type node: dict
+    :type path: str
+    :type data: str
+    :type mode: int
+    :returns: RC, Stdout, Stderr.
+    :rtype: tuple(int, str, str)
+    """
+    agent = get_agent(node)
+    if not agent:
+        ret = exec_cmd(node, f"sh -c {quote(f'printf %s {quote(data)} > {path}')}", sudo=True)
+        if mode is not None and ret[0] == 0:
+            ret = exec_cmd(node, f"chmod {mode:o} {path}", sudo=True)
+        return ret
+    resp = agent.request(u"write_file", path=path, data=data, mode=mode)
+    return resp[u"rc"], resp[u"o"], resp[u"e"]
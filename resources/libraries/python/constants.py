@@ -23,6 +23,7 @@ class Constants():
     OFP_UPLINK_BASE = 1
     OFP_VHOST_BASE = 10
     OFP_TUNNEL_BASE = 100
+    OFP_NETNS_BASE = 1000
 
     OF_TABLE_ADMISS = 0
     OF_TABLE_INPUT = 20
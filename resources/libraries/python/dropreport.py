@@ -0,0 +1,285 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Drop and loss attribution along the path of a throughput test.
+
+Counters along the path of the first allow pair are diffed over a test,
+i.e. virtio statistics in both guests, OVS statistics of vhost-user and
+uplink interfaces, DPDK xstats of uplinks, datapath lookups ('dpctl/show'),
+coverage counters ('coverage/show') and kernel conntrack statistics, and
+the counters which grew are ranked as suspects of lost packets.
+"""
+
+import json
+import re
+
+from robot.api import logger
+
+from resources.libraries.python.hostsampler import parse_counters
+from resources.libraries.python.output import output_path
+from resources.libraries.python.telemetry import diff_xstats
+from resources.libraries.python.timeline import traced
+from resources.libraries.python.topology import suts
+from resources.libraries.python.vswitch import OvsDpdk
+
+__all__ = [
+    u"Suspect",
+    u"parse_dpctl_lookups",
+    u"parse_coverage",
+    u"parse_conntrack_stats",
+    u"rank_suspects",
+    u"take_drop_snapshot",
+    u"analyze_drops",
+]
+
+_LOOKUPS_RE = re.compile(r"lookups:\s*hit:(\d+)\s+missed:(\d+)\s+lost:(\d+)")
+_COVERAGE_RE = re.compile(r"^(\w+)\s+.*total:\s*(\d+)\s*$", re.M)
+# Counters which count lost packets, and counters of backpressure which
+# delay packets but don't lose them by themselves. Lookup misses of EMC,
+# SMC or megaflow cache are upcalls, but rx_missed_errors or imissed of a
+# NIC are drops.
+_DROP_RE = re.compile(r"drop|discard|lost|error|err$|imissed|fail|full|overflow|no_?buf|nombuf",
+                      re.IGNORECASE)
+_BACKPRESSURE_RE = re.compile(r"retr|busy|stall|full_q", re.IGNORECASE)
+# Kernel conntrack statistics which mean a dropped packet
+_CONNTRACK_DROPS = (u"drop", u"early_drop", u"insert_failed", u"invalid", u"error")
+
+_snapshot = dict()
+
+def parse_dpctl_lookups(output):
+    """Parse datapath lookups of 'ovs-appctl dpctl/show', summed over
+    datapaths.
+
+    :param output: Command output.
+    :type output: str
+    :returns: 'hit', 'missed' and 'lost' lookups, 'lost' are packets
+        dropped as their upcalls were not queued.
+    :rtype: dict
+    """
+    lookups = {u"hit": 0, u"missed": 0, u"lost": 0}
+    for match in _LOOKUPS_RE.finditer(output):
+        for key, value in zip((u"hit", u"missed", u"lost"), match.groups()):
+            lookups[key] += int(value)
+    return lookups
+
+def parse_coverage(output):
+    """Parse total counts of 'ovs-appctl coverage/show'.
+
+    :param output: Command output.
+    :type output: str
+    :returns: Totals by coverage counter name.
+    :rtype: dict
+    """
+    return {name: int(total) for name, total in _COVERAGE_RE.findall(output)}
+
+def parse_conntrack_stats(output):
+    """Parse 'conntrack -S', counters are summed over CPUs.
+
+    :param output: Command output.
+    :type output: str
+    :returns: Counters by name, e.g. {'drop': 0, 'insert_failed': 0}.
+    :rtype: dict
+    """
+    stats = dict()
+    for key, value in re.findall(r"(\w+)=(\d+)", output):
+        if key != u"cpu":
+            stats[key] = stats.get(key, 0) + int(value)
+    return stats
+
+
+class Suspect:
+    """A counter which grew during a test.
+
+    :param location: Point on the path, e.g. 'receiver guest' or 'uplink'.
+    :param node: SUT or guest name.
+    :param device: Device or source of the counter, e.g. 'dpdk1'.
+    :param counter: Counter name.
+    :param packets: Increase of the counter.
+    :param kind: 'drop' or 'backpressure'.
+    :type location: str
+    :type node: str
+    :type device: str
+    :type counter: str
+    :type packets: int
+    :type kind: str
+    """
+
+    def __init__(self, location, node, device, counter, packets, kind=u"drop"):
+        # pylint: disable=too-many-arguments
+        self.location = location
+        self.node = node
+        self.device = device
+        self.counter = counter
+        self.packets = packets
+        self.kind = kind
+
+    def to_dict(self):
+        """Convert to a JSON serializable dict. """
+        return dict(self.__dict__)
+
+    def __str__(self):
+        return f"{self.location} {self.node} {self.device} {self.counter}: {self.packets} packets"
+
+
+def _kind(counter):
+    if _BACKPRESSURE_RE.search(counter):
+        return u"backpressure"
+    if _DROP_RE.search(counter):
+        return u"drop"
+    return None
+
+def _diff(before, after):
+    return {key: value - before.get(key, 0) for key, value in after.items()
+            if value - before.get(key, 0) > 0}
+
+def rank_suspects(before, after, roles):
+    """Rank counters which grew between two path snapshots.
+
+    :param before: Snapshot before a test, see take_drop_snapshot().
+    :param after: Snapshot after a test.
+    :param roles: Location of each interface or guest name, e.g.
+        {'vhu1': 'sender vhost-user', 'vm1': 'sender guest'}.
+    :type before: dict
+    :type after: dict
+    :type roles: dict
+    :returns: Suspects, drops first and largest first.
+    :rtype: list(Suspect)
+    """
+    suspects = list()
+    def add(location, node, device, counters):
+        for counter, packets in counters.items():
+            kind = _kind(counter)
+            if kind:
+                suspects.append(Suspect(location, node, device, counter, packets, kind))
+
+    for name, guest in after[u"guests"].items():
+        add(roles.get(name, u"guest"), name, guest[u"dev"],
+            _diff(before[u"guests"][name][u"counters"], guest[u"counters"]))
+
+    for name, sut in after[u"suts"].items():
+        old = before[u"suts"][name]
+        xstats = diff_xstats(old[u"xstats"], sut[u"xstats"])
+        for dev, counters in xstats[u"interfaces"].items():
+            add(roles.get(dev, u"interface"), name, dev,
+                {k: v for k, v in counters.items() if v > 0})
+        for dev, counters in xstats[u"ethdev"].items():
+            # OVS statistics of a DPDK port already have some of its xstats
+            seen = xstats[u"interfaces"].get(dev, dict())
+            add(roles.get(dev, u"uplink"), name, dev,
+                {k: v for k, v in counters.items() if v > 0 and k not in seen})
+        lost = sut[u"lookups"][u"lost"] - old[u"lookups"][u"lost"]
+        if lost > 0:
+            suspects.append(Suspect(u"datapath", name, u"dpctl", u"lookups lost", lost))
+        add(u"datapath", name, u"coverage", _diff(old[u"coverage"], sut[u"coverage"]))
+        conntrack = _diff(old[u"conntrack"], sut[u"conntrack"])
+        add(u"conntrack", name, u"conntrack",
+            {k: v for k, v in conntrack.items() if k in _CONNTRACK_DROPS})
+
+    return sorted(suspects, key=lambda s: (s.kind != u"drop", -s.packets))
+
+def _snapshot_guest(guest, vif):
+    dev = guest.vif_dev_name(vif)
+    _, stdout, _ = guest.execute(f"ethtool -S {dev}; "
+                                 f"cd /sys/class/net/{dev}/statistics && grep . *",
+                                 exp_fail=None)
+    return {u"dev": dev, u"counters": parse_counters(stdout or u"")}
+
+def _snapshot_sut(sut):
+    vswitch = sut.vswitch
+    _, dpctl, _ = vswitch.execute("ovs-appctl dpctl/show")
+    _, coverage, _ = vswitch.execute("ovs-appctl coverage/show")
+    conntrack = dict()
+    if not isinstance(vswitch, OvsDpdk):
+        # Userspace conntrack drops are coverage counters
+        ret_code, stdout, _ = vswitch.execute_host("conntrack -S", exp_fail=None)
+        if ret_code is not None and int(ret_code) == 0:
+            conntrack = parse_conntrack_stats(stdout)
+    return {u"xstats": vswitch.get_xstats(), u"lookups": parse_dpctl_lookups(dpctl),
+            u"coverage": parse_coverage(coverage), u"conntrack": conntrack}
+
+def _path(vt):
+    if not vt.allow or not vt.allow[0].get_deps():
+        raise RuntimeError("No allowed entry is found.")
+    return vt.allow[0].sep, vt.allow[0].get_deps()[0]
+
+def _take_snapshot(sep, dep):
+    hosts = [sut for sut in suts if sut in (sep.host, dep.host)]
+    return {u"guests": {ep.guest.name: _snapshot_guest(ep.guest, ep.vif) for ep in (sep, dep)},
+            u"suts": {sut.name: _snapshot_sut(sut) for sut in hosts}}
+
+@traced("dropreport")
+def take_drop_snapshot(vt):
+    """Given an input verify topology, snapshot counters along the path of
+    the first allow pair before a test.
+
+    :param vt: Input verify topology.
+    :type vt: VerifyTopology obj
+    """
+    sep, dep = _path(vt)
+    _snapshot.clear()
+    _snapshot.update(_take_snapshot(sep, dep))
+
+@traced("dropreport")
+def analyze_drops(vt, top_n=5, name=None):
+    """Given an input verify topology, diff counters along the path of the
+    first allow pair against the snapshot before a test, and report the
+    dominant loss point and ranked suspects. The whole ranking is written
+    into 'drops_<name>.json' in robot output directory.
+
+    :param vt: Input verify topology.
+    :param top_n: Number of suspects in results.
+    :param name: Report name, default is the test name.
+    :type vt: VerifyTopology obj
+    :type top_n: int
+    :type name: str
+    :returns: Packets lost between the guests, the dominant loss point and
+        suspects, they are printed as result lines.
+    :rtype: list(str)
+    """
+    if not _snapshot:
+        raise RuntimeError("No drop snapshot is taken.")
+    sep, dep = _path(vt)
+    before = dict(_snapshot)
+    after = _take_snapshot(sep, dep)
+    roles = {sep.guest.name: u"sender guest", dep.guest.name: u"receiver guest",
+             sep.vif.name: u"sender vhost-user", dep.vif.name: u"receiver vhost-user"}
+    for sut in suts:
+        for uplink in sut.vswitch.uplinks:
+            roles[uplink.name] = u"uplink"
+    suspects = rank_suspects(before, after, roles)
+
+    sent = _diff(before[u"guests"][sep.guest.name][u"counters"],
+                 after[u"guests"][sep.guest.name][u"counters"]).get(u"tx_packets", 0)
+    received = _diff(before[u"guests"][dep.guest.name][u"counters"],
+                     after[u"guests"][dep.guest.name][u"counters"]).get(u"rx_packets", 0)
+    lost = max(0, sent - received)
+
+    results = [f"path lost: {lost} packets of {sent}"]
+    drops = [s for s in suspects if s.kind == u"drop"]
+    if drops:
+        share = f", {drops[0].packets * 100 / lost:.0f}% of lost" if lost else u""
+        results.append(f"dominant loss point: {drops[0]}{share}")
+    elif lost:
+        results.append(u"dominant loss point: unknown, no drop counter increased")
+    results += [f"suspect {idx} ({s.kind}) {s}" for idx, s in
+                enumerate(suspects[:int(top_n)], 1)]
+    for line in results:
+        logger.info(line)
+
+    path = output_path(u"drops", name)
+    with open(path, u"w") as report:
+        json.dump({u"sent": sent, u"received": received,
+                   u"suspects": [s.to_dict() for s in suspects]}, report, indent=2)
+    logger.info(f"Drop report is written to {path}")
+    return results
@@ -0,0 +1,118 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Throughput versus the number of concurrent flows.
+
+Flows are spread over udp ports by pktgen, so traffic doesn't stay in the
+EMC as a few 5-tuples do, and each flow count is reported with the cache
+hit ratios of PMD threads (EMC, SMC and megaflow).
+"""
+
+from robot.api import logger
+
+from resources.libraries.python.pktgen import run_pktgen
+from resources.libraries.python.timeline import traced
+from resources.libraries.python.topology import suts
+
+__all__ = [
+    u"FLOW_COUNTS",
+    u"cache_hit_ratios",
+    u"execute_flow_scaling_test",
+]
+
+FLOW_COUNTS = (1, 1000, 10000, 100000, 1000000)
+
+def cache_hit_ratios(stats):
+    """Get cache hit ratios of datapath lookups from PMD statistics.
+
+    :param stats: PMD statistics, see VirtualSwitch.get_pmd_stats().
+    :type stats: dict
+    :returns: Ratios of 'emc', 'smc', 'megaflow' and 'miss', empty if
+        there is no lookup.
+    :rtype: dict
+    """
+    # Older OVS names them 'exact match hits', 'miss' and 'lost'
+    hits = {u"emc": stats.get(u"emc hits", stats.get(u"exact match hits", 0)),
+            u"smc": stats.get(u"smc hits", 0),
+            u"megaflow": stats.get(u"megaflow hits", 0),
+            u"miss": stats.get(u"miss with success upcall", stats.get(u"miss", 0)) +
+                     stats.get(u"miss with failed upcall", stats.get(u"lost", 0))}
+    total = sum(hits.values())
+    if not total:
+        return dict()
+    return {name: count / total for name, count in hits.items()}
+
+def _get_pmd_stats_on_all_suts():
+    stats = dict()
+    for sut in suts:
+        for name, value in sut.vswitch.get_pmd_stats().items():
+            stats[name] = stats.get(name, 0) + value
+    return stats
+
+@traced("flowscale")
+def execute_flow_scaling_test(vt, pipeline=u"normal", flow_counts=FLOW_COUNTS,
+                              frame_size=64, duration=10, warmup=2, burst=1):
+    """Given an input verify topology, send pktgen UDP of the first allow
+    pair as fast as possible with an increasing number of flows.
+
+    Each flow count is warmed up before PMD statistics are cleared, so
+    upcalls of installing megaflows are not counted.
+
+    :param vt: Input verify topology.
+    :param pipeline: Pipeline name shown in results, e.g. normal, vxlan
+        or conntrack.
+    :param flow_counts: Numbers of concurrent flows.
+    :param frame_size: Ethernet frame size in bytes including FCS.
+    :param duration: Duration in seconds of each flow count.
+    :param warmup: Duration in seconds of the warm-up run.
+    :param burst: Number of packets sent in a burst by pktgen.
+    :type vt: VerifyTopology obj
+    :type pipeline: str
+    :type flow_counts: list(int)
+    :type frame_size: int
+    :type duration: int
+    :type warmup: int
+    :type burst: int
+    :returns: Throughput and cache hit ratios of each flow count.
+    :rtype: list(str)
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    if not vt.allow or not vt.allow[0].get_deps():
+        raise RuntimeError("No allowed entry is found.")
+    sep = vt.allow[0].sep
+    dep = vt.allow[0].get_deps()[0]
+
+    results = list()
+    for flows in [int(f) for f in flow_counts]:
+        if int(warmup):
+            run_pktgen(sep.guest, sep.vif, dep.vif, int(frame_size), flows, int(burst),
+                       duration=int(warmup))
+        for sut in suts:
+            sut.vswitch.clear_pmd_stats()
+
+        rx_start = dep.guest.get_vif_statistics(dep.vif, u"rx_packets")
+        result = run_pktgen(sep.guest, sep.vif, dep.vif, int(frame_size), flows, int(burst),
+                            duration=int(duration))
+        rx_pps = (dep.guest.get_vif_statistics(dep.vif, u"rx_packets") - rx_start) / \
+            int(duration)
+
+        ratios = cache_hit_ratios(_get_pmd_stats_on_all_suts())
+        if ratios:
+            cache = u", ".join(f"{name} {ratio * 100:.1f}%" for name, ratio in ratios.items())
+        else:
+            cache = u"no pmd stats"
+        results.append(f"{pipeline} {flows} flows {frame_size}B: "
+                       f"tx {result.pps / 1e6:.3f} Mpps, rx {rx_pps / 1e6:.3f} Mpps, {cache}")
+        logger.info(results[-1])
+    return results
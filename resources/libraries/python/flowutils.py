@@ -14,7 +14,12 @@
 
 """Defines functions for flow configuration."""
 
+import os
+from tempfile import NamedTemporaryFile
+from time import time
+
 from resources.libraries.python.constants import Constants
+from resources.libraries.python.ssh import scp_node
 from resources.libraries.python.topology import suts
 
 __all__ = [
@@ -24,8 +29,12 @@ __all__ = [
     u"generate_output_flows",
     u"provision_flows",
     u"delete_flows",
+    u"benchmark_flow_provisioning_on_all_suts",
 ]
 
+# Cookie of flows provisioned by the flow provisioning benchmark
+_BENCHMARK_COOKIE = 0xbe
+
 def _append_as(actions, action):
     if not actions:
         actions = action
@@ -389,3 +398,55 @@ def setup_default_pipeline_on_all_suts(br_name):
 
         # provision the flows
         provision_flows(sut, br_name, flows)
+
+def _generate_benchmark_flows(flow_num):
+    # Low priority ACL flows never hit as the default ACL flow goes to CORE,
+    # so the benchmark doesn't change the pipeline's forwarding behavior.
+    flows = list()
+    for idx in range(flow_num):
+        flows.append(f"table={Constants.OF_TABLE_ACL},cookie={_BENCHMARK_COOKIE},priority=10,"
+                     f"ip,nw_src=10.{(idx >> 16) & 0xff}.{(idx >> 8) & 0xff}.{idx & 0xff},"
+                     f"actions=drop")
+    return flows
+
+def benchmark_flow_provisioning_on_all_suts(br_name, flow_num=10000):
+    """Benchmark control plane performance of the bridges.
+    It measures the default pipeline setup time, then bulk provisions
+    'flow_num' flows by 'ovs-ofctl add-flows' and deletes them.
+
+    :param br_name: Bridge name.
+    :param flow_num: Number of flows to provision on each SUT.
+    :type br_name: str
+    :type flow_num: int
+    :returns: Benchmark results.
+    :rtype: list(str)
+    """
+    flow_num = int(flow_num)
+    results = list()
+
+    start = time()
+    setup_default_pipeline_on_all_suts(br_name)
+    results.append(f"default pipeline setup on {len(suts)} SUTs: {time() - start:.3f} s")
+
+    with NamedTemporaryFile('w', suffix='.flows') as flow_file:
+        flow_file.write('\n'.join(_generate_benchmark_flows(flow_num)) + '\n')
+        flow_file.flush()
+        for sut in suts:
+            remote_path = os.path.join(sut.test_tmp_dir, "benchmark.flows")
+            scp_node(sut.ssh_info, flow_file.name, remote_path)
+
+            start = time()
+            sut.vswitch.execute(f"ovs-ofctl add-flows {br_name} {remote_path}", timeout=600)
+            elapsed = time() - start
+            results.append(f"{sut.name} {br_name} add {flow_num} flows: {elapsed:.3f} s, "
+                           f"{flow_num / elapsed:.0f} flows/sec")
+
+            start = time()
+            sut.vswitch.execute(f"ovs-ofctl del-flows {br_name} "
+                                f"cookie={_BENCHMARK_COOKIE}/-1", timeout=600)
+            elapsed = time() - start
+            results.append(f"{sut.name} {br_name} del {flow_num} flows: {elapsed:.3f} s, "
+                           f"{flow_num / elapsed:.0f} flows/sec")
+            sut.vswitch.execute_host(f"rm -f {remote_path}")
+
+    return results
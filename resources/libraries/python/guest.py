@@ -14,16 +14,55 @@
 
 """Library for executing commands in guest."""
 
-from io import StringIO
+import json
 import re
 from ipaddress import IPv4Address, IPv6Address
+from shlex import quote
+from time import time
 from robot.api import logger
-from resources.libraries.python.ssh import exec_cmd, kill_process, SSHTimeout
+from resources.libraries.python.agent import kill_process
+from resources.libraries.python.hostsampler import traffic_log
+from resources.libraries.python.iperf import IperfResult, iperf_client_cmd, parse_iperf_json
+from resources.libraries.python.netperf import netperf_client_cmd, parse_netperf_output
+from resources.libraries.python.ssh import exec_cmd, exec_cmd_batch, SSHTimeout
 
 __all__ = [
     u"Guest",
 ]
 
+# Return codes of a blocked reachability probe: timed out by coreutils
+# 'timeout' (124) or busybox 'timeout' (SIGTERM). A refused connection or
+# an ICMP port unreachable is an answer of the destination, so it's reachable.
+_PROBE_BLOCKED = (124, 128 + 15)
+_PROBE_BLOCKED_RCS = u"|".join(str(ret_code) for ret_code in _PROBE_BLOCKED)
+
+# UDP probe which sends a datagram and waits for an answer, either the
+# echo of a UDP echo server or an ICMP port unreachable.
+_UDP_PROBE = u"""import socket, sys
+addr = socket.getaddrinfo(sys.argv[1], int(sys.argv[2]), 0, socket.SOCK_DGRAM)[0]
+sock = socket.socket(addr[0], socket.SOCK_DGRAM)
+sock.settimeout(float(sys.argv[3]))
+sock.connect(addr[4])
+sock.send(b"probe")
+try:
+    sock.recv(64)
+except ConnectionRefusedError:
+    pass
+except socket.timeout:
+    sys.exit(124)
+"""
+# UDP echo server of UDP probes on both ipv4 and ipv6, its name is an
+# argument, so it can be killed by name.
+_UDP_ECHO_NAME = u"cne-udp-echo"
+_UDP_ECHO = u"""import socket, sys
+sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+sock.bind(("::", int(sys.argv[2])))
+while True:
+    data, peer = sock.recvfrom(2048)
+    sock.sendto(data, peer)
+"""
+
 def _ip_is_v4(ip_addr):
     if isinstance(ip_addr, IPv4Address):
         ipv4 = True
@@ -54,129 +93,6 @@ def _verify_ping_result(log, exp_cnt):
         return False
     return True
 
-def _verify_iperf_result(log, exp_rate=0):
-    # $ iperf3 -6 -c 2001:1000:1000:1000::aca8:101 -f k
-    # ...
-    # [ ID] Interval           Transfer     Bandwidth       Retr  Cwnd
-    # [  4]   0.00-1.00   sec  1.13 GBytes  9693816 Kbits/sec  443    534 KBytes
-    # [  4]   1.00-2.00   sec  1.61 GBytes  13804173 Kbits/sec  678    757 KBytes
-    # [  4]   2.00-3.00   sec  1.34 GBytes  11488700 Kbits/sec  622    512 KBytes
-    # [  4]   3.00-4.00   sec  1.66 GBytes  14240768 Kbits/sec  818    524 KBytes
-    # [  4]   4.00-5.00   sec  1.65 GBytes  14211005 Kbits/sec  684    558 KBytes
-    # [  4]   5.00-6.00   sec  1.64 GBytes  14082017 Kbits/sec  411    548 KBytes
-    # [  4]   6.00-7.00   sec  1.65 GBytes  14165441 Kbits/sec  720    545 KBytes
-    # [  4]   7.00-8.00   sec  1.66 GBytes  14245942 Kbits/sec  901    541 KBytes
-    # [  4]   8.00-9.00   sec  1.55 GBytes  13340002 Kbits/sec  562    735 KBytes
-    # [  4]   9.00-10.00  sec  1.68 GBytes  14443332 Kbits/sec  722    782 KBytes
-    # [  4]   9.00-10.00  sec  0.00 GBytes      0.00 Kbits/sec  722    782 KBytes
-    # - - - - - - - - - - - - - - - - - - - - - - - - -
-    # [ ID] Interval           Transfer     Bandwidth       Retr
-    # [  4]   0.00-10.00  sec  15.6 GBytes  13371471 Kbits/sec  6561             sender
-    # [  4]   0.00-10.00  sec  15.6 GBytes  13369569 Kbits/sec                  receiver
-    buf = StringIO(log)
-    results = list()
-    regex = re.compile(r'\s+(\d+\.*\d+)\s+Kbits\/sec')
-    for line in buf.readlines():
-        #logger.debug('line :{0}'.format(line))
-        match = regex.search(line)
-        if match:
-            results.append(match.group(1))
-            #logger.debug('Bandwidth:{0}'.format(match.group(1)))
-    buf.close()
-    if len(results) == 0:
-        logger.warn('NO Bandwidth output')
-        return "0 Kbits/sec"
-    first_one = True
-    bw = 0
-    zero_cnt = 0
-    for result in results:
-        bw = float(result)
-        if bw == 0:
-            zero_cnt = zero_cnt + 1
-            logger.warn('zero Bandwidth accumulated count:{0}'.format(zero_cnt))
-            if zero_cnt > 5:
-                logger.warn('zero Bandwidth exceed threshold')
-                return (False, -1)
-        if exp_rate > 0 and not first_one: # don't check the 1st second
-            if abs(bw - exp_rate) > (exp_rate / 10):
-                logger.warn('invalid Bandwidth:{0} exp_rate:{1}'.format(
-                    bw, exp_rate))
-                return (False, -1)
-        if first_one:
-            first_one = False
-    return f"{int(bw)} Kbits/sec"
-
-def _verify_iperf_udp_result(log, exp_rate=0):
-    # $ sudo iperf3 -c 172.168.2.1 -u -l 63k -b 10G
-    # Connecting to host 172.168.2.1, port 5201
-    # [  4] local 172.168.1.1 port 56551 connected to 172.168.2.1 port 5201
-    # [ ID] Interval           Transfer     Bandwidth       Total Datagrams
-    # [  4]   0.00-1.00   sec  40.7 MBytes   342 Mbits/sec  662
-    # [  4]   1.00-2.00   sec  57.3 MBytes   481 Mbits/sec  932
-    # [  4]   2.00-3.00   sec  46.0 MBytes   386 Mbits/sec  748
-    # [  4]   3.00-4.00   sec  60.2 MBytes   505 Mbits/sec  978
-    # [  4]   4.00-5.00   sec  54.0 MBytes   453 Mbits/sec  877
-    # [  4]   5.00-6.00   sec  53.9 MBytes   452 Mbits/sec  876
-    # [  4]   6.00-7.00   sec  48.4 MBytes   406 Mbits/sec  787
-    # [  4]   7.00-8.00   sec  57.2 MBytes   480 Mbits/sec  930
-    # [  4]   8.00-9.00   sec  43.1 MBytes   361 Mbits/sec  700
-    # [  4]   9.00-10.00  sec  34.5 MBytes   289 Mbits/sec  560
-    # - - - - - - - - - - - - - - - - - - - - - - - - -
-    # [ ID] Interval           Transfer     Bandwidth       Jitter    Lost/Total Datagrams
-    # [  4]   0.00-10.00  sec   495 MBytes   415 Mbits/sec  43.480 ms  7768/8002 (97%)
-    # [  4] Sent 8002 datagrams
-
-    # we don't count on 'Bandwidth' which is miss-leading in udp case,
-    # we use Lost/Total counters instead.
-    buf = StringIO(log)
-    sign_found = False
-    re_sign = re.compile(r'Jitter')
-    re_sum = re.compile(r'\s+(\d+)\/(\d+)\s+')
-    lost = 0
-    total = 0
-    #regex = re.compile(r'\s+(\d+\.*\d+)\s+Kbits\/sec')
-    for line in buf.readlines():
-        logger.debug('line :{0}'.format(line))
-        if sign_found:
-            s = re_sum.search(line)
-            if not s:
-                return 0
-            lost = int(s.group(1))
-            total = int(s.group(2))
-            break
-
-        match = re_sign.search(line)
-        if match:
-            sign_found = True
-            logger.debug('summary found')
-    buf.close()
-
-    # we used to think udp summary will show up even deny is in place
-    # but looks like the session cannot be setup thus timeout
-    logger.debug('Lost/Total: {0}/{1}'.format(lost, total))
-    # we assume iperf udp is using 63k/10seconds to test
-    if lost == total:
-        return 0
-
-    # we don't count eth/ip/ipv6/udp header overhead
-    # as they are trivial comparing to 63k
-    rate = float((total - lost) * 63 * 1024) / 10.0 * 8 / 1000 # in kbps
-
-    if exp_rate != 0 and abs(rate - exp_rate) > (exp_rate / 10):
-        logger.warn(f"invalid Bandwidth:{rate} exp_rate:{exp_rate}")
-    return f"{int(rate)} Kbits/sec"
-
-def _process_netperf_result(stdout, testname='TCP_RR'):
-    buf = StringIO(stdout)
-    regex = re.compile(r"(\d+)[ ]+(\d+)[ ]+(\d+)[ ]+(\d+)[ ]+(\d+(?:\.\d+)?)[ ]+(\d+(?:\.\d+)?)")
-    for line in buf.readlines():
-        match = regex.search(line)
-        if match:
-            logger.debug("Find the line {}".format(line))
-            return match.group(6)
-    logger.warn(f"{testname} doesn't have valid result.")
-    return 0
-
 class Guest():
     """Contains methods for executing guest commands. """
 
@@ -186,6 +102,16 @@ class Guest():
         self._ssh_info = {}
         self._host_ssh_info = {}
 
+    def vif_dev_name(self, vif):
+        """Get the device name of a VIF inside the guest.
+
+        :param vif: Virtual interface.
+        :type vif: VirtualInterface obj
+        :returns: Device name.
+        :rtype: str
+        """
+        return f"virtio{vif.idx}"
+
     def kill_process(self, proc_name):
         """Kill a process in the guest.
 
@@ -194,6 +120,9 @@ class Guest():
         """
         kill_process(self._ssh_info, proc_name)
 
+    def _guest_cmd(self, cmd): # pylint: disable=no-self-use
+        return cmd
+
     def execute(self, cmd, timeout=30, sudo=True, exp_fail=False):
         """Execute a command in the guest.
 
@@ -216,7 +145,7 @@ class Guest():
 
         try:
             ret_code, stdout, stderr = \
-                exec_cmd(self._ssh_info, f"{cmd}", timeout, sudo)
+                exec_cmd(self._ssh_info, self._guest_cmd(cmd), timeout, sudo)
             logger.trace(stdout)
         except SSHTimeout: # THere might be timeout in 'exp_fail' case
             ret_code = -1
@@ -235,22 +164,41 @@ class Guest():
 
         return (ret_code, stdout, stderr)
 
-    def execute_batch(self, cmds):
-        """Execute a batch of commands in the guest.
+    def execute_batch(self, cmds, timeout=30, sudo=True, stop_on_error=False):
+        """Execute a batch of commands in the guest by one round trip.
 
         :param cmds: Commands to be executed.
+        :param timeout: Timeout value in seconds for each command. Defualt: 30
+        :param sudo: Sudo privilege execution flag. Default: True.
+        :param stop_on_error: Skip the remaining commands after a failed one.
         :type cmds: list(str)
+        :type timeout: int
+        :type sudo: bool
+        :type stop_on_error: bool
+        :returns: RC, Stdout, Stderr of each executed command.
+        :rtype: list(tuple(int, str, str))
         """
-        for cmd in cmds:
-            self.execute(cmd)
+        try:
+            results = exec_cmd_batch(self._ssh_info, [self._guest_cmd(cmd) for cmd in cmds],
+                                     timeout * len(cmds), sudo, stop_on_error)
+        except SSHTimeout:
+            results = [(-1, '', '')] * len(cmds)
 
-    def execute_host(self, cmd, timeout=30):
+        for cmd, (ret_code, _, _) in zip(cmds, results):
+            if ret_code is None or int(ret_code) != 0:
+                logger.error(f"Execute cmd failed on {self.name} : {cmd}")
+        return results
+
+    def execute_host(self, cmd, timeout=30, exp_fail=False):
         """Execute a command on a host which the guest resides.
 
         :param cmd: Command.
         :param timeout: Timeout value in seconds.
+        :param exp_fail: Expect the command failure or success. Default: False.
+                         None means don't care about the command result.
         :type cmd: str
         :type timeout: int
+        :type exp_fail: bool
         :returns: ret_code, stdout, stderr
         :rtype: tuple(int, str, str)
         """
@@ -259,21 +207,29 @@ class Guest():
         logger.trace(stdout)
 
         if ret_code is None or int(ret_code) != 0:
-            raise RuntimeError(f"Execute host cmd failed on "
-                               f"{self._host_ssh_info['host']} : {cmd}")
+            # 'None' for exp_fail means don't care the result
+            if exp_fail is not None and not exp_fail:
+                raise RuntimeError(f"Execute host cmd failed on "
+                                   f"{self._host_ssh_info['host']} : {cmd}")
 
         return (ret_code, stdout, stderr)
 
     def execute_host_batch(self, cmds, timeout=30):
         """Execute a batch of commands on a host which the guest resides.
+        It stops at the first failed command.
 
         :param cmds: Commands.
-        :param timeout: Timeout value in seconds.
+        :param timeout: Timeout value in seconds for each command.
         :type cmds: list(str)
         :type timeout: int
         """
-        for cmd in cmds:
-            self.execute_host(cmd, timeout)
+        results = exec_cmd_batch(self._host_ssh_info, cmds, timeout * len(cmds),
+                                 sudo=True, stop_on_error=True)
+        for cmd, (ret_code, stdout, _) in zip(cmds, results):
+            logger.trace(stdout)
+            if ret_code is None or int(ret_code) != 0:
+                raise RuntimeError(f"Execute host cmd failed on "
+                                   f"{self._host_ssh_info['host']} : {cmd}")
 
     def add_vif(self, vif):
         """Add a VIF to the guest.
@@ -288,18 +244,19 @@ class Guest():
         """
         self.execute("ip addr list")
         for vif in self.vifs:
+            dev = self.vif_dev_name(vif)
             ipv4_str = vif.if_addr.ipv4_str_with_prefix()
             ipv6_str = vif.if_addr.ipv6_str_with_prefix()
 
-            cmds = [f"ip -4 addr add {ipv4_str} dev virtio{vif.idx}",
-                    f"ip -6 addr add {ipv6_str} dev virtio{vif.idx}",
-                    f"ip link set virtio{vif.idx} up"]
+            cmds = [f"ip -4 addr add {ipv4_str} dev {dev}",
+                    f"ip -6 addr add {ipv6_str} dev {dev}",
+                    f"ip link set {dev} up"]
             self.execute_batch(cmds)
             if vif.qpair > 1:
                 # start from 'combined 2' otherwise 'ethtool -L' will complain with
                 # 'combined unmodified, ignoring'
                 for q_idx in range(2, vif.qpair + 1):
-                    self.execute(f"ethtool -L virtio{vif.idx} combined {q_idx}")
+                    self.execute(f"ethtool -L {dev} combined {q_idx}")
 
     def configure_mtu(self, mtu):
         """Configure mtu of network interfaces inside the guest.
@@ -308,7 +265,7 @@ class Guest():
         :type mtu: int
         """
         for vif in self.vifs:
-            self.execute(f"ip link set virtio{vif.idx} mtu {mtu}")
+            self.execute(f"ip link set {self.vif_dev_name(vif)} mtu {mtu}")
 
     def configure(self):
         """Configure a guest after it starts.
@@ -316,9 +273,10 @@ class Guest():
         self.configure_interface()
 
     def _exec_ping(self, cmd, cnt, exp_fail):
-        _, stdout, _ = self.execute(cmd, exp_fail=exp_fail)
-        if not exp_fail:
-            _verify_ping_result(stdout, cnt)
+        ret_code, stdout, _ = self.execute(cmd, exp_fail=exp_fail)
+        if exp_fail:
+            return ret_code != 0
+        return ret_code == 0 and _verify_ping_result(stdout, cnt)
 
 
     def ping_ipv4_addr(self, ipv4, cnt=5, exp_fail=False):
@@ -331,11 +289,13 @@ class Guest():
         :type ipv4: IPv4Address obj
         :type cnt: int
         :type exp_fail: bool
+        :returns: True if all pings are as expected.
+        :rtype: bool
         """
-        for cmd in [f"ping -c {cnt} -i 0.3 {ipv4}",
-                    f"ping -c {cnt} -i 0.3 -s 1600 {ipv4}",
-                    f"ping -c {cnt} -i 0.3 -s 3200 {ipv4}"]:
-            self._exec_ping(cmd, cnt, exp_fail)
+        return all(self._exec_ping(cmd, cnt, exp_fail)
+                   for cmd in (f"ping -c {cnt} -i 0.3 {ipv4}",
+                               f"ping -c {cnt} -i 0.3 -s 1600 {ipv4}",
+                               f"ping -c {cnt} -i 0.3 -s 3200 {ipv4}"))
 
     def ping_ipv6_addr(self, ipv6, cnt=5, exp_fail=False):
         """Ping an ipv6 address from the guest.
@@ -347,11 +307,105 @@ class Guest():
         :type ipv4: IPv6Address obj
         :type cnt: int
         :type exp_fail: bool
+        :returns: True if all pings are as expected.
+        :rtype: bool
         """
-        for cmd in [f"ping -6 -c {cnt} -i 0.3 {ipv6}",
-                    f"ping -6 -c {cnt} -i 0.3 -s 1600 {ipv6}",
-                    f"ping -6 -c {cnt} -i 0.3 -s 3200 {ipv6}"]:
-            self._exec_ping(cmd, cnt, exp_fail)
+        return all(self._exec_ping(cmd, cnt, exp_fail)
+                   for cmd in (f"ping -6 -c {cnt} -i 0.3 {ipv6}",
+                               f"ping -6 -c {cnt} -i 0.3 -s 1600 {ipv6}",
+                               f"ping -6 -c {cnt} -i 0.3 -s 3200 {ipv6}"))
+
+    def probe_reachability(self, probes, deadline=0.5, attempts=3):
+        """Probe destinations from the guest concurrently by one command,
+        each attempt of a probe is given up after the deadline. It's used to
+        quickly verify that destinations are blocked.
+
+        A probe is retried until it succeeds, e.g. the first packet is slowed
+        down by ARP or flow setup, and it's blocked only if all of its
+        attempts time out. Any answer of the destination means reachable,
+        i.e. a refused tcp connection, or an ICMP port unreachable of udp.
+
+        :param probes: Probes of (proto, address, port), proto is 'icmp',
+            'tcp' or 'udp', and port is ignored by 'icmp'. A 'udp' probe
+            requires python3 in the guest.
+        :param deadline: Deadline in seconds of each attempt.
+        :param attempts: Number of attempts of each probe.
+        :type probes: list(tuple(str, IPv4Address or IPv6Address, int))
+        :type deadline: float
+        :type attempts: int
+        :returns: Reachability of each probe.
+        :rtype: list(bool)
+        :raises RuntimeError: If a probe fails for other reasons, e.g. the
+            probe tool is missing or its usage is wrong.
+        """
+        jobs = list()
+        for idx, (proto, addr, port) in enumerate(probes):
+            if proto == 'icmp':
+                ping = f"ping -c 1 {addr}" if _ip_is_v4(addr) else f"ping -6 -c 1 {addr}"
+                probe = f"timeout {deadline} {ping}"
+            elif proto == 'tcp':
+                probe = f"timeout {deadline} nc -z -v {addr} {port}"
+            elif proto == 'udp':
+                # The probe waits for the answer itself, python3 startup is
+                # not counted in the deadline.
+                probe = f"timeout {deadline + 5} python3 -c {quote(_UDP_PROBE)} " \
+                        f"{addr} {port} {deadline}"
+            else:
+                raise RuntimeError(f"Unsupported probe protocol: {proto}")
+            jobs.append(f"(for __i in $(seq {attempts}); do "
+                        f"__o=$({probe} 2>&1); __rc=$?; "
+                        f"case \"$__o\" in *[Rr]efused*) __rc=0;; esac; "
+                        f"case $__rc in {_PROBE_BLOCKED_RCS}) ;; *) break;; esac; "
+                        f"done; echo \"{idx} $__rc\") &")
+        _, stdout, _ = self.execute(" ".join(jobs) + " wait", exp_fail=None)
+
+        ret_codes = dict()
+        for line in stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0].isdigit():
+                ret_codes[int(fields[0])] = int(fields[1])
+        results = list()
+        for idx, probe in enumerate(probes):
+            ret_code = ret_codes.get(idx)
+            if ret_code == 0:
+                results.append(True)
+            elif ret_code in _PROBE_BLOCKED:
+                results.append(False)
+            else:
+                raise RuntimeError(f"Probe {probe} failed to run on {self.name}, "
+                                   f"return code {ret_code}")
+        return results
+
+    def start_udp_echo_server(self, port=5201):
+        """Run a UDP echo server of udp reachability probes in the guest,
+        it requires python3.
+
+        :param port: Server port.
+        :type port: int
+        """
+        self.execute(f"nohup python3 -c {quote(_UDP_ECHO)} {_UDP_ECHO_NAME} {port} "
+                     f">/dev/null 2>&1 &")
+
+    def stop_udp_echo_server(self):
+        """Stop the UDP echo server in the guest. """
+        self.kill_process(_UDP_ECHO_NAME)
+
+    def get_vif_statistics(self, vif, name):
+        """Get a statistics counter of a VIF inside the guest.
+
+        :param vif: Virtual interface.
+        :param name: Counter name in /sys/class/net/<dev>/statistics, e.g. rx_packets.
+        :type vif: VirtualInterface obj
+        :type name: str
+        :returns: Counter value.
+        :rtype: int
+        """
+        dev = self.vif_dev_name(vif)
+        _, stdout, _ = self.execute(f"cat /sys/class/net/{dev}/statistics/{name}")
+        try:
+            return int(stdout.strip())
+        except ValueError as err:
+            raise RuntimeError(f"Failed to read {name} of {dev} on {self.name}") from err
 
     def start_netperf_server(self, ipv4=True):
         """Run netperf server in the guest.
@@ -367,20 +421,78 @@ class Guest():
 
     def stop_netperf_server(self):
         """Stop netperf server in the guest. """
-        kill_process(self._ssh_info, "netserver")
+        self.kill_process("netserver")
+
+    def _run_netperf_client(self, server_ip, testname='TCP_RR', duration=10, req_size=0,
+                            resp_size=0, burst=0, send_size=0):
+        """Run netperf client in the guest against a started server.
+
+        :param server_ip: Server address.
+        :param testname: Netperf test type, TCP_RR, TCP_CRR, UDP_RR,
+            TCP_STREAM or TCP_MAERTS.
+        :param duration: Test duration in seconds.
+        :param req_size: Request size in bytes of RR tests.
+        :param resp_size: Response size in bytes of RR tests.
+        :param burst: Number of transactions in flight of RR tests.
+        :param send_size: Send size in bytes of stream tests.
+        :type server_ip: IPv4Address or IPv6Address obj
+        :type testname: str
+        :type duration: int
+        :type req_size: int
+        :type resp_size: int
+        :type burst: int
+        :type send_size: int
+        :returns: Test result.
+        :rtype: NetperfResult obj
+        """
+        cmd = netperf_client_cmd(server_ip, testname, duration, req_size, resp_size,
+                                 burst, send_size)
+        _, stdout, _ = self.execute(cmd, duration + 30)
+        end = time()
+        result = parse_netperf_output(stdout, testname)
+        logger.debug(f"netperf result: {json.dumps(result.to_dict())}")
+        if not result.error:
+            rate = result.transaction_rate if result.is_rr else result.throughput
+            traffic_log.record(f"netperf {testname} {self.name} -> {server_ip}",
+                               u"Tran/sec" if result.is_rr else result.throughput_units,
+                               [(end - duration, end, rate)])
+        return result
+
+    def execute_netperf(self, server_vm, server_ip, testname='TCP_RR', duration=10,
+                        req_size=0, resp_size=0, burst=0, send_size=0):
+        """Execute netperf test, the server is started before and stopped after it.
 
-    def _run_netperf_client(self, server_ip, testname='TCP_RR'):
-        cmd = f"netperf -H {server_ip} -l 10 -t {testname}"
-        ret_code, stdout, _ = self.execute(cmd)
-        logger.debug("netperf result: {}".format(stdout))
-        if ret_code != 0:
-            return (False, -1)
-        r_string = _process_netperf_result(stdout, testname)
-        return (True, r_string)
+        :param server_vm: Destination guest to run netperf server.
+        :param server_ip: Destination address.
+        :param testname: Netperf test type, TCP_RR, TCP_CRR, UDP_RR,
+            TCP_STREAM or TCP_MAERTS.
+        :param duration: Test duration in seconds.
+        :param req_size: Request size in bytes of RR tests.
+        :param resp_size: Response size in bytes of RR tests.
+        :param burst: Number of transactions in flight of RR tests.
+        :param send_size: Send size in bytes of stream tests.
+        :type server_vm: Guest obj
+        :type server_ip: IPv4Address or IPv6Address obj
+        :type testname: str
+        :type duration: int
+        :type req_size: int
+        :type resp_size: int
+        :type burst: int
+        :type send_size: int
+        :returns: Test result.
+        :rtype: NetperfResult obj
+        """
+        # pylint: disable=too-many-arguments
+        server_vm.start_netperf_server(ipv4=_ip_is_v4(server_ip))
+        result = self._run_netperf_client(server_ip, testname, duration, req_size,
+                                          resp_size, burst, send_size)
+        server_vm.stop_netperf_server()
+        if result.error:
+            raise RuntimeError(f"NetPerf Not Successful: {result.error}")
+        return result
 
     def execute_netperf_ipv4(self, server_vm, server_ip, testname='TCP_RR'):
         """Execute netperf ipv4 test.
-        Only test TCP_RR for now.
 
         :param server_vm: Destination guest to run netperf server.
         :param server_ip: Destination ipv4 address.
@@ -391,16 +503,11 @@ class Guest():
         :returns: Test result.
         :rtype: str
         """
-        server_vm.start_netperf_server(ipv4=True)
-        (succ, r_string) = self._run_netperf_client(server_ip, testname)
-        server_vm.stop_netperf_server()
-        if not succ:
-            raise RuntimeError("NetPerf Not Successful")
-        return f"TCP_RR ipv4 {r_string} Tran/sec"
+        result = self.execute_netperf(server_vm, server_ip, testname)
+        return f"{testname} ipv4 {result}"
 
     def execute_netperf_ipv6(self, server_vm, server_ip, testname='TCP_RR'):
         """Execute netperf ipv6 test.
-        Only test TCP_RR for now.
 
         :param server_vm: Destination guest to run netperf server.
         :param server_ip: Destination ipv6 address.
@@ -411,63 +518,121 @@ class Guest():
         :returns: Test result.
         :rtype: str
         """
-        server_vm.start_netperf_server(ipv4=False)
-        (succ, r_string) = self._run_netperf_client(server_ip, testname)
-        server_vm.stop_netperf_server()
-        if not succ:
-            raise RuntimeError("NetPerf Not Successful")
-        return f"TCP_RR ipv6 {r_string} Tran/sec"
+        result = self.execute_netperf(server_vm, server_ip, testname)
+        return f"{testname} ipv6 {result}"
 
-    def start_iperf_server(self, ipv4=True):
+    def start_iperf_server(self, ipv4=True, port=5201):
         """Run iperf server in the guest.
 
         :param ipv4: Run in v4 mode.
+        :param port: Server port.
         :type ipv4: bool
+        :type port: int
         """
         if ipv4:
             options = ''
         else:
             options = '-6'
-        self.execute(f"iperf3 {options} -s -D")
+        self.execute(f"iperf3 {options} -s -D -p {port}")
 
     def stop_iperf_server(self):
         """Stop netperf server in the guest. """
-        kill_process(self._ssh_info, "iperf3")
+        self.kill_process("iperf3")
 
-    def _run_iperf_client(self, server_ip, bw=0, proto='tcp',
-                          parallel=1, exp_fail=False):
-        if _ip_is_v4(server_ip):
-            options = ''
-        else:
-            options = '-6'
-
-        if bw:
-            options += f" -b {bw}K "
+    def run_iperf_client(self, server_ip, bw=0, proto='tcp', parallel=1, exp_fail=False,
+                         port=5201, duration=10, omit=0, reverse=False, bidir=False,
+                         length=0):
+        """Run iperf client in the guest against a started server.
 
-        if proto == 'udp':
-            udp_options = '-u -l 63k'
-        else:
-            udp_options = ''
-
-        if parallel > 1:
-            parallel_options = f"-P {parallel}"
-        else:
-            parallel_options = ''
-
-        cmd = f"iperf3 {options} -c {server_ip} -t 10 -f k " \
-              f"{udp_options} {parallel_options}"
-        _, stdout, _ = self.execute(cmd, 50, exp_fail=exp_fail)
+        :param server_ip: Server address.
+        :param bw: Bandwidth in kbps. Default: 0 means unlimited
+        :param proto: Test protocol. Default: "tcp"
+        :param parallel: Number of concurrent streams. Default: 1
+        :param exp_fail: Expect the command failure or success. Default: False.
+        :param port: Server port.
+        :param duration: Test duration in seconds.
+        :param omit: Seconds of warm-up which are omitted from the result.
+        :param reverse: Server sends and client receives.
+        :param bidir: Test in both directions at the same time.
+        :param length: Datagram payload length in bytes of udp, 0 means 63k.
+        :type server_ip: IPv4Address or IPv6Address obj
+        :type bw: int
+        :type proto: str
+        :type parallel: int
+        :type exp_fail: bool
+        :type port: int
+        :type duration: int
+        :type omit: int
+        :type reverse: bool
+        :type bidir: bool
+        :type length: int
+        :returns: Test result, it's printed as e.g. "1000 Kbits/sec".
+        :rtype: IperfResult obj
+        """
+        # pylint: disable=too-many-arguments
+        cmd = iperf_client_cmd(server_ip, _ip_is_v4(server_ip), port, proto, bw, parallel,
+                               duration, omit, reverse, bidir, length)
+        _, stdout, _ = self.execute(cmd, duration + omit + 40, exp_fail=exp_fail)
+        end = time()
+        if exp_fail:
+            return IperfResult(proto)
+
+        result = parse_iperf_json(stdout, proto)
+        intervals = [i for i in result.intervals if not i.omitted]
+        if intervals:
+            # iperf3 exits right after its last interval, anchor intervals at
+            # the local end time as the guest clock is not synchronized.
+            offset = end - intervals[-1].end
+            traffic_log.record(f"iperf {proto} {self.name} -> {server_ip}", u"Kbits/sec",
+                               [(offset + i.start, offset + i.end, i.bits_per_second / 1000)
+                                for i in intervals])
+        logger.debug(f"iperf result: {json.dumps(result.to_dict())}")
+        if result.error:
+            logger.warn(f"iperf failed on {self.name}: {result.error}")
+        elif result.zero_intervals() > 5:
+            logger.warn(f"zero Bandwidth in {result.zero_intervals()} intervals")
+        return result
+
+    def execute_iperf(self, server_vm, server_ip, bw=0, proto='tcp', parallel=1,
+                      exp_fail=False, port=5201, duration=10, omit=0, reverse=False,
+                      bidir=False):
+        """Execute iperf test, the server is started before and stopped after it.
 
-        rate = 0
-        if not exp_fail:
-            if proto == 'udp':
-                rate = _verify_iperf_udp_result(stdout, rate)
-            else:
-                rate = _verify_iperf_result(stdout, rate)
-        return rate
+        :param server_vm: Destination guest to run iperf server.
+        :param server_ip: Destination address.
+        :param bw: Bandwidth in kbps. Default: 0 means unlimited
+        :param proto: Test protocol. Default: "tcp"
+        :param parallel: Number of concurrent streams. Default: 1
+        :param exp_fail: Expect the command failure or success. Default: False.
+                         None means don't care about the command result.
+        :param port: Server port.
+        :param duration: Test duration in seconds.
+        :param omit: Seconds of warm-up which are omitted from the result.
+        :param reverse: Server sends and client receives.
+        :param bidir: Test in both directions at the same time.
+        :type server_vm: Guest obj
+        :type server_ip: IPv4Address or IPv6Address obj
+        :type bw: int
+        :type proto: str
+        :type parallel: int
+        :type exp_fail: bool
+        :type port: int
+        :type duration: int
+        :type omit: int
+        :type reverse: bool
+        :type bidir: bool
+        :returns: Test result.
+        :rtype: IperfResult obj
+        """
+        # pylint: disable=too-many-arguments
+        server_vm.start_iperf_server(ipv4=_ip_is_v4(server_ip), port=port)
+        result = self.run_iperf_client(server_ip, bw, proto, parallel, exp_fail, port,
+                                       duration, omit, reverse, bidir)
+        server_vm.stop_iperf_server()
+        return result
 
     def execute_iperf_ipv4(self, server_vm, server_ip, bw=0, proto='tcp',
-                           parallel=1, exp_fail=False):
+                           parallel=1, exp_fail=False, port=5201):
         """Execute iperf ipv4 test.
 
         :param server_vm: Destination guest to run iperf server.
@@ -477,22 +642,22 @@ class Guest():
         :param parallel: Number of concurrent streams. Default: 1
         :param exp_fail: Expect the command failure or success. Default: False.
                          None means don't care about the command result.
+        :param port: Server port.
         :type server_vm: Guest obj
         :type server_ip: IPv4Address obj
         :type bw: int
         :type proto: str
         :type parallel: int
         :type exp_fail: bool
+        :type port: int
         :returns: Test result in kbps.
         :rtype: str
         """
-        server_vm.start_iperf_server(ipv4=True)
-        rate = self._run_iperf_client(server_ip, bw, proto, parallel, exp_fail)
-        server_vm.stop_iperf_server()
+        rate = self.execute_iperf(server_vm, server_ip, bw, proto, parallel, exp_fail, port)
         return f"{proto} ipv4 throughput: {rate}"
 
     def execute_iperf_ipv6(self, server_vm, server_ip, bw=0, proto='tcp',
-                           parallel=1, exp_fail=False):
+                           parallel=1, exp_fail=False, port=5201):
         """Execute iperf ipv6 test.
 
         :param server_vm: Destination guest to run iperf server.
@@ -502,18 +667,18 @@ class Guest():
         :param parallel: Number of concurrent streams. Default: 1
         :param exp_fail: Expect the command failure or success. Default: False.
                          None means don't care about the command result.
+        :param port: Server port.
         :type server_vm: Guest obj
         :type server_ip: IPv6Address obj
         :type bw: int
         :type proto: str
         :type parallel: int
         :type exp_fail: bool
+        :type port: int
         :returns: Test result in kbps.
         :rtype: str
         """
-        server_vm.start_iperf_server(ipv4=False)
-        rate = self._run_iperf_client(server_ip, bw, proto, parallel, exp_fail)
-        server_vm.stop_iperf_server()
+        rate = self.execute_iperf(server_vm, server_ip, bw, proto, parallel, exp_fail, port)
         return f"{proto} ipv6 throughput: {rate}"
 
     # The test VM as very limited space on test vm, thus using 1MB test file
@@ -0,0 +1,576 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Host resource sampling of SUTs which is time aligned with traffic.
+
+A sampler runs one shell loop on a SUT through a single long-lived SSH
+channel, and every interval the loop prints a snapshot of /proc/stat,
+/proc/softirqs, /proc/net/dev, /proc/meminfo, RSS of ovs-vswitchd and QEMU
+processes, uplink counters and PMD cycles. Deltas between snapshots are
+samples of rates and utilizations.
+
+Traffic generators record their reporting intervals into 'traffic_log'
+while sampling is enabled, so each interval of e.g. iperf can be joined
+with host samples of the same period, and a throughput dip can be tied to
+host events.
+"""
+
+import json
+import re
+import socket
+import statistics
+
+from threading import Lock, Thread
+from time import time
+
+from paramiko.ssh_exception import SSHException
+from robot.api import logger
+
+from resources.libraries.python.sshshell import open_stream, close_stream
+
+__all__ = [
+    u"HostSampler",
+    u"TrafficLog",
+    u"traffic_log",
+    u"parse_counters",
+    u"parse_snapshot",
+    u"sample_delta",
+    u"flatten_sample",
+    u"align_samples",
+    u"write_host_sampling_report",
+]
+
+_BLOCK = u"@@ "
+_BLOCK_END = u"@@ end"
+_SECTION = u"## "
+
+# Fields of a cpu line of /proc/stat, guest time is included in user time.
+_CPU_FIELDS = (u"user", u"nice", u"system", u"idle", u"iowait", u"irq", u"softirq", u"steal")
+_MEMINFO_KEYS = (u"MemTotal", u"MemAvailable", u"HugePages_Total", u"HugePages_Free",
+                 u"Hugepagesize")
+_PMD_RE = re.compile(r"^pmd thread numa_id (\d+) core_id (\d+):")
+_CYCLES_RE = re.compile(r"^\s*(idle|processing) cycles:\s*(\d+)")
+_DROP_RE = re.compile(r"drop|miss|discard|error|fifo|no_buf|nombuf", re.IGNORECASE)
+# A throughput interval below this ratio of the median is a dip.
+_DIP_RATIO = 0.8
+
+def sampler_script(cmds, interval=1):
+    """Build the remote shell loop of a sampler.
+
+    :param cmds: Extra commands by section name, e.g. 'uplink dpdk1'.
+    :param interval: Sampling interval in seconds.
+    :type cmds: dict
+    :type interval: float
+    :returns: Shell script.
+    :rtype: str
+    """
+    meminfo = u"|".join(_MEMINFO_KEYS)
+    lines = [u"while :; do",
+             f"echo \"{_BLOCK}$(date +%s.%N)\"",
+             f"echo '{_SECTION}stat'; cat /proc/stat",
+             f"echo '{_SECTION}softirqs'; grep -E 'CPU|NET_RX|NET_TX' /proc/softirqs",
+             f"echo '{_SECTION}netdev'; cat /proc/net/dev",
+             f"echo '{_SECTION}meminfo'; grep -E '^({meminfo}):' /proc/meminfo",
+             f"echo '{_SECTION}rss'",
+             u"for p in $(pgrep 'ovs-vswitchd|qemu'); do "
+             u"echo \"$p $(cat /proc/$p/comm) "
+             u"$(awk '/^VmRSS/{print $2}' /proc/$p/status)\"; done 2>/dev/null"]
+    for section, cmd in cmds.items():
+        lines.append(f"echo '{_SECTION}{section}'; {cmd} 2>/dev/null")
+    lines += [f"echo '{_BLOCK_END}'", f"sleep {interval}", u"done"]
+    return u"\n".join(lines)
+
+def _parse_stat(lines, snapshot):
+    cpus = dict()
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0].startswith(u"cpu") and fields[0] != u"cpu":
+            cpus[fields[0][3:]] = [int(v) for v in fields[1:len(_CPU_FIELDS) + 1]]
+        elif fields[0] in (u"intr", u"softirq"):
+            snapshot[fields[0]] = int(fields[1])
+    snapshot[u"cpu"] = cpus
+
+def _parse_softirqs(lines, snapshot):
+    cpus = list()
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0].startswith(u"CPU"):
+            cpus = [f[3:] for f in fields]
+        else:
+            snapshot[fields[0].rstrip(u":")] = dict(zip(cpus, [int(v) for v in fields[1:]]))
+
+def _parse_netdev(lines, snapshot):
+    netdev = dict()
+    for line in lines:
+        name, sep, counters = line.partition(u":")
+        fields = counters.split()
+        if not sep or len(fields) < 12:
+            continue
+        # rx bytes, packets, errs, drop ... tx bytes, packets, errs, drop
+        netdev[name.strip()] = {
+            u"rx_bytes": int(fields[0]), u"rx_packets": int(fields[1]),
+            u"rx_dropped": int(fields[3]), u"tx_bytes": int(fields[8]),
+            u"tx_packets": int(fields[9]), u"tx_dropped": int(fields[11])}
+    snapshot[u"netdev"] = netdev
+
+def _parse_meminfo(lines, snapshot):
+    meminfo = dict()
+    for line in lines:
+        name, sep, value = line.partition(u":")
+        if sep and value.split():
+            meminfo[name.strip()] = int(value.split()[0])
+    snapshot[u"meminfo"] = meminfo
+
+def _parse_rss(lines, snapshot):
+    rss = dict()
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 3:
+            rss[f"{fields[1]} {fields[0]}"] = int(fields[2])
+    snapshot[u"rss"] = rss
+
+def parse_counters(output):
+    """Parse interface counters of 'ethtool -S', or 'ovs-vsctl get
+    Interface <name> statistics' which is a '{key=value, ...}' map.
+
+    :param output: Command output.
+    :type output: str
+    :returns: Counters by name.
+    :rtype: dict
+    """
+    output = output.strip()
+    if output.startswith(u"{"):
+        pairs = [p.partition(u"=") for p in output.strip(u"{}").split(u",")]
+    else:
+        pairs = [line.partition(u":") for line in output.splitlines()]
+    counters = dict()
+    for name, sep, value in pairs:
+        value = value.strip()
+        if sep and value.lstrip(u"-").isdigit():
+            counters[name.strip()] = int(value)
+    return counters
+
+def _parse_pmd(lines, snapshot):
+    cycles = dict()
+    core = None
+    for line in lines:
+        match = _PMD_RE.match(line)
+        if match:
+            core = match.group(2)
+            cycles[core] = {u"idle": 0, u"processing": 0}
+            continue
+        match = _CYCLES_RE.match(line)
+        if match and core is not None:
+            cycles[core][match.group(1)] = int(match.group(2))
+    snapshot[u"pmd"] = cycles
+
+_PARSERS = {u"stat": _parse_stat, u"softirqs": _parse_softirqs, u"netdev": _parse_netdev,
+            u"meminfo": _parse_meminfo, u"rss": _parse_rss, u"pmd": _parse_pmd}
+
+def parse_snapshot(lines):
+    """Parse a snapshot printed by the sampler loop.
+
+    :param lines: Lines between the timestamp line and the end line.
+    :type lines: list(str)
+    :returns: Snapshot with 'ts' in remote epoch seconds and a key of
+        each section, uplink counters are in 'uplink' by uplink name.
+    :rtype: dict
+    """
+    snapshot = {u"uplink": dict(), u"pmd": dict()}
+    sections = dict()
+    section = None
+    for line in lines:
+        if line.startswith(_BLOCK):
+            snapshot[u"ts"] = float(line[len(_BLOCK):])
+        elif line.startswith(_SECTION):
+            section = line[len(_SECTION):].strip()
+            sections[section] = list()
+        elif section is not None:
+            sections[section].append(line)
+    for section, section_lines in sections.items():
+        if section.startswith(u"uplink "):
+            snapshot[u"uplink"][section[len(u"uplink "):]] = \
+                parse_counters(u"\n".join(section_lines))
+        elif section in _PARSERS:
+            _PARSERS[section](section_lines, snapshot)
+    return snapshot
+
+def _pct(part, total):
+    return round(100.0 * part / total, 2) if total > 0 else 0.0
+
+def sample_delta(prev, cur):
+    """Build a sample from two consecutive snapshots.
+
+    Utilization of a PMD core is taken from PMD processing cycles, as a
+    polling core is always 100% busy in /proc/stat.
+
+    :param prev: Previous snapshot.
+    :param cur: Current snapshot.
+    :type prev: dict
+    :type cur: dict
+    :returns: Sample with 'start', 'end', per cpu utilization in percent,
+        pmd busy percent by core, interrupt and softirq rates, per
+        interface rates, uplink counter deltas, memory and RSS in MB.
+    :rtype: dict
+    """
+    # pylint: disable=too-many-locals
+    elapsed = cur[u"ts"] - prev[u"ts"]
+    sample = {u"start": prev[u"ts"], u"end": cur[u"ts"]}
+
+    pmd = dict()
+    for core, cycles in cur.get(u"pmd", dict()).items():
+        old = prev.get(u"pmd", dict()).get(core)
+        if old:
+            busy = cycles[u"processing"] - old[u"processing"]
+            pmd[core] = _pct(busy, busy + cycles[u"idle"] - old[u"idle"])
+    sample[u"pmd"] = pmd
+
+    cpus = dict()
+    for cpu, fields in cur.get(u"cpu", dict()).items():
+        old = prev.get(u"cpu", dict()).get(cpu)
+        if not old:
+            continue
+        delta = dict(zip(_CPU_FIELDS, [c - o for c, o in zip(fields, old)]))
+        total = sum(delta.values())
+        cpus[cpu] = {u"busy": _pct(total - delta[u"idle"] - delta[u"iowait"], total),
+                     u"system": _pct(delta[u"system"], total),
+                     u"irq": _pct(delta[u"irq"], total),
+                     u"softirq": _pct(delta[u"softirq"], total),
+                     u"pmd": cpu in pmd}
+    sample[u"cpu"] = cpus
+
+    for name in (u"intr", u"softirq"):
+        if name in cur and name in prev:
+            sample[f"{name}_rate"] = round((cur[name] - prev[name]) / elapsed, 1)
+    for name in (u"NET_RX", u"NET_TX"):
+        if name in cur and name in prev:
+            sample[f"{name.lower()}_rate"] = {
+                cpu: round((count - prev[name].get(cpu, 0)) / elapsed, 1)
+                for cpu, count in cur[name].items()}
+
+    netdev = dict()
+    for iface, counters in cur.get(u"netdev", dict()).items():
+        old = prev.get(u"netdev", dict()).get(iface)
+        if not old or counters == old:
+            continue
+        netdev[iface] = {
+            u"rx_pps": round((counters[u"rx_packets"] - old[u"rx_packets"]) / elapsed, 1),
+            u"tx_pps": round((counters[u"tx_packets"] - old[u"tx_packets"]) / elapsed, 1),
+            u"rx_mbps": round((counters[u"rx_bytes"] - old[u"rx_bytes"]) * 8 / elapsed / 1e6, 3),
+            u"tx_mbps": round((counters[u"tx_bytes"] - old[u"tx_bytes"]) * 8 / elapsed / 1e6, 3),
+            u"rx_dropped": counters[u"rx_dropped"] - old[u"rx_dropped"],
+            u"tx_dropped": counters[u"tx_dropped"] - old[u"tx_dropped"]}
+    sample[u"netdev"] = netdev
+
+    uplinks = dict()
+    for uplink, counters in cur.get(u"uplink", dict()).items():
+        old = prev.get(u"uplink", dict()).get(uplink, dict())
+        uplinks[uplink] = {name: value - old[name] for name, value in counters.items()
+                           if name in old and value != old[name]}
+    sample[u"uplink"] = uplinks
+
+    meminfo = cur.get(u"meminfo", dict())
+    sample[u"mem_available_mb"] = round(meminfo.get(u"MemAvailable", 0) / 1024, 1)
+    sample[u"hugepages_total"] = meminfo.get(u"HugePages_Total", 0)
+    sample[u"hugepages_free"] = meminfo.get(u"HugePages_Free", 0)
+    sample[u"rss_mb"] = {proc: round(kbytes / 1024, 1)
+                         for proc, kbytes in cur.get(u"rss", dict()).items()}
+    return sample
+
+def flatten_sample(sample):
+    """Reduce a sample to scalar metrics which can be averaged over time.
+
+    :param sample: Sample, see sample_delta().
+    :type sample: dict
+    :returns: Metrics by name, e.g. 'cpu_busy_max', 'pmd_busy_avg' and
+        'uplink_drops'.
+    :rtype: dict
+    """
+    flat = dict()
+    host_cpus = [c for c in sample[u"cpu"].values() if not c[u"pmd"]]
+    if host_cpus:
+        flat[u"cpu_busy_avg"] = statistics.mean(c[u"busy"] for c in host_cpus)
+        flat[u"cpu_busy_max"] = max(c[u"busy"] for c in host_cpus)
+        flat[u"cpu_softirq_max"] = max(c[u"softirq"] for c in host_cpus)
+    if sample[u"pmd"]:
+        flat[u"pmd_busy_avg"] = statistics.mean(sample[u"pmd"].values())
+        flat[u"pmd_busy_max"] = max(sample[u"pmd"].values())
+    for name in (u"intr_rate", u"softirq_rate"):
+        if name in sample:
+            flat[name] = sample[name]
+    for name in (u"net_rx_rate", u"net_tx_rate"):
+        if name in sample:
+            flat[name] = sum(sample[name].values())
+    flat[u"uplink_drops"] = sum(value for counters in sample[u"uplink"].values()
+                                for name, value in counters.items()
+                                if _DROP_RE.search(name)) + \
+        sum(c[u"rx_dropped"] + c[u"tx_dropped"] for c in sample[u"netdev"].values())
+    flat[u"mem_available_mb"] = sample[u"mem_available_mb"]
+    flat[u"hugepages_free"] = sample[u"hugepages_free"]
+    for proc, rss in sample[u"rss_mb"].items():
+        # comm of QEMU is truncated, e.g. 'qemu-system-x86'
+        comm = proc.split()[0]
+        key = f"{u'qemu' if comm.startswith(u'qemu') else comm}_rss_mb"
+        flat[key] = flat.get(key, 0) + rss
+    return flat
+
+def align_samples(samples, start, end):
+    """Aggregate samples over a period, weighted by their overlap with it.
+
+    Drop counters are summed, other metrics are averaged.
+
+    :param samples: Samples in local time, see HostSampler.samples().
+    :param start: Start of the period in local epoch seconds.
+    :param end: End of the period in local epoch seconds.
+    :type samples: list(dict)
+    :type start: float
+    :type end: float
+    :returns: Metrics by name, empty if no sample overlaps the period.
+    :rtype: dict
+    """
+    totals = dict()
+    weights = dict()
+    for sample in samples:
+        overlap = min(end, sample[u"end"]) - max(start, sample[u"start"])
+        if overlap <= 0:
+            continue
+        ratio = overlap / (sample[u"end"] - sample[u"start"])
+        for name, value in flatten_sample(sample).items():
+            if name == u"uplink_drops":
+                totals[name] = totals.get(name, 0) + value * ratio
+                weights[name] = 1
+            else:
+                totals[name] = totals.get(name, 0) + value * overlap
+                weights[name] = weights.get(name, 0) + overlap
+    return {name: round(total / weights[name], 2) for name, total in totals.items()}
+
+
+class TrafficLog:
+    """Reporting intervals of traffic generators in local time, they are
+    only recorded while host sampling is enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = Lock()
+        self.entries = list()
+
+    def start(self):
+        """Clear recorded traffic and enable recording. """
+        with self._lock:
+            self.entries = list()
+            self.enabled = True
+
+    def stop(self):
+        """Disable recording.
+
+        :returns: Recorded traffic.
+        :rtype: list(dict)
+        """
+        with self._lock:
+            self.enabled = False
+            return list(self.entries)
+
+    def record(self, label, unit, intervals):
+        """Record intervals of a traffic run, it's a no-op if not enabled.
+
+        :param label: Traffic label, e.g. 'iperf tcp vm1 -> 10.0.0.2'.
+        :param unit: Unit of interval values.
+        :param intervals: Start, end in local epoch seconds and value of
+            each interval.
+        :type label: str
+        :type unit: str
+        :type intervals: list(tuple(float, float, float))
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.entries.append({u"label": label, u"unit": unit,
+                                 u"intervals": [list(i) for i in intervals]})
+
+
+traffic_log = TrafficLog()
+
+
+class HostSampler:
+    """Sampler of a SUT which streams snapshots over one SSH channel.
+
+    The remote loop is killed by stop(), or after max_duration seconds if
+    it's left behind, see open_stream().
+
+    :param node: SSH info of the SUT.
+    :param name: SUT name.
+    :param cmds: Extra commands by section name, see
+        VirtualSwitch.host_sampling_cmds().
+    :param interval: Sampling interval in seconds.
+    :param max_duration: Seconds after which the remote loop is killed.
+    :type node: dict
+    :type name: str
+    :type cmds: dict
+    :type interval: float
+    :type max_duration: int
+    """
+
+    def __init__(self, node, name, cmds, interval=1, max_duration=3600):
+        # pylint: disable=too-many-arguments
+        self.node = node
+        self.name = name
+        self._script = sampler_script(cmds, interval)
+        self._max_duration = max_duration
+        self._stream = None
+        self._thread = None
+        self._stopping = False
+        self._snapshots = list()
+        self.error = None
+
+    def start(self):
+        """Start the remote loop and the local reader thread, nothing is
+        sampled if SSH is replayed.
+        """
+        self._stream = open_stream(self.node, self._script, self._max_duration)
+        if self._stream is None:
+            return
+        self._stream[0].settimeout(0.5)
+        self._stopping = False
+        self._snapshots = list()
+        self._thread = Thread(target=self._read, name=f"sampler-{self.name}", daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        # Robot ignores logging of non-main threads, errors are kept in self.error
+        chan = self._stream[0]
+        buf = u""
+        block = list()
+        while not self._stopping:
+            try:
+                data = chan.recv(65536)
+            except socket.timeout:
+                continue
+            except (SSHException, socket.error) as err:
+                self.error = str(err)
+                break
+            if not data:
+                if not self._stopping:
+                    self.error = u"sampler exited"
+                break
+            recv_time = time()
+            buf += data.decode(encoding=u"utf-8", errors=u"ignore")
+            lines = buf.split(u"\n")
+            buf = lines.pop()
+            for line in lines:
+                if line == _BLOCK_END:
+                    if block:
+                        try:
+                            snapshot = parse_snapshot(block)
+                            snapshot[u"recv"] = recv_time
+                            self._snapshots.append(snapshot)
+                        except (ValueError, KeyError, IndexError) as err:
+                            self.error = f"bad snapshot: {err}"
+                    block = list()
+                elif line.startswith(_BLOCK) or block:
+                    block.append(line)
+
+    def stop(self):
+        """Stop the remote loop and the reader thread. """
+        if self._stream is None:
+            return
+        self._stopping = True
+        close_stream(self._stream)
+        self._thread.join(5)
+        self._stream = None
+        if self.error:
+            logger.warn(f"Host sampler on {self.name}: {self.error}")
+
+    def samples(self):
+        """Get samples with times converted to the local clock.
+
+        The clock offset is the smallest difference between the receive
+        time and the remote timestamp of snapshots, i.e. it's biased by the
+        minimal one-way latency only.
+
+        :returns: Samples, see sample_delta().
+        :rtype: list(dict)
+        """
+        snapshots = list(self._snapshots)
+        if len(snapshots) < 2:
+            return list()
+        offset = min(s[u"recv"] - s[u"ts"] for s in snapshots)
+        samples = list()
+        for prev, cur in zip(snapshots, snapshots[1:]):
+            sample = sample_delta(prev, cur)
+            sample[u"start"] += offset
+            sample[u"end"] += offset
+            samples.append(sample)
+        return samples
+
+
+def _summarize(name, samples):
+    flats = [flatten_sample(s) for s in samples]
+    lines = list()
+    def metric(key, label, unit, reduce=statistics.mean):
+        values = [f[key] for f in flats if key in f]
+        if values:
+            lines.append(f"{name} {label}: {reduce(values):.1f} {unit}")
+    metric(u"cpu_busy_avg", u"host cpu busy", u"%")
+    metric(u"cpu_busy_max", u"host cpu busy max", u"%", max)
+    metric(u"pmd_busy_avg", u"pmd busy", u"%")
+    metric(u"pmd_busy_max", u"pmd busy max", u"%", max)
+    metric(u"intr_rate", u"interrupts", u"/sec")
+    metric(u"net_rx_rate", u"NET_RX softirqs", u"/sec")
+    metric(u"uplink_drops", u"uplink drops", u"packets", sum)
+    metric(u"hugepages_free", u"hugepages free", u"pages", min)
+    metric(u"ovs-vswitchd_rss_mb", u"ovs-vswitchd rss", u"MB", max)
+    metric(u"qemu_rss_mb", u"qemu rss", u"MB", max)
+    return lines
+
+def write_host_sampling_report(path, samples, traffic):
+    """Write samples and traffic intervals joined with host metrics as
+    JSON, and warn about throughput dips with host metrics of their period.
+
+    :param path: File path.
+    :param samples: Samples by SUT name.
+    :param traffic: Recorded traffic, see TrafficLog.stop().
+    :type path: str
+    :type samples: dict
+    :type traffic: list(dict)
+    :returns: Summary result lines of each SUT.
+    :rtype: list(str)
+    """
+    aligned = list()
+    for entry in traffic:
+        values = [i[2] for i in entry[u"intervals"]]
+        median = statistics.median(values) if values else 0
+        for start, end, value in entry[u"intervals"]:
+            row = {u"label": entry[u"label"], u"start": start, u"end": end, u"value": value,
+                   u"unit": entry[u"unit"], u"dip": value < median * _DIP_RATIO,
+                   u"hosts": {name: align_samples(s, start, end)
+                              for name, s in samples.items()}}
+            aligned.append(row)
+            if row[u"dip"]:
+                logger.warn(f"{entry[u'label']} dropped to {value:.0f} {entry[u'unit']} "
+                            f"(median {median:.0f}) at {start - entry[u'intervals'][0][0]:.1f}s, "
+                            f"host metrics: {json.dumps(row[u'hosts'])}")
+
+    with open(path, u"w") as report:
+        json.dump({u"samples": samples, u"traffic": aligned}, report)
+    logger.info(f"Host samples are written to {path}")
+
+    lines = list()
+    for name, sut_samples in samples.items():
+        lines += _summarize(name, sut_samples)
+    return lines
@@ -0,0 +1,218 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library for building iperf3 commands and parsing their JSON output."""
+
+import json
+
+__all__ = [
+    u"IperfInterval",
+    u"IperfResult",
+    u"iperf_client_cmd",
+    u"parse_iperf_json",
+]
+
+def iperf_client_cmd(server_ip, ipv4=True, port=5201, proto='tcp', bw=0, parallel=1,
+                     duration=10, omit=0, reverse=False, bidir=False, length=0):
+    """Build an iperf3 client command with JSON output.
+
+    :param server_ip: Server address.
+    :param ipv4: Run in v4 mode.
+    :param port: Server port.
+    :param proto: Test protocol, 'tcp' or 'udp'.
+    :param bw: Bandwidth in kbps, 0 means unlimited.
+    :param parallel: Number of concurrent streams.
+    :param duration: Test duration in seconds.
+    :param omit: Seconds of warm-up which are omitted from the result.
+    :param reverse: Server sends and client receives.
+    :param bidir: Test in both directions at the same time.
+    :param length: Datagram payload length in bytes of udp, 0 means 63k.
+    :type server_ip: IPv4Address or IPv6Address obj
+    :type ipv4: bool
+    :type port: int
+    :type proto: str
+    :type bw: int
+    :type parallel: int
+    :type duration: int
+    :type omit: int
+    :type reverse: bool
+    :type bidir: bool
+    :type length: int
+    :returns: Command.
+    :rtype: str
+    """
+    # pylint: disable=too-many-arguments
+    options = [u"iperf3", u"-J"]
+    if not ipv4:
+        options.append(u"-6")
+    options += [f"-c {server_ip}", f"-p {port}", f"-t {duration}"]
+    if omit:
+        options.append(f"-O {omit}")
+    if bw:
+        options.append(f"-b {bw}K")
+    if proto == 'udp':
+        options.append(f"-u -l {length}" if length else u"-u -l 63k")
+    if parallel > 1:
+        options.append(f"-P {parallel}")
+    if reverse:
+        options.append(u"-R")
+    if bidir:
+        options.append(u"--bidir")
+    return u" ".join(options)
+
+
+class IperfInterval:
+    """Throughput of a reporting interval. """
+
+    def __init__(self, data):
+        self.start = data.get(u"start", 0.0)
+        self.end = data.get(u"end", 0.0)
+        self.bits_per_second = data.get(u"bits_per_second", 0.0)
+        self.retransmits = data.get(u"retransmits")
+        self.omitted = data.get(u"omitted", False)
+        self.snd_cwnd = None
+        self.lost_packets = data.get(u"lost_packets")
+        self.packets = data.get(u"packets")
+
+    def to_dict(self):
+        """Convert to a JSON serializable dict. """
+        return dict(self.__dict__)
+
+
+class IperfResult:
+    """Structured result of an iperf3 test.
+
+    Throughput is the receiver's, it's in the forward direction for
+    '--bidir', and the reverse direction is in 'reverse_*' attributes.
+    """
+
+    def __init__(self, proto=u"tcp"):
+        self.proto = proto
+        self.error = None
+        self.intervals = list()
+        self.reverse_intervals = list()
+        self.sent_bps = 0.0
+        self.received_bps = 0.0
+        self.retransmits = None
+        self.max_snd_cwnd = None
+        self.cpu_local = None
+        self.cpu_remote = None
+        self.jitter_ms = None
+        self.lost_packets = None
+        self.packets = None
+        self.lost_percent = None
+        self.reverse_sent_bps = None
+        self.reverse_received_bps = None
+
+    @property
+    def kbps(self):
+        """Receiver throughput in kbps. """
+        return self.received_bps / 1000
+
+    @property
+    def reverse_kbps(self):
+        """Receiver throughput of the reverse direction in kbps, None if it's
+        not a bidirectional test.
+        """
+        if self.reverse_received_bps is None:
+            return None
+        return self.reverse_received_bps / 1000
+
+    def zero_intervals(self):
+        """Get the number of non omitted intervals without any throughput. """
+        return len([i for i in self.intervals if not i.omitted and i.bits_per_second == 0])
+
+    def to_dict(self):
+        """Convert to a JSON serializable dict. """
+        data = dict(self.__dict__)
+        data[u"intervals"] = [i.to_dict() for i in self.intervals]
+        data[u"reverse_intervals"] = [i.to_dict() for i in self.reverse_intervals]
+        return data
+
+    def __str__(self):
+        if self.reverse_kbps is None:
+            return f"{int(self.kbps)} Kbits/sec"
+        return f"{int(self.kbps)} Kbits/sec, reverse {int(self.reverse_kbps)} Kbits/sec"
+
+
+def _parse_intervals(intervals, key):
+    parsed = list()
+    for interval in intervals:
+        if key not in interval:
+            continue
+        parsed_interval = IperfInterval(interval[key])
+        cwnds = [s[u"snd_cwnd"] for s in interval.get(u"streams", list())
+                 if u"snd_cwnd" in s and s.get(u"sender", True)]
+        if cwnds:
+            parsed_interval.snd_cwnd = sum(cwnds)
+        parsed.append(parsed_interval)
+    return parsed
+
+def parse_iperf_json(output, proto=u"tcp"):
+    """Parse the JSON output of an iperf3 client.
+
+    :param output: Output of 'iperf3 -J'.
+    :param proto: Test protocol, 'tcp' or 'udp'.
+    :type output: str
+    :type proto: str
+    :returns: Parsed result, 'error' is set if iperf3 failed.
+    :rtype: IperfResult obj
+    """
+    result = IperfResult(proto)
+    try:
+        data = json.loads(output)
+    except ValueError:
+        result.error = f"Invalid iperf3 JSON output: {output[:200]}"
+        return result
+    if data.get(u"error"):
+        result.error = data[u"error"]
+
+    result.intervals = _parse_intervals(data.get(u"intervals", list()), u"sum")
+    result.reverse_intervals = _parse_intervals(data.get(u"intervals", list()),
+                                                u"sum_bidir_reverse")
+
+    end = data.get(u"end", dict())
+    sum_sent = end.get(u"sum_sent", dict())
+    sum_received = end.get(u"sum_received", dict())
+    udp_sum = end.get(u"sum", dict())
+    result.sent_bps = sum_sent.get(u"bits_per_second", udp_sum.get(u"bits_per_second", 0.0))
+    result.received_bps = sum_received.get(u"bits_per_second",
+                                           udp_sum.get(u"bits_per_second", 0.0))
+    result.retransmits = sum_sent.get(u"retransmits")
+    cwnds = [s[u"sender"][u"max_snd_cwnd"] for s in end.get(u"streams", list())
+             if u"max_snd_cwnd" in s.get(u"sender", dict())]
+    if cwnds:
+        result.max_snd_cwnd = max(cwnds)
+
+    cpu = end.get(u"cpu_utilization_percent", dict())
+    result.cpu_local = cpu.get(u"host_total")
+    result.cpu_remote = cpu.get(u"remote_total")
+
+    if proto == 'udp':
+        # Loss and jitter are measured by the receiver
+        udp_stats = sum_received if u"jitter_ms" in sum_received else udp_sum
+        result.jitter_ms = udp_stats.get(u"jitter_ms")
+        result.lost_packets = udp_stats.get(u"lost_packets")
+        result.packets = udp_stats.get(u"packets")
+        result.lost_percent = udp_stats.get(u"lost_percent")
+        if u"lost_packets" in udp_sum and u"bits_per_second" not in sum_received:
+            # Old iperf3 has no receiver sum for udp, derive it from the loss
+            result.received_bps = result.sent_bps * (1 - (result.lost_percent or 0) / 100)
+
+    if u"sum_received_bidir_reverse" in end:
+        result.reverse_sent_bps = end.get(u"sum_sent_bidir_reverse", dict()).get(
+            u"bits_per_second", 0.0)
+        result.reverse_received_bps = end[u"sum_received_bidir_reverse"].get(
+            u"bits_per_second", 0.0)
+    return result
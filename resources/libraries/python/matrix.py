@@ -0,0 +1,353 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cartesian performance matrix driven by a YAML spec, e.g.::
+
+    name: basic
+    repetitions: 3
+    warmup: 1
+    dimensions:
+      overlay: [normal, vlan, vxlan]
+      offload: [true, false]
+      qpair: [1]
+      mtu: [1500]
+      locality: [XHOST, NUMA]
+      proto: [tcp, TCP_RR]
+      flows: [1, 4]
+
+Cells are ordered by reconfiguration cost, i.e. the most expensive
+dimension changes least often, and as a reflected Gray code, so two
+consecutive cells differ in one dimension only. State is kept between
+cells and only changed dimensions are reconfigured.
+"""
+
+import csv
+import os
+
+from functools import partial
+
+from yaml import safe_load
+
+from robot.api import logger
+from robot.libraries.BuiltIn import BuiltIn, RobotNotRunningError
+
+from resources.libraries.python.netperf import NETPERF_RR_TESTS, NETPERF_STREAM_TESTS
+from resources.libraries.python.overlay import set_vif_vni_by_idx_on_vm, \
+                                               reset_vif_vni_on_all_suts, \
+                                               deploy_vni_as_tunnel_overlay, \
+                                               undeploy_vni_as_tunnel_overlay, \
+                                               deploy_vni_as_vlan_overlay, \
+                                               undeploy_vni_as_vlan_overlay, \
+                                               deploy_vni_as_qinq_overlay, \
+                                               undeploy_vni_as_qinq_overlay
+from resources.libraries.python.flowutils import setup_default_pipeline_on_all_suts
+from resources.libraries.python.pal import create_bridge_on_all_suts, \
+                                           delete_bridge_on_all_suts, \
+                                           add_vif_ports_on_all_suts, \
+                                           delete_vif_ports_on_all_suts, \
+                                           bump_uplink_mtu_on_all_suts, \
+                                           set_vm_mtu_on_all_suts, \
+                                           start_vms_on_all_suts, \
+                                           stop_vms_on_all_suts, \
+                                           verify_topology_get, \
+                                           verify_topology_select_pair
+from resources.libraries.python.timeline import traced
+from resources.libraries.python.topology import suts
+from resources.libraries.python.trial import run_trials
+
+__all__ = [
+    u"DIMENSIONS",
+    u"load_matrix_spec",
+    u"order_cells",
+    u"reconfiguration_cost",
+    u"execute_performance_matrix",
+]
+
+# Dimensions with their reconfiguration cost and default values, a pipeline
+# rebuild also restarts VMs as VIF ports move between bridges.
+DIMENSIONS = {
+    u"userspace_tso": (1000, None),
+    u"overlay": (100, [u"normal"]),
+    u"offload": (50, [True]),
+    u"qpair": (50, [1]),
+    u"mtu": (10, [1500]),
+    u"locality": (0, [u"XHOST"]),
+    u"proto": (0, [u"tcp"]),
+    u"family": (0, [u"ipv4"]),
+    u"flows": (0, [1]),
+}
+_VM_DIMENSIONS = (u"overlay", u"offload", u"qpair")
+
+_BR_UPLINK = u"br0"
+_BR_INT = u"br-int"
+_TUNNELS = (u"vxlan", u"geneve")
+_OVERLAYS = (u"normal", u"native", u"vlan", u"qinq") + _TUNNELS
+# Room for the outer headers of any overlay on uplinks
+_UPLINK_MTU_OVERHEAD = 100
+
+def load_matrix_spec(path):
+    """Load a matrix spec, dimensions which are not given get their
+    default values.
+
+    :param path: YAML file path.
+    :type path: str
+    :returns: Spec with 'name', 'repetitions', 'warmup', 'duration' and
+        'dimensions'.
+    :rtype: dict
+    """
+    with open(path) as spec_file:
+        spec = safe_load(spec_file.read())
+    dimensions = spec.get(u"dimensions") or dict()
+    unknown = set(dimensions) - set(DIMENSIONS)
+    if unknown:
+        raise RuntimeError(f"Unknown matrix dimensions: {', '.join(sorted(unknown))}")
+    for overlay in dimensions.get(u"overlay", list()):
+        if overlay not in _OVERLAYS:
+            raise RuntimeError(f"Unsupported overlay: {overlay}")
+
+    spec[u"dimensions"] = {name: list(dimensions[name]) if name in dimensions else default
+                           for name, (_, default) in DIMENSIONS.items()
+                           if name in dimensions or default is not None}
+    spec.setdefault(u"name", os.path.splitext(os.path.basename(path))[0])
+    spec.setdefault(u"repetitions", 1)
+    spec.setdefault(u"warmup", 0)
+    spec.setdefault(u"duration", 10)
+    return spec
+
+def order_cells(dimensions):
+    """Order all cells of dimensions, dimensions are nested by their cost,
+    and inner dimensions are walked forth and back alternately.
+
+    :param dimensions: Values by dimension name.
+    :type dimensions: dict
+    :returns: Cells, each is a value by dimension name.
+    :rtype: list(dict)
+    """
+    names = sorted(dimensions, key=lambda name: -DIMENSIONS[name][0])
+
+    def walk(names):
+        if not names:
+            return [dict()]
+        inner = walk(names[1:])
+        cells = list()
+        for idx, value in enumerate(dimensions[names[0]]):
+            for cell in inner if idx % 2 == 0 else reversed(inner):
+                cells.append(dict(cell, **{names[0]: value}))
+        return cells
+
+    return walk(names)
+
+def reconfiguration_cost(cells):
+    """Get the total reconfiguration cost of walking cells in order.
+
+    :param cells: Cells in order.
+    :type cells: list(dict)
+    :returns: Cost.
+    :rtype: int
+    """
+    cost = 0
+    prev = dict()
+    for cell in cells:
+        cost += max([DIMENSIONS[name][0] for name, value in cell.items()
+                     if prev.get(name) != value] + [0])
+        prev = cell
+    return cost
+
+def _cell_label(cell):
+    return u" ".join(f"{name}={cell[name]}" for name in DIMENSIONS if name in cell)
+
+def _deploy_overlay(overlay):
+    if overlay in _TUNNELS:
+        create_bridge_on_all_suts(_BR_INT)
+        add_vif_ports_on_all_suts(_BR_INT)
+        set_vif_vni_by_idx_on_vm()
+        deploy_vni_as_tunnel_overlay(_BR_INT, overlay)
+        return
+    add_vif_ports_on_all_suts(_BR_UPLINK)
+    if overlay == u"normal":
+        for sut in suts:
+            sut.vswitch.execute(f"ovs-ofctl del-flows {_BR_UPLINK}")
+            sut.vswitch.execute(f"ovs-ofctl add-flow {_BR_UPLINK} actions=NORMAL")
+    elif overlay == u"native":
+        setup_default_pipeline_on_all_suts(_BR_UPLINK)
+    elif overlay == u"vlan":
+        set_vif_vni_by_idx_on_vm()
+        deploy_vni_as_vlan_overlay(_BR_UPLINK)
+    else:
+        set_vif_vni_by_idx_on_vm()
+        deploy_vni_as_qinq_overlay(_BR_UPLINK)
+
+def _undeploy_overlay(overlay):
+    if overlay in _TUNNELS:
+        undeploy_vni_as_tunnel_overlay(_BR_INT)
+        reset_vif_vni_on_all_suts()
+        delete_bridge_on_all_suts(_BR_INT)
+        return
+    if overlay == u"vlan":
+        undeploy_vni_as_vlan_overlay(_BR_UPLINK)
+        reset_vif_vni_on_all_suts()
+    elif overlay == u"qinq":
+        undeploy_vni_as_qinq_overlay(_BR_UPLINK)
+        reset_vif_vni_on_all_suts()
+    delete_vif_ports_on_all_suts(_BR_UPLINK)
+
+
+class _MatrixState:
+    """Current state of VMs and the pipeline, it reconfigures changed
+    dimensions only.
+    """
+
+    def __init__(self):
+        self.cell = dict()
+        self.vms_running = False
+
+    def apply(self, cell):
+        """Reconfigure dimensions of a cell which differ from the current
+        state.
+
+        :param cell: Cell to apply.
+        :type cell: dict
+        """
+        changed = {name for name, value in cell.items() if self.cell.get(name) != value}
+        if changed & set(_VM_DIMENSIONS) or not self.vms_running:
+            if self.vms_running:
+                stop_vms_on_all_suts()
+                self.vms_running = False
+            if u"overlay" in changed:
+                if self.cell.get(u"overlay"):
+                    _undeploy_overlay(self.cell[u"overlay"])
+                    self.cell.pop(u"overlay")
+                _deploy_overlay(cell[u"overlay"])
+                self.cell[u"overlay"] = cell[u"overlay"]
+            for sut in suts:
+                for guest in sut.get_vms():
+                    for vif in guest.vifs:
+                        guest.reconfigure_vhost_user_if(vif, offload=bool(cell[u"offload"]),
+                                                        qpair=int(cell[u"qpair"]))
+            start_vms_on_all_suts()
+            self.vms_running = True
+            # MTU of guests is reset by the restart
+            changed.add(u"mtu")
+
+        if u"mtu" in changed:
+            bump_uplink_mtu_on_all_suts(int(cell[u"mtu"]) + _UPLINK_MTU_OVERHEAD)
+            set_vm_mtu_on_all_suts(int(cell[u"mtu"]))
+        self.cell = dict(cell)
+
+    def reset(self):
+        """Stop VMs, undeploy the overlay and restore VIFs' defaults. """
+        if self.vms_running:
+            stop_vms_on_all_suts()
+            self.vms_running = False
+        if self.cell.get(u"overlay"):
+            _undeploy_overlay(self.cell[u"overlay"])
+        for sut in suts:
+            for guest in sut.get_vms():
+                for vif in guest.vifs:
+                    guest.reconfigure_vhost_user_if(vif)
+        bump_uplink_mtu_on_all_suts(1500)
+        self.cell = dict()
+
+
+def _measure_cell(cell, trials, duration):
+    """Measure a cell, returns None if it's not applicable. """
+    try:
+        vt = verify_topology_select_pair(verify_topology_get(), cell[u"locality"])
+    except RuntimeError as err:
+        logger.warn(f"Skip {_cell_label(cell)}: {err}")
+        return None
+    sep = vt.allow[0].sep
+    dep = vt.allow[0].get_deps()[0]
+    server_ip = getattr(dep.vif.if_addr, cell[u"family"])
+    proto = cell[u"proto"]
+    flows = int(cell[u"flows"])
+    name = _cell_label(cell)
+
+    if proto in (u"tcp", u"udp"):
+        return trials(partial(sep.guest.execute_iperf, dep.guest, server_ip, proto=proto,
+                              parallel=flows, duration=duration),
+                      name, u"Kbits/sec", value=lambda r: r.kbps)
+    if proto in NETPERF_RR_TESTS + NETPERF_STREAM_TESTS:
+        if flows != 1:
+            # A netperf test is a single flow
+            return None
+        unit = (lambda r: r.throughput_units) if proto in NETPERF_STREAM_TESTS \
+            else u"Tran/sec"
+        return trials(partial(sep.guest.execute_netperf, dep.guest, server_ip, proto,
+                              duration),
+                      name, unit,
+                      value=lambda r: r.transaction_rate
+                      if r.transaction_rate is not None else r.throughput)
+    raise RuntimeError(f"Unsupported matrix proto: {proto}")
+
+def _write_table(spec, rows):
+    try:
+        out_dir = BuiltIn().get_variable_value(u"${OUTPUT DIR}", u".")
+    except RobotNotRunningError:
+        out_dir = u"."
+    path = os.path.join(out_dir, f"matrix_{spec[u'name']}.csv")
+    names = list(spec[u"dimensions"])
+    with open(path, u"w", newline=u"") as table:
+        writer = csv.writer(table)
+        writer.writerow(names + [u"median", u"mean", u"ci95", u"stddev", u"n", u"unit",
+                                 u"noisy"])
+        for cell, result in rows:
+            writer.writerow([cell[name] for name in names] +
+                            [result.median, result.mean, result.ci95, result.stddev,
+                             result.n, result.unit, result.noisy])
+    logger.info(f"Matrix table is written to {path}")
+
+@traced("matrix")
+def execute_performance_matrix(spec_path):
+    """Run all cells of a performance matrix spec in the order of least
+    reconfiguration, and write one table of results, i.e.
+    'matrix_<name>.csv' in robot output dir.
+
+    The uplink bridge 'br0' must exist, and VMs must not be running, they
+    are stopped and VIFs are restored when the matrix finishes. Cells
+    whose userspace_tso differs from a SUT's setting, whose locality has
+    no pair, or netperf cells with more than one flow are skipped.
+
+    :param spec_path: YAML spec path.
+    :type spec_path: str
+    :returns: Measurement of each cell.
+    :rtype: list(Measurement)
+    """
+    spec = load_matrix_spec(spec_path)
+    cells = order_cells(spec[u"dimensions"])
+    logger.info(f"Matrix {spec[u'name']}: {len(cells)} cells, reconfiguration cost "
+                f"{reconfiguration_cost(cells)}")
+    trials = partial(run_trials, repetitions=int(spec[u"repetitions"]),
+                     warmup=int(spec[u"warmup"]))
+
+    state = _MatrixState()
+    rows = list()
+    try:
+        for cell in cells:
+            tso = cell.pop(u"userspace_tso", None)
+            if tso is not None and any(bool(sut.userspace_tso) != bool(tso) for sut in suts):
+                logger.warn(f"Skip {_cell_label(cell)}: needs userspace_tso={tso} "
+                            f"in the topology file")
+                continue
+            state.apply(cell)
+            result = _measure_cell(cell, trials, int(spec[u"duration"]))
+            if result is not None:
+                logger.info(str(result))
+                rows.append((cell, result))
+    finally:
+        state.reset()
+
+    spec[u"dimensions"].pop(u"userspace_tso", None)
+    _write_table(spec, rows)
+    return [result for _, result in rows]
@@ -73,7 +73,7 @@ _NAT_ROUTER_SIF_IPV6 = _NAT_SERVER_NETV6[1]
 def _configure_vm(vm, vif, ipv4_routes, ipv6_routes,
                   ipv4_neighs, ipv6_neighs):
 
-    dev = f"virtio{vif.idx}"
+    dev = vm.vif_dev_name(vif)
     ipv4_str = vif.if_addr.ipv4_str_with_prefix()
     ipv6_str = vif.if_addr.ipv6_str_with_prefix()
 
@@ -524,15 +524,15 @@ def _nat_execute_related(nat_spec, sep, dep, ip_ver, direction):
 
     if direction == 'orig':
         tcpdump_vm = server_vm
-        tcpdump_if = f"virtio{dep.vif.idx}"
+        tcpdump_if = server_vm.vif_dev_name(dep.vif)
         iptables_vm = client_vm
-        iptables_if = f"virtio{sep.vif.idx}"
+        iptables_if = client_vm.vif_dev_name(sep.vif)
         reject_ip = client_ip
     else:
         tcpdump_vm = client_vm
-        tcpdump_if = f"virtio{sep.vif.idx}"
+        tcpdump_if = client_vm.vif_dev_name(sep.vif)
         iptables_vm = server_vm
-        iptables_if = f"virtio{dep.vif.idx}"
+        iptables_if = server_vm.vif_dev_name(dep.vif)
         reject_ip = server_ip
 
     tcpdump_vm.execute('rm -rf ./cap')
@@ -0,0 +1,97 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Network namespace based lightweight endpoints."""
+
+from shlex import quote
+from time import time
+
+from robot.api import logger
+
+from resources.libraries.python.guest import Guest
+
+__all__ = [
+    u"NetnsEndpoint",
+]
+
+class NetnsEndpoint(Guest):
+    """An endpoint implemented by a Linux network namespace on a SUT.
+
+    All commands are executed on the host through 'ip netns exec',
+    so an endpoint doesn't need any boot or its own SSH server.
+    'ip netns exec' requires root privilege, so commands must be
+    executed with sudo, which is the default of execute().
+    Note tftp/ftp servers are not available in netns endpoints.
+    """
+
+    def __init__(self, name, host_ssh_info, numa_id=0):
+        super().__init__(name)
+        self.netns = name
+        self.numa_id = numa_id
+        self.active = False
+        self._host_ssh_info = host_ssh_info
+        # Commands are executed on the host, wrapped into the namespace
+        self._ssh_info = host_ssh_info
+
+    def _guest_cmd(self, cmd):
+        """Wrap a command to be executed inside the namespace.
+
+        :param cmd: Command to be executed.
+        :type cmd: str
+        :returns: Command executed by the host.
+        :rtype: str
+        """
+        return f"ip netns exec {self.netns} sh -c {quote(cmd)}"
+
+    def vif_dev_name(self, vif):
+        """Get the device name of a VIF inside the namespace.
+
+        :param vif: Virtual interface.
+        :type vif: VethInterface obj
+        :returns: Device name.
+        :rtype: str
+        """
+        return vif.dev_name
+
+    def kill_process(self, proc_name):
+        """Kill processes matched by name in the namespace.
+
+        :param proc_name: Process name to be killed.
+        :type proc_name: str
+        """
+        self.execute_host(f"sh -c 'for p in $(ip netns pids {self.netns}); do "
+                          f"grep -qa {proc_name} /proc/$p/cmdline 2>/dev/null "
+                          f"&& kill -9 $p; done; true'")
+
+    def create(self):
+        """Create the network namespace, stale one is removed firstly. """
+        self.execute_host(f"ip netns del {self.netns}", exp_fail=None)
+        self.execute_host(f"ip netns add {self.netns}")
+
+    def start(self):
+        """Configure the endpoint's network after its interfaces are attached.
+        """
+        start = time()
+        cmds = ["ip link set lo up"]
+        for vif in self.vifs:
+            cmds.append(f"ip link set dev {vif.dev_name} address {vif.mac}")
+        self.execute_batch(cmds)
+        self.configure()
+        self.active = True
+        logger.trace(f"netns endpoint {self.name} started in {time() - start} seconds")
+
+    def stop(self):
+        """Destroy the network namespace. """
+        self.execute_host(f"ip netns del {self.netns}", exp_fail=None)
+        self.active = False
@@ -0,0 +1,148 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library for building netperf omni commands and parsing their output."""
+
+__all__ = [
+    u"NETPERF_RR_TESTS",
+    u"NETPERF_STREAM_TESTS",
+    u"NetperfResult",
+    u"netperf_client_cmd",
+    u"parse_netperf_output",
+]
+
+NETPERF_RR_TESTS = (u"TCP_RR", u"TCP_CRR", u"UDP_RR")
+NETPERF_STREAM_TESTS = (u"TCP_STREAM", u"TCP_MAERTS")
+
+_STREAM_SELECTORS = (u"THROUGHPUT", u"THROUGHPUT_UNITS", u"LOCAL_CPU_UTIL",
+                     u"REMOTE_CPU_UTIL")
+_RR_SELECTORS = _STREAM_SELECTORS + (u"TRANSACTION_RATE", u"MEAN_LATENCY", u"MIN_LATENCY",
+                                     u"MAX_LATENCY", u"P50_LATENCY", u"P90_LATENCY",
+                                     u"P99_LATENCY", u"STDDEV_LATENCY")
+
+def netperf_client_cmd(server_ip, testname=u"TCP_RR", duration=10, req_size=0,
+                       resp_size=0, burst=0, send_size=0):
+    """Build a netperf command with omni output selectors.
+
+    :param server_ip: Server address.
+    :param testname: Test type, one of NETPERF_RR_TESTS or NETPERF_STREAM_TESTS.
+    :param duration: Test duration in seconds.
+    :param req_size: Request size in bytes of RR tests, 0 is netperf default.
+    :param resp_size: Response size in bytes of RR tests, 0 is netperf default.
+    :param burst: Number of transactions in flight of RR tests, it requires
+        netperf built with '--enable-burst', 0 means no burst.
+    :param send_size: Send size in bytes of stream tests, 0 is netperf default.
+    :type server_ip: IPv4Address or IPv6Address obj
+    :type testname: str
+    :type duration: int
+    :type req_size: int
+    :type resp_size: int
+    :type burst: int
+    :type send_size: int
+    :returns: Command.
+    :rtype: str
+    """
+    if testname in NETPERF_RR_TESTS:
+        selectors = _RR_SELECTORS
+    elif testname in NETPERF_STREAM_TESTS:
+        selectors = _STREAM_SELECTORS
+    else:
+        raise RuntimeError(f"Unsupported netperf test: {testname}")
+
+    # '-j' keeps the timing statistics for min/max/percentile latency
+    options = [f"netperf -H {server_ip} -l {duration} -t {testname} -j --",
+               f"-k {','.join(selectors)}"]
+    if testname in NETPERF_RR_TESTS:
+        if req_size or resp_size:
+            options.append(f"-r {req_size or 1},{resp_size or 1}")
+        if burst:
+            options.append(f"-b {burst}")
+    elif send_size:
+        options.append(f"-m {send_size}")
+    return u" ".join(options)
+
+
+class NetperfResult:
+    """Structured result of a netperf omni test, latency is in usec. """
+
+    def __init__(self, testname=u"TCP_RR"):
+        self.testname = testname
+        self.error = None
+        self.throughput = 0.0
+        self.throughput_units = u""
+        self.transaction_rate = None
+        self.mean_latency = None
+        self.min_latency = None
+        self.max_latency = None
+        self.p50_latency = None
+        self.p90_latency = None
+        self.p99_latency = None
+        self.stddev_latency = None
+        self.local_cpu_util = None
+        self.remote_cpu_util = None
+
+    @property
+    def is_rr(self):
+        """If it's a request/response test. """
+        return self.testname in NETPERF_RR_TESTS
+
+    def to_dict(self):
+        """Convert to a JSON serializable dict. """
+        return dict(self.__dict__)
+
+    def __str__(self):
+        if not self.is_rr:
+            return f"{self.throughput:.2f} {self.throughput_units}"
+        rate = self.transaction_rate if self.transaction_rate is not None else self.throughput
+        latency = [f"{name} {getattr(self, f'{name}_latency'):.1f}"
+                   for name in (u"mean", u"p50", u"p90", u"p99")
+                   if getattr(self, f"{name}_latency") is not None]
+        if not latency:
+            return f"{rate:.2f} Tran/sec"
+        return f"{rate:.2f} Tran/sec, latency usec {' '.join(latency)}"
+
+
+def parse_netperf_output(output, testname=u"TCP_RR"):
+    """Parse the output of netperf with '-k' output selectors.
+
+    :param output: netperf output of KEY=VALUE lines.
+    :param testname: Test type.
+    :type output: str
+    :type testname: str
+    :returns: Parsed result, 'error' is set if no throughput is found.
+    :rtype: NetperfResult obj
+    """
+    result = NetperfResult(testname)
+    values = dict()
+    for line in output.splitlines():
+        key, sep, value = line.strip().partition(u"=")
+        if sep:
+            values[key] = value
+
+    if u"THROUGHPUT" not in values:
+        result.error = f"{testname} doesn't have valid result: {output[:200]}"
+        return result
+
+    for selector in _RR_SELECTORS:
+        if selector not in values:
+            continue
+        attr = selector.lower()
+        if selector == u"THROUGHPUT_UNITS":
+            setattr(result, attr, values[selector])
+            continue
+        try:
+            setattr(result, attr, float(values[selector]))
+        except ValueError:
+            pass
+    return result
@@ -0,0 +1,45 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Paths of reports written into robot output directory."""
+
+import os
+import re
+
+from robot.libraries.BuiltIn import BuiltIn, RobotNotRunningError
+
+__all__ = [
+    u"output_path",
+]
+
+def output_path(prefix, name=None, suffix=u".json"):
+    """Get the path of a report in robot output directory, which is named
+    by the test name by default, or "run" if robot isn't running.
+
+    :param prefix: Prefix of the report file name, e.g. 'xstats'.
+    :param name: Name of the report, the test name by default.
+    :param suffix: Suffix of the report file name.
+    :type prefix: str
+    :type name: str
+    :type suffix: str
+    :returns: Report path.
+    :rtype: str
+    """
+    try:
+        out_dir = BuiltIn().get_variable_value(u"${OUTPUT DIR}", u".")
+        name = name or BuiltIn().get_variable_value(u"${TEST NAME}", u"")
+    except RobotNotRunningError:
+        out_dir = u"."
+    name = re.sub(r"[^\w.-]+", u"_", name or u"run").strip(u"_")
+    return os.path.join(out_dir, f"{prefix}_{name}{suffix}")
@@ -14,8 +14,21 @@
 
 """Defines keywords for robot tests, PAL stands for Python Adaption Layer."""
 
+import json
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 from robot.api import logger
+from resources.libraries.python.hostsampler import HostSampler, traffic_log, \
+    write_host_sampling_report
+from resources.libraries.python.netperf import NETPERF_RR_TESTS
+from resources.libraries.python.output import output_path
+from resources.libraries.python.telemetry import diff_xstats, drop_counters, queue_packets
+from resources.libraries.python.timeline import traced
 from resources.libraries.python.topology import suts
+from resources.libraries.python.trial import run_trials
 
 __all__ = [
     u"create_bridge_on_all_suts",
@@ -31,6 +44,14 @@ __all__ = [
     u"start_vms_on_all_suts",
     u"stop_vms_on_all_suts",
     u"set_vm_mtu_on_all_suts",
+    u"start_host_sampling_on_all_suts",
+    u"stop_host_sampling_on_all_suts",
+    u"take_xstats_snapshot_on_all_suts",
+    u"get_xstats_drops_on_all_suts",
+    u"add_netns_ports_on_all_suts",
+    u"delete_netns_ports_on_all_suts",
+    u"start_netns_endpoints_on_all_suts",
+    u"stop_netns_endpoints_on_all_suts",
     u"verify_topology_get",
     u"verify_topology_allow_originate",
     u"verify_topology_select_pair",
@@ -38,12 +59,15 @@ __all__ = [
     u"verify_topology_change_deny_to_allow",
     u"execute_ping_verification",
     u"execute_iperf_verification",
+    u"execute_stress_test",
     u"execute_performance_test",
+    u"execute_netperf_test",
     u"VerifyTopology",
     u"VerifyTopologyEntry",
     u"EndPoint",
 ]
 
+@traced("pal")
 def create_bridge_on_all_suts(br_name):
     """Create bridges on all SUTS.
     :param br_name: Bridge name.
@@ -52,6 +76,7 @@ def create_bridge_on_all_suts(br_name):
     for sut in suts:
         sut.vswitch.create_bridge(br_name)
 
+@traced("pal")
 def delete_bridge_on_all_suts(br_name):
     """Delete bridges on all SUTS.
     :param br_name: Bridge name.
@@ -60,6 +85,7 @@ def delete_bridge_on_all_suts(br_name):
     for sut in suts:
         sut.vswitch.delete_bridge(br_name)
 
+@traced("pal")
 def setup_uplink_bridge_on_all_suts(br_name, bond=False):
     """Create uplink bridges on all SUTS.
     :param br_name: Bridge name.
@@ -70,6 +96,7 @@ def setup_uplink_bridge_on_all_suts(br_name, bond=False):
     for sut in suts:
         sut.vswitch.create_uplink_bridge(br_name, bond)
 
+@traced("pal")
 def teardown_uplink_bridge_on_all_suts(br_name):
     """Delete uplink bridges on all SUTS.
     :param br_name: Bridge name.
@@ -78,6 +105,7 @@ def teardown_uplink_bridge_on_all_suts(br_name):
     for sut in suts:
         sut.vswitch.delete_uplink_bridge(br_name)
 
+@traced("pal")
 def bump_uplink_mtu_on_all_suts(mtu):
     """Set uplink MTU on all SUTS.
     :param mtu: Requested MTU.
@@ -86,17 +114,20 @@ def bump_uplink_mtu_on_all_suts(mtu):
     for sut in suts:
         sut.vswitch.set_uplink_mtu(mtu)
 
+@traced("pal")
 def flush_revalidator_on_all_suts():
     """Flush vswitch revalidator on all SUTS. """
     for sut in suts:
         sut.vswitch.execute("ovs-appctl revalidator/purge")
 
+@traced("pal")
 def flush_conntrack_on_all_suts():
     """Flush all datapath conntrack states on all duts. """
     for sut in suts:
         sut.vswitch.execute("ovs-appctl dpctl/flush-conntrack")
         sut.vswitch.execute("ovs-appctl dpctl/dump-conntrack -m")
 
+@traced("pal")
 def set_port_vlan_on_all_suts(port_name, vlan_id):
     """Set ports' VLAN on all SUTS.
     :param port_name: Ports' name.
@@ -107,6 +138,7 @@ def set_port_vlan_on_all_suts(port_name, vlan_id):
     for sut in suts:
         sut.vswitch.set_port_vlan(port_name, vlan_id)
 
+@traced("pal")
 def add_vif_ports_on_all_suts(br_name):
     """Attach VM's VIFs to bridges on all SUTS.
     :param br_name: Name of bridges to attach.
@@ -117,6 +149,7 @@ def add_vif_ports_on_all_suts(br_name):
             for vif in vm.vifs:
                 sut.vswitch.create_vhost_user_interface(br_name, vif)
 
+@traced("pal")
 def delete_vif_ports_on_all_suts(br_name):
     """Dettach VM's VIFs from bridges on all SUTS.
     :param br_name: Name of bridges to dettach.
@@ -127,18 +160,21 @@ def delete_vif_ports_on_all_suts(br_name):
             for vif in vm.vifs:
                 sut.vswitch.delete_interface(br_name, vif.name)
 
+@traced("pal")
 def start_vms_on_all_suts():
     """Poweron VMs on all SUTS. """
     for sut in suts:
         for vm in sut.get_vms():
             vm.qemu_start()
 
+@traced("pal")
 def stop_vms_on_all_suts():
     """Poweroff VMs on all SUTS. """
     for sut in suts:
         for vm in sut.get_vms():
             vm.qemu_guest_poweroff()
 
+@traced("pal")
 def set_vm_mtu_on_all_suts(mtu):
     """Configure VM's interface MTU on all SUTS.
     :param mtu: Requested MTU.
@@ -148,6 +184,139 @@ def set_vm_mtu_on_all_suts(mtu):
         for vm in sut.get_vms():
             vm.configure_mtu(mtu)
 
+_host_samplers = list()
+
+@traced("pal")
+def start_host_sampling_on_all_suts(interval=1, max_duration=3600):
+    """Start a host resource sampler on all SUTS, and record intervals of
+    iperf/netperf runs until sampling is stopped.
+    :param interval: Sampling interval in seconds.
+    :param max_duration: Seconds after which a left behind sampler is killed.
+    :type interval: float
+    :type max_duration: int
+    """
+    stop_host_sampling_on_all_suts(report=False)
+    for sut in suts:
+        sampler = HostSampler(sut.ssh_info, sut.name, sut.vswitch.host_sampling_cmds(),
+                              float(interval), int(max_duration))
+        sampler.start()
+        _host_samplers.append(sampler)
+    traffic_log.start()
+
+@traced("pal")
+def stop_host_sampling_on_all_suts(name=None, report=True):
+    """Stop host resource samplers on all SUTS, and write samples with
+    traffic intervals joined with host metrics into
+    'hostsamples_<name>.json' in robot output directory.
+    :param name: Report name, default is the test name.
+    :param report: Write the report or only stop samplers.
+    :type name: str
+    :type report: bool
+    :returns: Summary of host metrics of each SUT, they are printed as
+        result lines.
+    :rtype: list(str)
+    """
+    traffic = traffic_log.stop()
+    for sampler in _host_samplers:
+        sampler.stop()
+    samples = {sampler.name: sampler.samples() for sampler in _host_samplers}
+    _host_samplers.clear()
+    if not report:
+        return list()
+
+    return write_host_sampling_report(output_path(u"hostsamples", name), samples, traffic)
+
+_xstats_snapshots = dict()
+
+@traced("pal")
+def take_xstats_snapshot_on_all_suts():
+    """Take a snapshot of OVS interface statistics and DPDK xstats on all
+    SUTS, the next Get Xstats Drops on All SUTs diffs against it.
+    """
+    _xstats_snapshots.clear()
+    for sut in suts:
+        _xstats_snapshots[sut.name] = sut.vswitch.get_xstats()
+
+@traced("pal")
+def get_xstats_drops_on_all_suts(top_n=10, name=None):
+    """Diff OVS interface statistics and DPDK xstats on all SUTS against
+    the last snapshot, and write the diff into 'xstats_<name>.json' in
+    robot output directory.
+    :param top_n: Number of the largest drop counters in results.
+    :param name: Report name, default is the test name.
+    :type top_n: int
+    :type name: str
+    :returns: The largest drop counters, per queue packets of uplinks and
+        mempool usage, they are printed as result lines.
+    :rtype: list(str)
+    """
+    deltas = dict()
+    for sut in suts:
+        if sut.name not in _xstats_snapshots:
+            raise RuntimeError(f"No xstats snapshot of {sut.name} is taken.")
+        deltas[sut.name] = diff_xstats(_xstats_snapshots[sut.name], sut.vswitch.get_xstats())
+    path = output_path(u"xstats", name)
+    with open(path, u"w") as report:
+        json.dump(deltas, report, indent=2)
+    logger.info(f"Xstats diff is written to {path}")
+
+    results = list()
+    drops = sorted(((sut_name, dev, key, value) for sut_name, delta in deltas.items()
+                    for dev, key, value in drop_counters(delta)),
+                   key=lambda d: d[3], reverse=True)
+    for sut_name, dev, key, value in drops[:int(top_n)]:
+        results.append(f"{sut_name} {dev} {key}: {value} packets")
+    if not drops:
+        logger.info(u"No drop counter increased")
+    for sut_name, delta in deltas.items():
+        for dev, counters in delta[u"ethdev"].items():
+            queues = queue_packets(counters)
+            if queues:
+                logger.info(f"{sut_name} {dev} queue packets: " + u", ".join(
+                    f"{direction} q{queue} {value}"
+                    for (direction, queue), value in sorted(queues.items())))
+        for pool, usage in delta[u"mempool"].items():
+            results.append(f"{sut_name} mempool {pool} in use: {usage[u'in_use']} "
+                           f"mbufs of {usage[u'size']}")
+    return results
+
+@traced("pal")
+def add_netns_ports_on_all_suts(br_name):
+    """Create netns endpoints and attach their VIFs to bridges on all SUTS.
+    :param br_name: Name of bridges to attach.
+    :type br_name: str
+    """
+    for sut in suts:
+        for endpoint in sut.get_netns_endpoints():
+            endpoint.create()
+            for vif in endpoint.vifs:
+                sut.vswitch.create_netns_interface(br_name, vif)
+
+@traced("pal")
+def delete_netns_ports_on_all_suts(br_name):
+    """Dettach netns endpoints' VIFs from bridges on all SUTS.
+    :param br_name: Name of bridges to dettach.
+    :type br_name: str
+    """
+    for sut in suts:
+        for endpoint in sut.get_netns_endpoints():
+            for vif in endpoint.vifs:
+                sut.vswitch.delete_netns_interface(br_name, vif)
+
+@traced("pal")
+def start_netns_endpoints_on_all_suts():
+    """Configure netns endpoints on all SUTS. """
+    for sut in suts:
+        for endpoint in sut.get_netns_endpoints():
+            endpoint.start()
+
+@traced("pal")
+def stop_netns_endpoints_on_all_suts():
+    """Destroy netns endpoints on all SUTS. """
+    for sut in suts:
+        for endpoint in sut.get_netns_endpoints():
+            endpoint.stop()
+
 class Locality:
     """Contains locality definitions."""
     UNDEF = 0
@@ -241,17 +410,19 @@ def _get_vte(vte_list, sep):
     vte_list.append(vte)
     return vte
 
-def verify_topology_get(tc=TopologyCriteria()):
+def verify_topology_get(tc=TopologyCriteria(), guest_type='vm'):
     """Get a typical topology for verification.
     :param tc: Criterias for verification.
+    :param guest_type: Type of guests as endpoints, 'vm', 'netns' or 'all'.
     :type tc: TopologyCriteria obj
+    :type guest_type: str
     """
     vt = VerifyTopology()
 
     # Select source EndPoint on the first sut
     sep = None
     sut = suts[0]
-    for vm in sut.get_vms():
+    for vm in sut.get_guests(guest_type):
         if ((tc.sepc.pnic_loc == Locality.NUMA
              and vm.numa_id != sut.pnic.numa_id)
                 or (tc.sepc.pnic_loc == Locality.XNUMA
@@ -274,7 +445,7 @@ def verify_topology_get(tc=TopologyCriteria()):
                     and sut != sep.host)):
             continue
 
-        for vm in sut.get_vms():
+        for vm in sut.get_guests(guest_type):
             if ((tc.locc == Locality.NUMA and vm.numa_id != sep.guest.numa_id)
                     or (tc.locc == Locality.XNUMA
                         and vm.numa_id == sep.guest.numa_id)):
@@ -407,16 +578,105 @@ def verify_topology_change_deny_to_allow(vt):
     vt.deny = list()
     logger.debug(f"Verify topology after change allow to deny.\n{vt}")
 
-def execute_ping_verification(vt):
+# Default port of iperf3 server
+_IPERF_PORT = 5201
+
+def _verify_deny_by_probes(vt, proto, deadline=0.5):
+    """Verify all deny entries are blocked by reachability probes, probes
+    of each source guest are run by one command, and all source guests
+    are probed at the same time.
+    """
+    probes = dict()
+    for vte in vt.deny:
+        for dep in vte.get_deps():
+            for addr in (dep.vif.if_addr.ipv4, dep.vif.if_addr.ipv6):
+                probes.setdefault(vte.sep.guest, list()).append((proto, addr, _IPERF_PORT))
+    if not probes:
+        return
+
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        futures = {svm: executor.submit(svm.probe_reachability, svm_probes, deadline)
+                   for svm, svm_probes in probes.items()}
+    for svm, future in futures.items():
+        for (_, addr, _), reachable in zip(probes[svm], future.result()):
+            if reachable:
+                logger.error(f"{proto} from {svm.name} to {addr} should be blocked")
+
+def _allow_pairs(vt, full=False):
+    return [(vte.sep, dep) for vte in vt.allow
+            for dep in (vte.get_full_deps() if full else vte.get_deps())]
+
+def _schedule_rounds(pairs):
+    """Group pairs into rounds, pairs in the same round share no guest,
+    so they can run at the same time without interfering each other.
+    """
+    rounds = list()
+    busy = list()
+    for idx, (sep, dep) in enumerate(pairs):
+        guests = {sep.guest, dep.guest}
+        for rnd, rnd_guests in zip(rounds, busy):
+            if not guests & rnd_guests:
+                rnd.append(idx)
+                rnd_guests |= guests
+                break
+        else:
+            rounds.append([idx])
+            busy.append(guests)
+    return rounds
+
+def _run_pairs(pairs, task, concurrent):
+    """Run a task of each pair, either one by one or round by round,
+    returns task results in the same order as pairs.
+
+    Note robot ignores logs of non-main threads, so concurrent tasks
+    must return their failures to be logged by the caller.
+    """
+    if not concurrent:
+        return [task(sep, dep) for sep, dep in pairs]
+
+    results = dict()
+    for rnd in _schedule_rounds(pairs):
+        with ThreadPoolExecutor(max_workers=len(rnd)) as executor:
+            futures = {idx: executor.submit(task, *pairs[idx]) for idx in rnd}
+        for idx, future in futures.items():
+            results[idx] = future.result()
+    return [results[idx] for idx in range(len(pairs))]
+
+def _kbps(result):
+    match = re.search(r"(\d+) Kbits/sec", str(result))
+    return int(match.group(1)) if match else 0
+
+def _ping_pair(sep, dep):
+    svm = sep.guest
+    ipv4_ok = svm.ping_ipv4_addr(dep.vif.if_addr.ipv4)
+    ipv6_ok = svm.ping_ipv6_addr(dep.vif.if_addr.ipv6)
+    return ipv4_ok and ipv6_ok
+
+def _iperf_pair(sep, dep, proto, parallel):
+    svm = sep.guest
+    return [svm.execute_iperf_ipv4(dep.guest, dep.vif.if_addr.ipv4,
+                                   proto=proto, parallel=parallel),
+            svm.execute_iperf_ipv6(dep.guest, dep.vif.if_addr.ipv6,
+                                   proto=proto, parallel=parallel)]
+
+@traced("pal")
+def execute_ping_verification(vt, fast_deny=False, concurrent=False):
     """Given an input verify topology, execute ping tests.
     :param vt: Input verify topology.
+    :param fast_deny: Verify deny entries by fast icmp probes.
+    :param concurrent: Verify allow pairs sharing no guest at the same time.
     :type vt: VerifyTopology obj
+    :type fast_deny: bool
+    :type concurrent: bool
     """
-    for vte in vt.allow:
-        svm = vte.sep.guest
-        for dep in vte.get_deps():
-            svm.ping_ipv4_addr(dep.vif.if_addr.ipv4)
-            svm.ping_ipv6_addr(dep.vif.if_addr.ipv6)
+    pairs = _allow_pairs(vt)
+    for (sep, dep), succ in zip(pairs, _run_pairs(pairs, _ping_pair, concurrent)):
+        if concurrent and not succ:
+            logger.error(f"ping from {sep} to {dep} failed")
+
+    if fast_deny:
+        _verify_deny_by_probes(vt, 'icmp')
+        return
 
     for vte in vt.deny:
         svm = vte.sep.guest
@@ -424,23 +684,46 @@ def execute_ping_verification(vt):
             svm.ping_ipv4_addr(dep.vif.if_addr.ipv4, exp_fail=True)
             svm.ping_ipv6_addr(dep.vif.if_addr.ipv6, exp_fail=True)
 
-def execute_iperf_verification(vt, proto='tcp', parallel=1):
+@traced("pal")
+def execute_iperf_verification(vt, proto='tcp', parallel=1, fast_deny=False,
+                               concurrent=False):
     """Given an input verify topology, execute iperf tests.
     :param vt: Input verify topology.
+    :param fast_deny: Verify deny entries by fast probes of the protocol,
+        tcp probes to iperf servers, or udp probes to udp echo servers
+        which require python3 in guests.
+    :param concurrent: Verify allow pairs sharing no guest at the same time.
     :type vt: VerifyTopology obj
+    :type fast_deny: bool
+    :type concurrent: bool
     :returns: Test results.
     :rtype: str
     """
     results = list()
-    for vte in vt.allow:
-        svm = vte.sep.guest
-        for dep in vte.get_deps():
-            result = svm.execute_iperf_ipv4(dep.guest, dep.vif.if_addr.ipv4,
-                                            proto=proto, parallel=parallel)
-            results.append(result)
-            result = svm.execute_iperf_ipv6(dep.guest, dep.vif.if_addr.ipv6,
-                                            proto=proto, parallel=parallel)
-            results.append(result)
+    pairs = _allow_pairs(vt)
+    task = partial(_iperf_pair, proto=proto, parallel=parallel)
+    for (sep, dep), pair_results in zip(pairs, _run_pairs(pairs, task, concurrent)):
+        for result in pair_results:
+            if concurrent and not _kbps(result):
+                logger.error(f"iperf from {sep} to {dep} failed: {result}")
+        results += pair_results
+
+    if fast_deny:
+        servers = {dep.guest for vte in vt.deny for dep in vte.get_deps()}
+        for server in servers:
+            if proto == 'udp':
+                server.start_udp_echo_server(port=_IPERF_PORT)
+            else:
+                server.start_iperf_server(port=_IPERF_PORT)
+        try:
+            _verify_deny_by_probes(vt, proto)
+        finally:
+            for server in servers:
+                if proto == 'udp':
+                    server.stop_udp_echo_server()
+                else:
+                    server.stop_iperf_server()
+        return results
 
     for vte in vt.deny:
         svm = vte.sep.guest
@@ -452,29 +735,132 @@ def execute_iperf_verification(vt, proto='tcp', parallel=1):
 
     return results
 
-def execute_performance_test(vt):
+@traced("pal")
+def execute_stress_test(vt, proto='tcp', parallel=1):
+    """Given an input verify topology, run iperf of all allow pairs at the
+    same time to measure aggregate throughput of the switch. Each pair has
+    its own iperf server port, so a guest can serve several pairs.
+    :param vt: Input verify topology.
+    :param proto: Test protocol.
+    :param parallel: Number of concurrent streams of each pair.
+    :type vt: VerifyTopology obj
+    :type proto: str
+    :type parallel: int
+    :returns: Throughput of each pair and the aggregate throughput.
+    :rtype: list(str)
+    """
+    pairs = _allow_pairs(vt, full=True)
+    if not pairs:
+        raise RuntimeError("No allowed entry is found.")
+
+    results = list()
+    for family in ['ipv4', 'ipv6']:
+        for idx, (_, dep) in enumerate(pairs):
+            dep.guest.start_iperf_server(ipv4=family == 'ipv4', port=_IPERF_PORT + idx)
+        try:
+            with ThreadPoolExecutor(max_workers=len(pairs)) as executor:
+                futures = [executor.submit(sep.guest.run_iperf_client,
+                                           getattr(dep.vif.if_addr, family),
+                                           proto=proto, parallel=parallel,
+                                           port=_IPERF_PORT + idx)
+                           for idx, (sep, dep) in enumerate(pairs)]
+            rates = [future.result() for future in futures]
+        finally:
+            for server in {dep.guest for _, dep in pairs}:
+                server.stop_iperf_server()
+
+        total = 0
+        for (sep, dep), rate in zip(pairs, rates):
+            if not _kbps(rate):
+                logger.error(f"iperf from {sep} to {dep} failed: {rate}")
+            total += _kbps(rate)
+            results.append(f"{sep.guest.name} -> {dep.guest.name} {proto} {family} "
+                           f"throughput: {rate}")
+        results.append(f"{proto} {family} aggregate throughput of {len(pairs)} pairs: "
+                       f"{total} Kbits/sec")
+    return results
+
+def _netperf_rate(result):
+    return result.transaction_rate if result.transaction_rate is not None else result.throughput
+
+@traced("pal")
+def execute_performance_test(vt, netperf_tests=('TCP_RR', 'TCP_CRR'), repetitions=1, warmup=0,
+                             ci_target=0.05):
     """Given an input verify topology, execute performance tests.
+    Each measurement is repeated until its 95% confidence interval is within
+    ci_target of the mean or it's measured 'repetitions' times.
     :param vt: Input verify topology.
+    :param netperf_tests: Netperf test types, TCP_CRR shows connection setup
+        rate through conntrack.
+    :param repetitions: Maximal number of trials of each measurement.
+    :param warmup: Number of discarded trials before each measurement.
+    :param ci_target: Relative half width of the 95% CI to stop at.
     :type vt: VerifyTopology obj
+    :type netperf_tests: list(str)
+    :type repetitions: int
+    :type warmup: int
+    :type ci_target: float
+    :returns: Test results, they are printed as result lines.
+    :rtype: list(Measurement)
+    """
+    trials = partial(run_trials, repetitions=int(repetitions), warmup=int(warmup),
+                     ci_target=float(ci_target))
+    results = list()
+    for vte in vt.allow:
+        svm = vte.sep.guest
+        for dep in vte.get_deps():
+            # iperf udp test is misleading, so only tcp is measured.
+            for family in ['ipv4', 'ipv6']:
+                server_ip = getattr(dep.vif.if_addr, family)
+                results.append(trials(partial(svm.execute_iperf, dep.guest, server_ip),
+                                      f"tcp {family} throughput", u"Kbits/sec",
+                                      value=lambda r: r.kbps))
+            for testname in netperf_tests:
+                for family in ['ipv4', 'ipv6']:
+                    server_ip = getattr(dep.vif.if_addr, family)
+                    unit = u"Tran/sec" if testname in NETPERF_RR_TESTS \
+                        else lambda r: r.throughput_units
+                    rate = trials(partial(svm.execute_netperf, dep.guest, server_ip, testname),
+                                  f"{testname} {family}", unit, value=_netperf_rate)
+                    results.append(rate)
+                    if testname in NETPERF_RR_TESTS and \
+                            all(r.p99_latency is not None for r in rate.results):
+                        results.append(rate.derive(f"{testname} {family} p99 latency",
+                                                   u"usec", lambda r: r.p99_latency))
+
+    return results
+
+@traced("pal")
+def execute_netperf_test(vt, testname='TCP_RR', duration=10, req_size=0, resp_size=0,
+                         burst=0, send_size=0):
+    """Given an input verify topology, execute a netperf test of each pair.
+    :param vt: Input verify topology.
+    :param testname: Netperf test type, TCP_RR, TCP_CRR, UDP_RR,
+        TCP_STREAM or TCP_MAERTS.
+    :param duration: Test duration in seconds.
+    :param req_size: Request size in bytes of RR tests.
+    :param resp_size: Response size in bytes of RR tests.
+    :param burst: Number of transactions in flight of RR tests.
+    :param send_size: Send size in bytes of stream tests.
+    :type vt: VerifyTopology obj
+    :type testname: str
+    :type duration: int
+    :type req_size: int
+    :type resp_size: int
+    :type burst: int
+    :type send_size: int
     :returns: Test results.
-    :rtype: list(str)
+    :rtype: list(NetperfResult)
     """
+    # pylint: disable=too-many-arguments
     results = list()
     for vte in vt.allow:
         svm = vte.sep.guest
         for dep in vte.get_deps():
-            # iperf udp test is misleading, so comment it out for now.
-            #for proto in ['tcp', 'udp']:
-            for proto in ['tcp']:
-                result = svm.execute_iperf_ipv4(dep.guest, dep.vif.if_addr.ipv4,
-                                                proto=proto)
+            for server_ip in (dep.vif.if_addr.ipv4, dep.vif.if_addr.ipv6):
+                result = svm.execute_netperf(dep.guest, server_ip, testname, int(duration),
+                                             int(req_size), int(resp_size), int(burst),
+                                             int(send_size))
+                logger.info(f"{testname} {svm.name} -> {server_ip}: {result}")
                 results.append(result)
-                result = svm.execute_iperf_ipv6(dep.guest, dep.vif.if_addr.ipv6,
-                                                proto=proto)
-                results.append(result)
-            result = svm.execute_netperf_ipv4(dep.guest, dep.vif.if_addr.ipv4)
-            results.append(result)
-            result = svm.execute_netperf_ipv6(dep.guest, dep.vif.if_addr.ipv6)
-            results.append(result)
-
     return results
@@ -0,0 +1,261 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library for driving the kernel pktgen module in guests.
+
+The guest kernel needs CONFIG_NET_PKTGEN, and each tx queue is driven by
+its own pktgen kernel thread, so the number of queues used is bounded by
+guest vCPUs.
+"""
+
+import json
+import re
+
+from robot.api import logger
+
+__all__ = [
+    u"PKTGEN_DIR",
+    u"PktgenResult",
+    u"get_queue_counters",
+    u"run_pktgen",
+    u"pktgen_flow_ranges",
+    u"pktgen_setup_cmds",
+    u"pktgen_run_cmd",
+    u"parse_pktgen_device",
+    u"parse_queue_counters",
+]
+
+PKTGEN_DIR = u"/proc/net/pktgen"
+
+# pktgen pkt_size doesn't include FCS
+_FCS_LEN = 4
+_PORT_BASE = 1024
+# udp_src_max and udp_dst_max are exclusive
+_MAX_PORTS = 65535 - _PORT_BASE
+
+def _coprime_split(flows):
+    """Split a number into two coprime factors, the larger one is minimized. """
+    prime_powers = list()
+    rest = flows
+    factor = 2
+    while factor * factor <= rest:
+        if rest % factor == 0:
+            power = 1
+            while rest % factor == 0:
+                rest //= factor
+                power *= factor
+            prime_powers.append(power)
+        factor += 1
+    if rest > 1:
+        prime_powers.append(rest)
+
+    best = (flows, 1)
+    for mask in range(1 << len(prime_powers)):
+        first = 1
+        for idx, power in enumerate(prime_powers):
+            if mask >> idx & 1:
+                first *= power
+        best = min(best, (max(first, flows // first), min(first, flows // first)))
+    return best
+
+def pktgen_flow_ranges(flows):
+    """Get udp source and destination port ranges for a number of flows.
+
+    pktgen steps both udp ports by every packet and wraps them at the
+    exclusive max, so port counts are coprime factors of the number of
+    flows, then each (src, dst) pair of their product is sent exactly once
+    per cycle.
+
+    :param flows: Number of flows.
+    :type flows: int
+    :returns: (udp_src_min, udp_src_max, udp_dst_min, udp_dst_max)
+    :rtype: tuple(int, int, int, int)
+    :raises RuntimeError: If the flows cannot be split into two port ranges.
+    """
+    flows = max(1, int(flows))
+    src_ports, dst_ports = _coprime_split(flows)
+    if src_ports > _MAX_PORTS:
+        raise RuntimeError(f"Cannot generate {flows} flows by udp ports")
+    return (_PORT_BASE, _PORT_BASE + src_ports,
+            _PORT_BASE, _PORT_BASE + dst_ports)
+
+def pktgen_setup_cmds(dev, queues, dst_mac, src_ip, dst_ip, frame_size=64, flows=1,
+                      burst=1, rate_pps=0):
+    """Build commands which configure pktgen to send UDP on a device.
+
+    :param dev: Device name.
+    :param queues: Number of tx queues, each is driven by a pktgen thread.
+    :param dst_mac: Destination MAC address.
+    :param src_ip: Source IPv4 address.
+    :param dst_ip: Destination IPv4 address.
+    :param frame_size: Ethernet frame size in bytes including FCS.
+    :param flows: Number of flows by varying udp ports.
+    :param burst: Number of packets sent in a burst by one xmit call.
+    :param rate_pps: Total rate in pps, 0 means as fast as possible.
+    :type dev: str
+    :type queues: int
+    :type dst_mac: str
+    :type src_ip: IPv4Address obj
+    :type dst_ip: IPv4Address obj
+    :type frame_size: int
+    :type flows: int
+    :type burst: int
+    :type rate_pps: int
+    :returns: Commands.
+    :rtype: list(str)
+    """
+    # pylint: disable=too-many-arguments
+    udp_src_min, udp_src_max, udp_dst_min, udp_dst_max = pktgen_flow_ranges(flows)
+    cmds = [u"modprobe pktgen", f"echo reset > {PKTGEN_DIR}/pgctrl"]
+    for queue in range(queues):
+        thread = f"{PKTGEN_DIR}/kpktgend_{queue}"
+        pgdev = f"{PKTGEN_DIR}/{dev}@{queue}"
+        cmds += [f"echo rem_device_all > {thread}",
+                 f"echo add_device {dev}@{queue} > {thread}"]
+        params = [u"count 0", u"clone_skb 0", f"pkt_size {frame_size - _FCS_LEN}",
+                  f"burst {burst}", u"delay 0", f"dst_mac {dst_mac}",
+                  f"src_min {src_ip}", f"src_max {src_ip}", f"dst {dst_ip}",
+                  f"udp_src_min {udp_src_min}", f"udp_src_max {udp_src_max}",
+                  f"udp_dst_min {udp_dst_min}", f"udp_dst_max {udp_dst_max}",
+                  f"queue_map_min {queue}", f"queue_map_max {queue}"]
+        if rate_pps:
+            params.append(f"ratep {max(1, int(rate_pps / queues))}")
+        cmds += [f"echo '{param}' > {pgdev}" for param in params]
+    return cmds
+
+def pktgen_run_cmd(duration):
+    """Build a command which runs configured pktgen threads for a duration.
+
+    :param duration: Duration in seconds.
+    :type duration: int
+    :returns: Command.
+    :rtype: str
+    """
+    return (f"(echo start > {PKTGEN_DIR}/pgctrl) & sleep {duration}; "
+            f"echo stop > {PKTGEN_DIR}/pgctrl; wait")
+
+def parse_pktgen_device(output):
+    """Parse the result of a pktgen device, i.e. /proc/net/pktgen/<dev>.
+
+    :param output: Content of the device file.
+    :type output: str
+    :returns: (sent packets, errors, pps)
+    :rtype: tuple(int, int, int)
+    """
+    match = re.search(r"pkts-sofar:\s*(\d+)\s+errors:\s*(\d+)", output)
+    if not match:
+        raise RuntimeError(f"Invalid pktgen device output: {output[:200]}")
+    sent, errors = int(match.group(1)), int(match.group(2))
+    match = re.search(r"(\d+)pps", output)
+    return sent, errors, int(match.group(1)) if match else 0
+
+def parse_queue_counters(output):
+    """Parse per queue packet counters of 'ethtool -S'.
+
+    :param output: Output of 'ethtool -S'.
+    :type output: str
+    :returns: Packets by (direction, queue), e.g. {('rx', 0): 100}.
+    :rtype: dict
+    """
+    counters = dict()
+    for match in re.finditer(r"(rx|tx)_queue_(\d+)_packets:\s*(\d+)", output):
+        counters[(match.group(1), int(match.group(2)))] = int(match.group(3))
+    return counters
+
+def get_queue_counters(guest, vif):
+    """Get per queue packet counters of a VIF inside a guest.
+
+    :param guest: Guest of the VIF.
+    :param vif: Virtual interface.
+    :type guest: Guest obj
+    :type vif: VirtualInterface obj
+    :returns: Packets by (direction, queue), e.g. {('rx', 0): 100}.
+    :rtype: dict
+    """
+    _, stdout, _ = guest.execute(f"ethtool -S {guest.vif_dev_name(vif)}")
+    return parse_queue_counters(stdout)
+
+def run_pktgen(guest, vif, dst_vif, frame_size=64, flows=1, burst=1, rate_pps=0,
+               duration=10):
+    """Send UDP by kernel pktgen from a VIF of a guest, each queue of the VIF
+    is driven by its own pktgen thread, so queues are bounded by the
+    number of pktgen threads, i.e. guest vCPUs.
+
+    :param guest: Guest to send from.
+    :param vif: Virtual interface to send from.
+    :param dst_vif: Destination virtual interface.
+    :param frame_size: Ethernet frame size in bytes including FCS.
+    :param flows: Number of flows by varying udp ports.
+    :param burst: Number of packets sent in a burst by one xmit call.
+    :param rate_pps: Total rate in pps, 0 means as fast as possible.
+    :param duration: Duration in seconds.
+    :type guest: Guest obj
+    :type vif: VirtualInterface obj
+    :type dst_vif: VirtualInterface obj
+    :type frame_size: int
+    :type flows: int
+    :type burst: int
+    :type rate_pps: int
+    :type duration: int
+    :returns: Result with per queue tx packets.
+    :rtype: PktgenResult obj
+    """
+    # pylint: disable=too-many-arguments
+    dev = guest.vif_dev_name(vif)
+    _, stdout, _ = guest.execute(f"modprobe pktgen && ls {PKTGEN_DIR}")
+    threads = len(re.findall(r"^kpktgend_\d+$", stdout, re.MULTILINE))
+    queues = max(1, min(vif.qpair, threads))
+    if queues < vif.qpair:
+        logger.debug(f"pktgen uses {queues} of {vif.qpair} queues on {guest.name}")
+    results = guest.execute_batch(
+        pktgen_setup_cmds(dev, queues, dst_vif.mac, vif.if_addr.ipv4,
+                          dst_vif.if_addr.ipv4, frame_size, flows, burst, rate_pps),
+        stop_on_error=True)
+    if any(ret_code is None or int(ret_code) != 0 for ret_code, _, _ in results):
+        raise RuntimeError(f"Failed to setup pktgen on {guest.name}")
+
+    before = get_queue_counters(guest, vif)
+    guest.execute(pktgen_run_cmd(duration), duration + 30)
+    after = get_queue_counters(guest, vif)
+
+    result = PktgenResult(duration)
+    for _, stdout, _ in guest.execute_batch([f"cat {PKTGEN_DIR}/{dev}@{queue}"
+                                             for queue in range(queues)]):
+        sent, errors, pps = parse_pktgen_device(stdout)
+        # pkts-sofar doesn't count errors
+        result.tx_packets += sent
+        result.errors += errors
+        result.pps += pps
+    result.tx_queues = {queue: after.get((u"tx", queue), 0) - before.get((u"tx", queue), 0)
+                        for queue in range(queues)}
+    logger.debug(f"pktgen result: {json.dumps(result.to_dict())}")
+    return result
+
+
+class PktgenResult:
+    """Result of a pktgen run. """
+
+    def __init__(self, duration):
+        self.duration = duration
+        self.tx_packets = 0
+        self.errors = 0
+        self.pps = 0
+        self.tx_queues = dict()
+
+    def to_dict(self):
+        """Convert to a JSON serializable dict. """
+        return dict(self.__dict__)
+
+    def __str__(self):
+        return f"{self.pps / 1e6:.3f} Mpps, sent {self.tx_packets}, errors {self.errors}"
@@ -0,0 +1,264 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rx queue to PMD placement of OVS-DPDK.
+
+The planner pins uplink and vhost-user rxqs to PMDs by 'pmd-rxq-affinity',
+NUMA-locally and balanced by the PMD usage of each rxq measured by OVS, so
+traffic should run before planning. The auto load balance test measures
+throughput with 'pmd-auto-lb' disabled and enabled under the same load.
+"""
+
+import re
+
+from robot.api import logger
+
+from resources.libraries.python.timeline import traced
+from resources.libraries.python.topology import suts
+from resources.libraries.python.vswitch import OvsDpdk
+
+__all__ = [
+    u"parse_pmd_rxq_show",
+    u"plan_rxq_affinity",
+    u"pmd_loads",
+    u"plan_pmd_rxq_affinity_on_all_suts",
+    u"clear_pmd_rxq_affinity_on_all_suts",
+    u"execute_pmd_auto_lb_test",
+]
+
+_PMD_THREAD_RE = re.compile(r"^pmd thread numa_id (\d+) core_id (\d+):")
+_RXQ_RE = re.compile(r"^\s*port:\s*(\S+)\s+queue-id:\s*(\d+)\s*(?:\((\w+)\))?"
+                     r"\s*(?:pmd usage:\s*(\d+|NOT AVAIL))?")
+
+def parse_pmd_rxq_show(output):
+    """Parse 'ovs-appctl dpif-netdev/pmd-rxq-show'.
+
+    :param output: Output of pmd-rxq-show.
+    :type output: str
+    :returns: NUMA id by PMD core id, and rxqs with 'port', 'queue', 'core'
+        and 'numa' of the PMD which polls it, 'enabled', and 'usage' in
+        percent of the PMD's cycles or None if it's not measured yet.
+    :rtype: tuple(dict, list(dict))
+    """
+    pmds = dict()
+    rxqs = list()
+    core = None
+    for line in output.splitlines():
+        match = _PMD_THREAD_RE.match(line)
+        if match:
+            core = int(match.group(2))
+            pmds[core] = int(match.group(1))
+            continue
+        match = _RXQ_RE.match(line)
+        if match and core is not None:
+            usage = match.group(4)
+            rxqs.append({u"port": match.group(1), u"queue": int(match.group(2)),
+                         u"core": core, u"numa": pmds[core],
+                         u"enabled": match.group(3) != u"disabled",
+                         u"usage": int(usage) if usage and usage.isdigit() else None})
+    return pmds, rxqs
+
+def plan_rxq_affinity(pmds, rxqs):
+    """Assign rxqs to PMDs, the busiest rxq first onto the least loaded PMD
+    of its NUMA node, and the fewest rxqs on ties, e.g. before any load is
+    measured. An rxq's NUMA node is the one of the PMD which polls it, as
+    OVS places rxqs NUMA-locally whenever there is a local PMD.
+
+    :param pmds: NUMA id by PMD core id.
+    :param rxqs: Rxqs, see parse_pmd_rxq_show().
+    :type pmds: dict
+    :type rxqs: list(dict)
+    :returns: PMD core id by queue id of each port.
+    :rtype: dict
+    """
+    loads = {core: 0 for core in pmds}
+    counts = {core: 0 for core in pmds}
+    affinity = dict()
+    for rxq in sorted(rxqs, key=lambda r: (-(r[u"usage"] or 0), r[u"port"], r[u"queue"])):
+        local = [core for core, numa in pmds.items() if numa == rxq[u"numa"]] or list(pmds)
+        core = min(local, key=lambda c: (loads[c], counts[c], c))
+        loads[core] += rxq[u"usage"] or 0
+        counts[core] += 1
+        affinity.setdefault(rxq[u"port"], dict())[rxq[u"queue"]] = core
+    return affinity
+
+def pmd_loads(pmds, rxqs):
+    """Sum measured usage of rxqs on each PMD.
+
+    :param pmds: NUMA id by PMD core id.
+    :param rxqs: Rxqs, see parse_pmd_rxq_show().
+    :type pmds: dict
+    :type rxqs: list(dict)
+    :returns: Usage in percent by PMD core id.
+    :rtype: dict
+    """
+    loads = {core: 0 for core in pmds}
+    for rxq in rxqs:
+        loads[rxq[u"core"]] = loads.get(rxq[u"core"], 0) + (rxq[u"usage"] or 0)
+    return loads
+
+def _rxq_placement(vswitch):
+    """Get rxq to PMD placement with measured PMD usage of each rxq, see
+    parse_pmd_rxq_show(), it's empty if the vswitch has no PMD threads.
+    """
+    if not isinstance(vswitch, OvsDpdk):
+        return dict(), list()
+    (_, stdout, _) = vswitch.execute("ovs-appctl dpif-netdev/pmd-rxq-show")
+    return parse_pmd_rxq_show(stdout)
+
+def _set_rxq_affinity(vswitch, affinity):
+    cmds = list()
+    for port, queues in affinity.items():
+        pairs = u",".join(f"{queue}:{core}" for queue, core in sorted(queues.items()))
+        cmds.append(f"ovs-vsctl set Interface {port} other_config:pmd-rxq-affinity=\"{pairs}\"")
+    if cmds:
+        vswitch.execute_batch(cmds)
+
+def _clear_rxq_affinity(vswitch, ports):
+    cmds = [f"ovs-vsctl remove Interface {port} other_config pmd-rxq-affinity"
+            for port in ports]
+    if cmds:
+        vswitch.execute_batch(cmds)
+
+def _set_auto_lb(vswitch, enable, load_threshold=None, improvement_threshold=None,
+                 rebal_interval=None):
+    """Enable or disable PMD auto load balance, a vswitch without PMD
+    threads has nothing to balance.
+    """
+    if not isinstance(vswitch, OvsDpdk):
+        return
+    options = [f"other_config:pmd-auto-lb={str(bool(enable)).lower()}"]
+    if load_threshold is not None:
+        options.append(f"other_config:pmd-auto-lb-load-threshold={int(load_threshold)}")
+    if improvement_threshold is not None:
+        options.append(f"other_config:pmd-auto-lb-improvement-threshold="
+                       f"{int(improvement_threshold)}")
+    if rebal_interval is not None:
+        options.append(f"other_config:pmd-auto-lb-rebal-interval={int(rebal_interval)}")
+    vswitch.execute(f"ovs-vsctl set Open_vSwitch . {' '.join(options)}")
+
+def _imbalance(loads):
+    return max(loads.values()) - min(loads.values()) if loads else 0
+
+@traced("pmdrxq")
+def plan_pmd_rxq_affinity_on_all_suts(apply=True):
+    """Plan rxq to PMD placement by measured load on all SUTs, and pin rxqs
+    accordingly.
+
+    :param apply: Pin rxqs or only report the plan.
+    :type apply: bool
+    :returns: Measured and planned load of each PMD, they are printed as
+        result lines.
+    :rtype: list(str)
+    """
+    results = list()
+    for sut in suts:
+        pmds, rxqs = _rxq_placement(sut.vswitch)
+        if not pmds:
+            continue
+        affinity = plan_rxq_affinity(pmds, rxqs)
+        planned = [dict(rxq, core=affinity[rxq[u"port"]][rxq[u"queue"]]) for rxq in rxqs]
+        current_loads = pmd_loads(pmds, rxqs)
+        planned_loads = pmd_loads(pmds, planned)
+        for core in sorted(pmds):
+            results.append(f"{sut.name} pmd {core} numa {pmds[core]} load: "
+                           f"{current_loads[core]} % measured, {planned_loads[core]} % planned")
+        logger.info(f"{sut.name} rxq affinity plan: {affinity}")
+        if apply:
+            _set_rxq_affinity(sut.vswitch, affinity)
+    return results
+
+@traced("pmdrxq")
+def clear_pmd_rxq_affinity_on_all_suts():
+    """Unpin all rxqs from PMDs on all SUTs, OVS places them again. """
+    for sut in suts:
+        _, rxqs = _rxq_placement(sut.vswitch)
+        _clear_rxq_affinity(sut.vswitch, sorted({rxq[u"port"] for rxq in rxqs}))
+
+def _placement():
+    placement = dict()
+    loads = dict()
+    for sut in suts:
+        pmds, rxqs = _rxq_placement(sut.vswitch)
+        for rxq in rxqs:
+            placement[(sut.name, rxq[u"port"], rxq[u"queue"])] = rxq[u"core"]
+        loads[sut.name] = pmd_loads(pmds, rxqs)
+    return placement, loads
+
+@traced("pmdrxq")
+def execute_pmd_auto_lb_test(vt, parallel=8, duration=30, rebal_interval=1,
+                             load_threshold=50, improvement_threshold=10):
+    """Given an input verify topology, measure the effect of PMD auto load
+    balance on iperf tcp throughput of the first allow pair.
+
+    The load is skewed as only the first pair has traffic, and its parallel
+    streams are spread over rxqs by RSS. The pair is measured with auto
+    load balance disabled, then it's enabled and the same load runs long
+    enough for a rebalance before it's measured again.
+
+    :param vt: Input verify topology.
+    :param parallel: Number of iperf streams.
+    :param duration: Duration in seconds of each measurement.
+    :param rebal_interval: Minimal minutes between rebalances.
+    :param load_threshold: PMD load in percent to trigger rebalance.
+    :param improvement_threshold: Variance improvement in percent which a
+        rebalance must achieve.
+    :type vt: VerifyTopology obj
+    :type parallel: int
+    :type duration: int
+    :type rebal_interval: int
+    :type load_threshold: int
+    :type improvement_threshold: int
+    :returns: Throughput and PMD load imbalance with auto load balance
+        disabled and enabled, and the number of moved rxqs.
+    :rtype: list(str)
+    """
+    # pylint: disable=too-many-arguments
+    if not vt.allow or not vt.allow[0].get_deps():
+        raise RuntimeError("No allowed entry is found.")
+    sep = vt.allow[0].sep
+    dep = vt.allow[0].get_deps()[0]
+    server_ip = dep.vif.if_addr.ipv4
+
+    def measure(mode, length):
+        result = sep.guest.execute_iperf(dep.guest, server_ip, parallel=int(parallel),
+                                         duration=int(length))
+        placement, loads = _placement()
+        imbalance = max((_imbalance(sut_loads) for sut_loads in loads.values()),
+                        default=0)
+        logger.info(f"pmd-auto-lb {mode}: {result}, pmd loads {loads}")
+        return result, placement, imbalance
+
+    results = list()
+    for sut in suts:
+        _set_auto_lb(sut.vswitch, False)
+    off, before, off_imbalance = measure(u"off", duration)
+    try:
+        for sut in suts:
+            _set_auto_lb(sut.vswitch, True, load_threshold, improvement_threshold,
+                         rebal_interval)
+        # Load long enough for rebalance which is checked once a rebalance interval
+        measure(u"warm-up", int(rebal_interval) * 60 + 30)
+        on, after, on_imbalance = measure(u"on", duration)
+    finally:
+        for sut in suts:
+            _set_auto_lb(sut.vswitch, False)
+
+    moved = len([key for key, core in after.items() if before.get(key, core) != core])
+    results.append(f"pmd-auto-lb off tcp ipv4 throughput: {int(off.kbps)} Kbits/sec")
+    results.append(f"pmd-auto-lb on tcp ipv4 throughput: {int(on.kbps)} Kbits/sec")
+    results.append(f"pmd-auto-lb off pmd load imbalance: {off_imbalance} %")
+    results.append(f"pmd-auto-lb on pmd load imbalance: {on_imbalance} %")
+    results.append(f"pmd-auto-lb moved rxqs: {moved}")
+    return results
@@ -0,0 +1,348 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-demand CPU profiling of ovs-vswitchd PMD threads and QEMU vCPU/vhost
+threads on SUTs for the traffic window of a test.
+
+'record' mode samples call stacks by 'perf record', and they are folded
+into 'comm;caller;...;callee count' lines which flamegraph.pl or
+speedscope can render. 'stat' mode counts PMU events by 'perf stat' per
+thread group, e.g. cycles and instructions for IPC.
+"""
+
+import gzip
+import os
+import re
+import shutil
+import subprocess
+
+from collections import Counter
+from time import time, sleep
+from uuid import uuid4
+
+from robot.api import logger
+from robot.libraries.BuiltIn import BuiltIn, RobotNotRunningError
+
+from resources.libraries.python.output import output_path
+from resources.libraries.python.ssh import scp_node
+from resources.libraries.python.sshshell import open_stream, close_stream
+from resources.libraries.python.timeline import traced
+from resources.libraries.python.topology import suts
+
+__all__ = [
+    u"PERF_STAT_EVENTS",
+    u"THREAD_GROUPS",
+    u"parse_threads",
+    u"fold_perf_script",
+    u"parse_perf_stat",
+    u"Profiler",
+    u"start_profiling_on_all_suts",
+    u"stop_profiling_on_all_suts",
+]
+
+PERF_STAT_EVENTS = (u"cycles", u"instructions", u"cache-references", u"cache-misses",
+                    u"branch-misses", u"LLC-load-misses")
+
+# Thread groups by thread name, e.g. 'pmd-c02/id:5' (or 'pmd12' of older
+# OVS), 'CPU 0/KVM' of QEMU, and 'vhost-<qemu pid>' kernel threads.
+THREAD_GROUPS = ((u"pmd", re.compile(r"^pmd")),
+                 (u"vcpu", re.compile(r"^CPU \d+/KVM$")),
+                 (u"vhost", re.compile(r"^vhost-\d+$")))
+
+_THREADS_CMD = u"ps -eLo tid=,comm="
+_SYMBOL_OFFSET_RE = re.compile(r"\+0x[0-9a-f]+$")
+
+_profilers = list()
+
+def parse_threads(output, groups=(u"pmd", u"vcpu", u"vhost")):
+    """Parse 'ps -eLo tid=,comm=' into thread ids of each group.
+
+    :param output: Command output.
+    :param groups: Thread groups to be profiled, see THREAD_GROUPS.
+    :type output: str
+    :type groups: list(str)
+    :returns: Thread ids by group, a group without threads is omitted.
+    :rtype: dict
+    """
+    threads = dict()
+    for line in output.splitlines():
+        fields = line.strip().split(None, 1)
+        if len(fields) != 2:
+            continue
+        for group, pattern in THREAD_GROUPS:
+            if group in groups and pattern.match(fields[1]):
+                threads.setdefault(group, list()).append(int(fields[0]))
+                break
+    return threads
+
+def fold_perf_script(lines):
+    """Fold call stacks of 'perf script -F comm,tid,ip,sym' output.
+
+    :param lines: Output lines.
+    :type lines: iterable(str)
+    :returns: Sample counts by folded stack, root first, e.g.
+        'pmd-c02/id:5;pmd_thread_main;dp_netdev_process_rxq_port'.
+    :rtype: Counter
+    """
+    folded = Counter()
+    comm = None
+    stack = list()
+    for line in lines:
+        if not line.strip():
+            if comm is not None:
+                folded[u";".join([comm] + stack[::-1])] += 1
+            comm = None
+            stack = list()
+        elif not line[0].isspace():
+            # Sample header is 'comm tid', comm may have spaces
+            comm = line.strip().rsplit(None, 1)[0].replace(u";", u":")
+        else:
+            fields = line.split(None, 1)
+            symbol = fields[1].strip() if len(fields) > 1 else u"[unknown]"
+            stack.append(_SYMBOL_OFFSET_RE.sub(u"", symbol).replace(u";", u":"))
+    if comm is not None:
+        folded[u";".join([comm] + stack[::-1])] += 1
+    return folded
+
+def parse_perf_stat(output):
+    """Parse 'perf stat -x, --per-thread' output.
+
+    :param output: Command output.
+    :type output: str
+    :returns: Counts by event, summed over threads, an event which is not
+        supported or counted is omitted.
+    :rtype: dict
+    """
+    counts = dict()
+    for line in output.splitlines():
+        fields = line.split(u",")
+        if len(fields) < 4 or line.startswith(u"#"):
+            continue
+        # thread,value,unit,event,... and the value may be '<not counted>'
+        try:
+            value = float(fields[1])
+        except ValueError:
+            continue
+        counts[fields[3]] = counts.get(fields[3], 0) + value
+    return counts
+
+def _self_time(folded):
+    # Leaf function of each stack is where the time is spent
+    leaves = Counter()
+    for stack, count in folded.items():
+        leaves[stack.rsplit(u";", 1)[-1]] += count
+    return leaves
+
+
+class Profiler:
+    """Profiler of thread groups on a SUT, perf runs in background on its
+    own stream until stop().
+
+    :param sut: SUT.
+    :param mode: 'record' or 'stat'.
+    :param groups: Thread groups to be profiled, see THREAD_GROUPS.
+    :param frequency: Sampling frequency in Hz of 'record'.
+    :param call_graph: Call graph method of 'record', 'fp' or 'dwarf'.
+    :param events: PMU events of 'stat'.
+    :type sut: SUT obj
+    :type mode: str
+    :type groups: list(str)
+    :type frequency: int
+    :type call_graph: str
+    :type events: list(str)
+    """
+
+    def __init__(self, sut, mode=u"record", groups=(u"pmd", u"vcpu", u"vhost"),
+                 frequency=999, call_graph=u"fp", events=PERF_STAT_EVENTS):
+        # pylint: disable=too-many-arguments
+        if mode not in (u"record", u"stat"):
+            raise RuntimeError(f"Unsupported profiling mode: {mode}")
+        self.sut = sut
+        self.mode = mode
+        self.groups = groups
+        self.frequency = frequency
+        self.call_graph = call_graph
+        self.events = events
+        self.threads = dict()
+        self._streams = dict()
+        self._prefix = f"/tmp/cne-perf-{uuid4().hex}"
+
+    def _perf_cmd(self, group, tids):
+        out = f"{self._prefix}-{group}"
+        tid_list = u",".join(str(tid) for tid in tids)
+        if self.mode == u"record":
+            perf = (f"perf record -q -F {self.frequency} --call-graph {self.call_graph} "
+                    f"-t {tid_list} -o {out}.data")
+        else:
+            perf = (f"perf stat -x, --per-thread -e {','.join(self.events)} "
+                    f"-t {tid_list} -o {out}.stat")
+        # perf replaces the shell so it can be interrupted by the pid file
+        return f"echo $$ >{out}.pid; exec {perf}"
+
+    def start(self, max_duration=3600):
+        """Start perf on each thread group.
+
+        :param max_duration: Seconds after which a left behind perf is killed.
+        :type max_duration: int
+        """
+        _, stdout, _ = self.sut.vswitch.execute_host(_THREADS_CMD)
+        self.threads = parse_threads(stdout, self.groups)
+        if not self.threads:
+            logger.warn(f"No thread to profile on {self.sut.name}")
+        for group, tids in self.threads.items():
+            stream = open_stream(self.sut.ssh_info, self._perf_cmd(group, tids), max_duration)
+            if stream:
+                self._streams[group] = stream
+        logger.debug(f"Profiling {self.mode} on {self.sut.name}: {self.threads}")
+
+    def _interrupt(self, timeout=60):
+        self.sut.vswitch.execute_host(
+            u"; ".join(f"kill -INT $(cat {self._prefix}-{group}.pid)"
+                       for group in self._streams), exp_fail=None)
+        start = time()
+        for group, stream in self._streams.items():
+            # perf writes its data file on SIGINT, it may take a while
+            while not stream[0].exit_status_ready() and time() - start < timeout:
+                sleep(0.1)
+            if not stream[0].exit_status_ready():
+                logger.warn(f"perf of {group} on {self.sut.name} didn't exit in {timeout}s")
+            close_stream(stream)
+
+    def _collect_record(self, group, prefix):
+        remote = f"{self._prefix}-{group}.script.gz"
+        self.sut.vswitch.execute_host(
+            f"perf script -F comm,tid,ip,sym -i {self._prefix}-{group}.data 2>/dev/null "
+            f"| gzip -c >{remote}", timeout=600)
+        local = f"{prefix}_{self.sut.name}_{group}.script.gz"
+        scp_node(self.sut.ssh_info, local, remote, get=True, timeout=600)
+        with gzip.open(local, u"rt", errors=u"ignore") as script:
+            folded = fold_perf_script(script)
+        os.remove(local)
+
+        path = f"{prefix}_{self.sut.name}_{group}.folded"
+        with open(path, u"w") as folded_file:
+            for stack, count in folded.most_common():
+                folded_file.write(f"{stack} {count}\n")
+        links = [f"<a href=\"{os.path.basename(path)}\">folded stacks</a>"]
+        flamegraph = shutil.which(u"flamegraph.pl")
+        if flamegraph:
+            svg = f"{path[:-len('.folded')]}.svg"
+            with open(svg, u"w") as svg_file:
+                subprocess.run([flamegraph, u"--title", f"{self.sut.name} {group}", path],
+                               stdout=svg_file, check=False)
+            links.append(f"<a href=\"{os.path.basename(svg)}\">flame graph</a>")
+        logger.info(f"{self.sut.name} {group} profile: {', '.join(links)}", html=True)
+
+        total = sum(folded.values())
+        results = list()
+        for func, count in _self_time(folded).most_common(5):
+            results.append(f"{self.sut.name} {group} top {func}: {count * 100 / total:.1f} %")
+        return results
+
+    def _collect_stat(self, group):
+        _, stdout, _ = self.sut.vswitch.execute_host(f"cat {self._prefix}-{group}.stat")
+        counts = parse_perf_stat(stdout)
+        results = [f"{self.sut.name} {group} {event}: {value:.0f} count"
+                   for event, value in counts.items()]
+        if counts.get(u"cycles") and u"instructions" in counts:
+            results.append(f"{self.sut.name} {group} IPC: "
+                           f"{counts[u'instructions'] / counts[u'cycles']:.2f}")
+        return results
+
+    def cancel(self):
+        """Stop perf without collecting its data. """
+        if not self._streams:
+            return
+        self._interrupt()
+        self.sut.vswitch.execute_host(f"rm -f {self._prefix}-*", exp_fail=None)
+        self._streams = dict()
+
+    def stop(self, prefix):
+        """Stop perf and collect its data.
+
+        :param prefix: Local path prefix of profile files, e.g.
+            '<output dir>/profile_<test name>'.
+        :type prefix: str
+        :returns: Hottest functions by share of samples in percent of
+            'record', or event counts and IPC of 'stat', of each group.
+        :rtype: list(str)
+        """
+        if not self._streams:
+            return list()
+        self._interrupt()
+        results = list()
+        try:
+            for group in self._streams:
+                if self.mode == u"record":
+                    results += self._collect_record(group, prefix)
+                else:
+                    results += self._collect_stat(group)
+        finally:
+            self.sut.vswitch.execute_host(f"rm -f {self._prefix}-*", exp_fail=None)
+            self._streams = dict()
+        return results
+
+
+@traced("profiler")
+def start_profiling_on_all_suts(mode=None, groups=(u"pmd", u"vcpu", u"vhost"), frequency=999,
+                                call_graph=u"fp"):
+    """Start profiling PMD threads and QEMU vCPU/vhost threads on all SUTs
+    by perf, e.g. right before the traffic of a test.
+
+    :param mode: 'record' or 'stat', default is '-v PROFILE:<mode>' and
+        it's a no-op if neither is given.
+    :param groups: Thread groups to be profiled, see THREAD_GROUPS.
+    :param frequency: Sampling frequency in Hz of 'record'.
+    :param call_graph: Call graph method of 'record', 'fp' or 'dwarf'.
+    :type mode: str
+    :type groups: list(str)
+    :type frequency: int
+    :type call_graph: str
+    """
+    stop_profiling_on_all_suts(collect=False)
+    if not mode:
+        try:
+            mode = BuiltIn().get_variable_value(u"${PROFILE}")
+        except RobotNotRunningError:
+            mode = None
+    if not mode:
+        return
+    for sut in suts:
+        profiler = Profiler(sut, mode, groups, int(frequency), call_graph)
+        profiler.start()
+        _profilers.append(profiler)
+
+@traced("profiler")
+def stop_profiling_on_all_suts(name=None, collect=True):
+    """Stop profiling on all SUTs, and collect profiles into robot output
+    directory, i.e. 'profile_<name>_<sut>_<group>.folded' (and '.svg' if
+    flamegraph.pl is in PATH) which are linked in the log.
+
+    :param name: Profile name, default is the test name.
+    :param collect: Collect profiles or only stop perf.
+    :type name: str
+    :type collect: bool
+    :returns: Hottest functions or event counts of each thread group,
+        they are printed as result lines.
+    :rtype: list(str)
+    """
+    prefix = output_path(u"profile", name, suffix=u"")
+    results = list()
+    while _profilers:
+        profiler = _profilers.pop(0)
+        if collect:
+            results += profiler.stop(prefix)
+        else:
+            profiler.cancel()
+    return results
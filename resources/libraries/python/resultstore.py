@@ -0,0 +1,364 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""SQLite store of performance results with their run context, and
+regression detection of a run against a baseline run.
+
+Results are recorded by 'Record Results' in common.robot, and two runs are
+compared by e.g.::
+
+    $ python3 -m resources.libraries.python.resultstore output/results.db base new
+
+It exits with 1 if any metric regresses significantly, i.e. Welch's t-test
+at 95% confidence and the change is beyond the threshold.
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import sqlite3
+import statistics
+import sys
+import time
+
+from robot.api import logger
+from robot.libraries.BuiltIn import BuiltIn, RobotNotRunningError
+
+from resources.libraries.python.trial import t95_quantile
+
+__all__ = [
+    u"ResultStore",
+    u"result_to_records",
+    u"collect_run_context",
+    u"store_results",
+    u"compare_runs",
+]
+
+_SCHEMA = (
+    u"CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, name TEXT UNIQUE, "
+    u"started REAL, context TEXT)",
+    u"CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, "
+    u"run_id INTEGER REFERENCES runs(id), suite TEXT, test TEXT, tags TEXT, "
+    u"metric TEXT, unit TEXT, value REAL, samples TEXT, noisy INTEGER, "
+    u"context TEXT, recorded REAL)",
+)
+
+# e.g. 'tcp ipv4 throughput: 1000 Kbits/sec' or 'TCP_RR ipv4: median 10.5 Tran/sec'
+_RESULT_RE = re.compile(r"^(?P<metric>[^:]+):\s*(?:[a-z]+\s+)?"
+                        r"(?P<value>-?\d+(?:\.\d+)?)\s*(?P<unit>[^\s,]*)")
+# Metrics are higher-is-better, e.g. throughput, except latencies, costs and
+# loss counters, e.g. 'sut1 dpdk0 rx_missed_errors: 10 packets'.
+_LOWER_BETTER_UNITS = (u"usec", u"ms", u"sec", u"cycles", u"cycles/pkt", u"packets")
+_LOWER_BETTER_RE = re.compile(r"latency|drop|discard|error|miss|lost|loss", re.IGNORECASE)
+
+
+class _Run:
+    """Context and name of this run, they are determined once. """
+    context = None
+    name = None
+
+
+class ResultStore:
+    """Results of runs in a SQLite database.
+
+    :param path: Database file path, it's created if it doesn't exist.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        for stmt in _SCHEMA:
+            self._conn.execute(stmt)
+        self._conn.commit()
+
+    def close(self):
+        """Close the database. """
+        self._conn.close()
+
+    def get_run(self, name, context=None):
+        """Get the ID of a run, the run is created if it doesn't exist.
+
+        :param name: Run name.
+        :param context: Run context, only used if the run is created.
+        :type name: str
+        :type context: dict
+        :returns: Run ID.
+        :rtype: int
+        """
+        row = self._conn.execute(u"SELECT id FROM runs WHERE name = ?", (name,)).fetchone()
+        if row:
+            return row[0]
+        cursor = self._conn.execute(
+            u"INSERT INTO runs (name, started, context) VALUES (?, ?, ?)",
+            (name, time.time(), json.dumps(context or dict(), default=str)))
+        self._conn.commit()
+        return cursor.lastrowid
+
+    def add_results(self, run_id, suite, test, tags, records, context=None):
+        """Add result records of a test.
+
+        :param run_id: Run ID.
+        :param suite: Suite name.
+        :param test: Test name.
+        :param tags: Test tags.
+        :param records: Records, see result_to_records().
+        :param context: Test context, e.g. offload flags and queue counts.
+        :type run_id: int
+        :type suite: str
+        :type test: str
+        :type tags: list(str)
+        :type records: list(dict)
+        :type context: dict
+        """
+        # pylint: disable=too-many-arguments
+        now = time.time()
+        self._conn.executemany(
+            u"INSERT INTO results (run_id, suite, test, tags, metric, unit, value, samples, "
+            u"noisy, context, recorded) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(run_id, suite, test, json.dumps(list(tags)), r[u"metric"], r[u"unit"],
+              r[u"value"], json.dumps(r[u"samples"]), int(r[u"noisy"]),
+              json.dumps(context or dict(), default=str), now) for r in records])
+        self._conn.commit()
+
+    def get_results(self, name):
+        """Get results of a run, the latest one wins if a metric is recorded
+        more than once.
+
+        :param name: Run name.
+        :type name: str
+        :returns: Records by (suite, test, metric).
+        :rtype: dict
+        """
+        rows = self._conn.execute(
+            u"SELECT suite, test, metric, unit, value, samples FROM results "
+            u"JOIN runs ON results.run_id = runs.id WHERE runs.name = ? "
+            u"ORDER BY results.id", (name,)).fetchall()
+        if not rows:
+            raise RuntimeError(f"No results of run {name} in {self.path}")
+        return {(suite, test, metric): {u"unit": unit, u"value": value,
+                                        u"samples": json.loads(samples)}
+                for suite, test, metric, unit, value, samples in rows}
+
+
+def result_to_records(result):
+    """Convert a test result to records of metrics.
+
+    A Measurement keeps its samples, and other results are parsed from their
+    result lines, e.g. 'tcp ipv4 throughput: 1000 Kbits/sec'. A line which
+    can't be parsed is kept as the metric without a value.
+
+    :param result: Test result, Measurement obj or anything printable.
+    :type result: object
+    :returns: Records with 'metric', 'unit', 'value', 'samples' and 'noisy'.
+    :rtype: list(dict)
+    """
+    if hasattr(result, u"samples") and hasattr(result, u"name"):
+        return [{u"metric": result.name, u"unit": result.unit, u"value": result.mean,
+                 u"samples": list(result.samples), u"noisy": result.noisy}]
+    line = str(result).strip()
+    match = _RESULT_RE.match(line)
+    if not match:
+        return [{u"metric": line, u"unit": u"", u"value": None, u"samples": list(),
+                 u"noisy": False}]
+    value = float(match.group(u"value"))
+    return [{u"metric": match.group(u"metric").strip(), u"unit": match.group(u"unit"),
+             u"value": value, u"samples": [value], u"noisy": u"NOISY" in line}]
+
+def _host_fact(sut, cmd):
+    ret_code, stdout, _ = sut.vswitch.execute_host(cmd, exp_fail=None)
+    if ret_code is None or int(ret_code) != 0:
+        return None
+    return stdout.strip()
+
+def collect_run_context():
+    """Collect the context of this run once, i.e. the topology file, and
+    dp_type, OVS/DPDK/QEMU versions and host facts of each SUT.
+
+    :returns: Run context.
+    :rtype: dict
+    """
+    # pylint: disable=import-outside-toplevel
+    if _Run.context is not None:
+        return _Run.context
+
+    # topology is imported lazily as its SUTs are only built in a robot run
+    from resources.libraries.python.topology import suts
+    try:
+        topology = BuiltIn().get_variable_value(u"${TOPOLOGY_PATH}")
+    except RobotNotRunningError:
+        topology = None
+    context = {u"topology": topology, u"suts": dict()}
+    for sut in suts:
+        try:
+            _, ovs_version, _ = sut.vswitch.execute(u"ovs-vswitchd --version")
+        except RuntimeError:
+            ovs_version = u""
+        vms = sut.get_vms()
+        context[u"suts"][sut.name] = {
+            u"host": sut.ssh_info.get(u"host"),
+            u"dp_type": type(sut.vswitch).__name__,
+            u"ovs_version": ovs_version.splitlines()[0] if ovs_version else None,
+            u"dpdk_version": next((line for line in ovs_version.splitlines()
+                                   if u"DPDK" in line), None),
+            u"qemu_version": _host_fact(sut, f"{vms[0].qemu_bin} --version | head -1")
+                             if vms else None,
+            u"kernel": _host_fact(sut, u"uname -r"),
+            u"cpu_model": _host_fact(sut, u"lscpu | sed -n 's/^Model name: *//p'"),
+            u"cpus": _host_fact(sut, u"nproc"),
+            u"cmdline": _host_fact(sut, u"cat /proc/cmdline"),
+        }
+    _Run.context = context
+    return context
+
+def _collect_test_context():
+    # pylint: disable=import-outside-toplevel
+    from resources.libraries.python.topology import suts
+    vifs = dict()
+    for sut in suts:
+        for guest in sut.get_vms():
+            for vif in guest.vifs:
+                vifs[vif.name] = {u"offload": vif.offload, u"qpair": vif.qpair}
+    return {u"vifs": vifs}
+
+def _variable(name, default=None):
+    try:
+        return BuiltIn().get_variable_value(name, default)
+    except RobotNotRunningError:
+        return default
+
+def store_results(results, db=None, run=None):
+    """Store results of the current test into the results store.
+
+    :param results: Test results, e.g. Measurement objs or result lines.
+    :param db: Database path, default is ${RESULTS_DB} or 'results.db' in
+        robot output dir.
+    :param run: Run name, default is ${RESULTS_RUN} or the start time of
+        this run.
+    :type results: list
+    :type db: str
+    :type run: str
+    """
+    if _Run.name is None:
+        _Run.name = time.strftime(u"%Y%m%d-%H%M%S")
+    db = db or _variable(u"${RESULTS_DB}") or \
+        os.path.join(_variable(u"${OUTPUT DIR}", u"."), u"results.db")
+    run = run or _variable(u"${RESULTS_RUN}") or _Run.name
+
+    records = [record for result in results for record in result_to_records(result)]
+    store = ResultStore(db)
+    try:
+        run_id = store.get_run(run, collect_run_context())
+        store.add_results(run_id, _variable(u"${SUITE NAME}", u""), _variable(u"${TEST NAME}", u""),
+                          _variable(u"@{TEST TAGS}", list()), records, _collect_test_context())
+    finally:
+        store.close()
+    logger.info(f"{len(records)} results are recorded to run {run} in {db}")
+
+def _lower_is_better(metric, unit):
+    return bool(_LOWER_BETTER_RE.search(metric)) or unit in _LOWER_BETTER_UNITS
+
+def _welch(base, new):
+    """Welch's t statistic and degrees of freedom. """
+    var_base, var_new = statistics.variance(base), statistics.variance(new)
+    se_base, se_new = var_base / len(base), var_new / len(new)
+    diff = statistics.mean(new) - statistics.mean(base)
+    if not se_base + se_new:
+        # Both sides have zero variance, so any difference of means is
+        # significant, and the t distribution is the normal one.
+        return (math.copysign(math.inf, diff) if diff else 0.0), math.inf
+    t_stat = diff / math.sqrt(se_base + se_new)
+    dof = (se_base + se_new) ** 2 / ((se_base ** 2 / (len(base) - 1) if se_base else 0) +
+                                     (se_new ** 2 / (len(new) - 1) if se_new else 0))
+    return t_stat, dof
+
+def compare_runs(db, baseline, run, threshold=0.02):
+    """Compare metrics of a run against a baseline run.
+
+    A metric regresses or improves if Welch's t-test is significant at 95%
+    confidence and the relative change is beyond the threshold. Metrics
+    with less than 2 samples on either side can't be tested.
+
+    :param db: Database path.
+    :param baseline: Baseline run name.
+    :param run: Run name.
+    :param threshold: Minimal relative change.
+    :type db: str
+    :type baseline: str
+    :type run: str
+    :type threshold: float
+    :returns: Comparisons with 'key', 'unit', 'base', 'new', 'change' and
+        'status' of 'regression', 'improvement', 'unchanged',
+        'insufficient samples' or 'missing'.
+    :rtype: list(dict)
+    """
+    store = ResultStore(db)
+    try:
+        base_results = store.get_results(baseline)
+        new_results = store.get_results(run)
+    finally:
+        store.close()
+
+    comparisons = list()
+    for key, base in base_results.items():
+        if base[u"value"] is None:
+            continue
+        comparison = {u"key": key, u"unit": base[u"unit"], u"base": base[u"value"],
+                      u"new": None, u"change": None, u"status": u"missing"}
+        comparisons.append(comparison)
+        new = new_results.get(key)
+        if not new or new[u"value"] is None:
+            continue
+        comparison[u"new"] = new[u"value"]
+        if base[u"value"]:
+            comparison[u"change"] = (new[u"value"] - base[u"value"]) / abs(base[u"value"])
+        if len(base[u"samples"]) < 2 or len(new[u"samples"]) < 2:
+            comparison[u"status"] = u"insufficient samples"
+            continue
+        t_stat, dof = _welch(base[u"samples"], new[u"samples"])
+        change = comparison[u"change"] or 0.0
+        if abs(t_stat) <= t95_quantile(dof) or abs(change) < threshold:
+            comparison[u"status"] = u"unchanged"
+        elif (change < 0) != _lower_is_better(key[2], base[u"unit"]):
+            comparison[u"status"] = u"regression"
+        else:
+            comparison[u"status"] = u"improvement"
+    return comparisons
+
+def main():
+    """Compare a run against a baseline run from command line. """
+    parser = argparse.ArgumentParser(description=u"Compare results of a run against a baseline.")
+    parser.add_argument(u"db", help=u"results database")
+    parser.add_argument(u"baseline", help=u"baseline run name")
+    parser.add_argument(u"run", help=u"run name to compare")
+    parser.add_argument(u"--threshold", type=float, default=0.02,
+                        help=u"minimal relative change, default 0.02")
+    args = parser.parse_args()
+
+    comparisons = compare_runs(args.db, args.baseline, args.run, args.threshold)
+    for comp in comparisons:
+        suite, test, metric = comp[u"key"]
+        new = f"{comp[u'new']:.2f}" if comp[u"new"] is not None else u"-"
+        change = f" ({comp[u'change']:+.1%})" if comp[u"change"] is not None else u""
+        print(f"{comp[u'status']:<20} {suite} / {test} / {metric}: "
+              f"{comp[u'base']:.2f} -> {new} {comp[u'unit']}{change}")
+    regressions = [c for c in comparisons if c[u"status"] == u"regression"]
+    print(f"{len(comparisons)} metrics compared, {len(regressions)} regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == u"__main__":
+    sys.exit(main())
@@ -16,47 +16,48 @@
 """Library for SSH connection management."""
 
 
+import os
 import socket
 
-from io import StringIO
+from base64 import b64decode
 from time import time, sleep
 
-from paramiko import RSAKey, SSHClient, AutoAddPolicy
-from paramiko.ssh_exception import SSHException, NoValidConnectionsError
+from paramiko.ssh_exception import SSHException
 from robot.api import logger
 from scp import SCPClient, SCPException
 
+from resources.libraries.python.sshpool import SSHConnectionPool, ssh_pool
+from resources.libraries.python.sshshell import ShellSession, open_stream, close_stream, \
+    new_sid_file, session_guard_supported, guard_command, kill_remote_session
+from resources.libraries.python.sshstats import ssh_stats
+from resources.libraries.python.sshtransport import SSHTimeout, set_ssh_agent, \
+    set_ssh_transport, ssh_agent, ssh_recorder, ssh_replay_log, ssh_transport_mode
+from resources.libraries.python.timeline import timeline
+
 __all__ = [
     u"exec_cmd", u"SSH", u"SSHTimeout", u"scp_node",
-    u"kill_process",
+    u"kill_process", u"ReplaySSH", u"set_ssh_transport",
+    u"ShellSession", u"exec_cmd_batch", u"ssh_transport_mode", u"set_ssh_agent",
+    u"SSHConnectionPool", u"ssh_pool", u"open_stream", u"close_stream",
 ]
 
 
-class SSHTimeout(Exception):
-    """This exception is raised when a timeout occurs."""
+def _new_ssh():
+    replay = ssh_replay_log()
+    if replay:
+        return ReplaySSH(replay)
+    return SSH()
 
 
 class SSH:
     """Contains methods for managing and using SSH connections."""
 
     __MAX_RECV_BUF = 10 * 1024 * 1024
-    __existing_connections = dict()
 
     def __init__(self):
         self._ssh = None
         self._node = None
 
-    @staticmethod
-    def _node_hash(node):
-        """Get IP address and port hash from node dictionary.
-
-        :param node: Node in topology.
-        :type node: dict
-        :returns: IP address and port for the specified node.
-        :rtype: int
-        """
-        return hash(frozenset([node[u"host"], node[u"port"]]))
-
     def connect(self, node, attempts=5):
         """Connect to node prior to running exec_command or scp.
 
@@ -69,46 +70,7 @@ class SSH:
         :raises IOError: If cannot connect to host.
         """
         self._node = node
-        node_hash = self._node_hash(node)
-        if node_hash in SSH.__existing_connections:
-            self._ssh = SSH.__existing_connections[node_hash]
-            if self._ssh.get_transport().is_active():
-                logger.debug(f"Reusing SSH: {self._ssh}")
-            else:
-                if attempts > 0:
-                    self._reconnect(attempts-1)
-                else:
-                    raise IOError(f"Cannot connect to {node['host']}")
-        else:
-            try:
-                start = time()
-                pkey = None
-                if u"priv_key" in node:
-                    pkey = RSAKey.from_private_key(StringIO(node[u"priv_key"]))
-
-                self._ssh = SSHClient()
-                self._ssh.set_missing_host_key_policy(AutoAddPolicy())
-
-                self._ssh.connect(
-                    node[u"host"], username=node[u"username"],
-                    password=node.get(u"password"), pkey=pkey,
-                    port=node[u"port"]
-                )
-
-                self._ssh.get_transport().set_keepalive(10)
-
-                SSH.__existing_connections[node_hash] = self._ssh
-                logger.debug(
-                    f"New SSH to {self._ssh.get_transport().getpeername()} "
-                    f"took {time() - start} seconds: {self._ssh}"
-                )
-            except SSHException as exc:
-                raise IOError(f"Cannot connect to {node[u'host']}") from exc
-            except NoValidConnectionsError as err:
-                raise IOError(
-                    f"Unable to connect to port {node[u'port']} on "
-                    f"{node[u'host']}"
-                ) from err
+        self._ssh = ssh_pool.get(node, attempts)
 
     def disconnect(self, node=None):
         """Close SSH connection to the node.
@@ -120,13 +82,7 @@ class SSH:
             node = self._node
         if node is None:
             return
-        node_hash = self._node_hash(node)
-        if node_hash in SSH.__existing_connections:
-            logger.debug(
-                f"Disconnecting peer: {node[u'host']}, {node[u'port']}"
-            )
-            ssh = SSH.__existing_connections.pop(node_hash)
-            ssh.close()
+        ssh_pool.disconnect(node)
 
     def _reconnect(self, attempts=0):
         """Close the SSH connection and open it again.
@@ -157,8 +113,44 @@ class SSH:
         :rtype: tuple(int, str, str)
         :raises SSHTimeout: If command is not finished in timeout time.
         """
+        return self._exec(cmd, timeout, log_stdout_err)
+
+    @staticmethod
+    def _logical_command(cmd, sudo, cmd_input):
+        # The command as it's recorded, replayed and reported.
+        command = f"sudo -E -S {cmd}" if sudo else cmd
+        if cmd_input is not None:
+            command = f"{command} <<< \"{cmd_input}\""
+        return command
+
+    def _exec(self, cmd, timeout, log_stdout_err, sudo=False, cmd_input=None):
+        logical = self._logical_command(cmd, sudo, cmd_input)
+        remote = logical
+        sid_file = None
+        if timeout is not None and \
+                session_guard_supported(self._node, self._ssh.get_transport()):
+            # Run in its own remote session, so all of its processes, e.g. a
+            # stuck traffic generator, can be killed if it times out.
+            sid_file = new_sid_file()
+            remote = self._logical_command(
+                guard_command(cmd, timeout, sid_file), sudo, cmd_input)
+        queued = time()
+        with timeline.span(logical[:80], u"ssh", f"{self._node[u'host']}:{self._node[u'port']}",
+                           {u"cmd": logical}):
+            with ssh_pool.channel_slot(self._node):
+                return self._exec_command(logical, timeout, log_stdout_err, time() - queued,
+                                          remote, sid_file, sudo)
+
+    def _record_stats(self, cmd, wait, open_time, exec_time, stdout, stderr):
+        ssh_stats.record(self._node, cmd, wait, open_time, exec_time,
+                         len(stdout.encode(u"utf-8")) + len(stderr.encode(u"utf-8")),
+                         len(cmd.encode(u"utf-8")))
+
+    def _exec_command(self, cmd, timeout, log_stdout_err, wait, remote, sid_file, sudo):
+        # pylint: disable=too-many-arguments
         stdout = u""
         stderr = u""
+        opening = time()
         try:
             chan = self._ssh.get_transport().open_session(timeout=5)
             peer = self._ssh.get_transport().getpeername()
@@ -167,33 +159,45 @@ class SSH:
             chan = self._ssh.get_transport().open_session(timeout=5)
             peer = self._ssh.get_transport().getpeername()
         chan.settimeout(timeout)
+        open_time = time() - opening
 
         logger.trace(f"exec_command on {peer} with timeout {timeout}: {cmd}")
 
         start = time()
-        chan.exec_command(cmd)
-        while not chan.exit_status_ready() and timeout is not None:
-            if chan.recv_ready():
-                s_out = chan.recv(self.__MAX_RECV_BUF)
-                stdout += s_out.decode(encoding=u'utf-8', errors=u'ignore') \
-                    if isinstance(s_out, bytes) else s_out
-
-            if chan.recv_stderr_ready():
-                s_err = chan.recv_stderr(self.__MAX_RECV_BUF)
-                stderr += s_err.decode(encoding=u'utf-8', errors=u'ignore') \
-                    if isinstance(s_err, bytes) else s_err
-
-            if time() - start > timeout:
-                raise SSHTimeout(
-                    f"Timeout exception during execution of command: {cmd}\n"
-                    f"Current contents of stdout buffer: "
-                    f"{stdout}\n"
-                    f"Current contents of stderr buffer: "
-                    f"{stderr}\n"
-                )
-
-            sleep(0.1)
-        return_code = chan.recv_exit_status()
+        try:
+            chan.exec_command(remote)
+            while not chan.exit_status_ready() and timeout is not None:
+                if chan.recv_ready():
+                    s_out = chan.recv(self.__MAX_RECV_BUF)
+                    stdout += s_out.decode(encoding=u'utf-8', errors=u'ignore') \
+                        if isinstance(s_out, bytes) else s_out
+
+                if chan.recv_stderr_ready():
+                    s_err = chan.recv_stderr(self.__MAX_RECV_BUF)
+                    stderr += s_err.decode(encoding=u'utf-8', errors=u'ignore') \
+                        if isinstance(s_err, bytes) else s_err
+
+                if time() - start > timeout:
+                    self._record_stats(cmd, wait, open_time, time() - start, stdout, stderr)
+                    if ssh_recorder():
+                        ssh_recorder().record(self._node, cmd, None, stdout, stderr,
+                                              time() - start)
+                    raise SSHTimeout(
+                        f"Timeout exception during execution of command: {cmd}\n"
+                        f"Current contents of stdout buffer: "
+                        f"{stdout}\n"
+                        f"Current contents of stderr buffer: "
+                        f"{stderr}\n"
+                    )
+
+                sleep(0.1)
+            return_code = chan.recv_exit_status()
+        except BaseException:
+            # Timed out or cancelled, don't leave the command running remotely.
+            chan.close()
+            if sid_file:
+                kill_remote_session(self._ssh.get_transport(), sid_file, sudo)
+            raise
 
         # It's very importent to correclty drain out full stdout.
         # The old way is insufficient and easily causes partial stdout
@@ -220,6 +224,9 @@ class SSH:
 
         end = time()
         logger.trace(f"exec_command on {peer} took {end-start} seconds")
+        self._record_stats(cmd, wait, open_time, end - start, stdout, stderr)
+        if ssh_recorder():
+            ssh_recorder().record(self._node, cmd, return_code, stdout, stderr, end - start)
 
         logger.trace(f"return RC {return_code}")
         if log_stdout_err or int(return_code):
@@ -256,13 +263,7 @@ class SSH:
         >>> # Execute command with input (sudo -S cmd <<< 'input')
         >>> ssh.exec_command_sudo(u"vpp_api_test", u"dump_interface_table")
         """
-        if cmd_input is None:
-            command = f"sudo -E -S {cmd}"
-        else:
-            command = f"sudo -E -S {cmd} <<< \"{cmd_input}\""
-        return self.exec_command(
-            command, timeout, log_stdout_err=log_stdout_err
-        )
+        return self._exec(cmd, timeout, log_stdout_err, sudo=True, cmd_input=cmd_input)
 
     def exec_command_lxc(
             self, lxc_cmd, lxc_name, lxc_params=u"", sudo=True, timeout=30):
@@ -407,20 +408,121 @@ class SSH:
                 self._ssh.get_transport(), sanitize=lambda x: x,
                 socket_timeout=timeout
             )
-        start = time()
-        if not get:
-            scp.put(local_path, remote_path)
-        else:
-            scp.get(remote_path, local_path)
-        scp.close()
+        queued = time()
+        with ssh_pool.channel_slot(self._node):
+            start = time()
+            if not get:
+                scp.put(local_path, remote_path)
+            else:
+                scp.get(remote_path, local_path)
+            scp.close()
         end = time()
+        if get and not wildcard and ssh_recorder():
+            ssh_recorder().record_file(self._node, remote_path,
+                                       _local_file_path(local_path, remote_path), end - start)
+        local_size = os.path.getsize(local_path) if os.path.isfile(local_path) else 0
+        ssh_stats.record(self._node, f"scp {remote_path}", start - queued, 0, end - start,
+                         local_size if get else 0, 0 if get else local_size)
         logger.trace(f"SCP took {end-start} seconds")
 
 
+def _local_file_path(local_path, remote_path):
+    """Get the local file which a fetched remote file is saved as. """
+    if os.path.isdir(local_path):
+        return os.path.join(local_path, os.path.basename(remote_path))
+    return local_path
+
+
+class ReplaySSH(SSH):
+    """SSH which replays recorded results instead of connecting to nodes.
+    It's used to benchmark the suite itself, e.g. flow generation, output
+    parsing and topology building, without a live lab.
+    """
+
+    def __init__(self, replay_log):
+        super().__init__()
+        self._log = replay_log
+
+    def connect(self, node, attempts=5):
+        self._node = node
+
+    def disconnect(self, node=None):
+        pass
+
+    def _exec(self, cmd, timeout, log_stdout_err, sudo=False, cmd_input=None):
+        cmd = self._logical_command(cmd, sudo, cmd_input)
+        entry = self._log.lookup(self._node, cmd)
+        if self._log.speedup > 0:
+            sleep(entry[u"t"] / self._log.speedup)
+        logger.trace(f"replay exec_command on {self._node[u'host']}: {cmd}")
+        if entry[u"rc"] is None:
+            raise SSHTimeout(f"Timeout exception during execution of command: {cmd}\n"
+                             f"Current contents of stdout buffer: {entry[u'o']}\n"
+                             f"Current contents of stderr buffer: {entry[u'e']}\n")
+        return entry[u"rc"], entry[u"o"], entry[u"e"]
+
+    def interactive_terminal_open(self, time_out=45):
+        raise RuntimeError(u"Interactive terminal is not supported by SSH replay")
+
+    def scp(self, local_path, remote_path, get=False, timeout=30,
+            wildcard=False):
+        logger.trace(f"replay SCP {local_path} {remote_path} get={get}")
+        if not get:
+            return
+        entry = self._log.lookup(self._node, f"scp-get {remote_path}")
+        if self._log.speedup > 0:
+            sleep(entry[u"t"] / self._log.speedup)
+        with open(_local_file_path(local_path, remote_path), u"wb") as local_file:
+            local_file.write(b64decode(entry[u"f"]))
+
+
+def exec_cmd_batch(node, cmds, timeout=600, sudo=True, stop_on_error=False):
+    """Execute a batch of commands through the node's persistent shell session.
+
+    :param node: The node to execute commands on.
+    :param cmds: Commands to execute.
+    :param timeout: Timeout value in seconds of the whole batch. Default: 600.
+    :param sudo: Sudo privilege execution flag. Default: True.
+    :param stop_on_error: Skip the remaining commands after a failed one.
+    :type node: dict
+    :type cmds: list(str)
+    :type timeout: int
+    :type sudo: bool
+    :type stop_on_error: bool
+    :returns: RC, Stdout, Stderr of each executed command, (None, None, None)
+        for all of them if the session failed.
+    :rtype: list(tuple(int, str, str))
+    """
+    if node is None:
+        raise TypeError(u"Node parameter is None")
+    if not cmds:
+        return list()
+
+    agent = ssh_agent(node)
+    if agent:
+        return agent.exec_cmd_batch(cmds, timeout, sudo, stop_on_error)
+
+    if ssh_replay_log():
+        results = list()
+        for cmd in cmds:
+            result = exec_cmd(node, cmd, timeout, sudo)
+            results.append(result)
+            if stop_on_error and (result[0] is None or int(result[0]) != 0):
+                break
+        return results
+
+    try:
+        return ShellSession.get(node, sudo).exec_batch(cmds, timeout, stop_on_error)
+    except SSHException as err:
+        logger.error(repr(err))
+        return [(None, None, None)] * len(cmds)
+
+
 def exec_cmd(node, cmd, timeout=600, sudo=True, disconnect=False):
     """Convenience function to ssh/exec/return rc, out & err.
 
-    Returns (rc, stdout, stderr).
+    Returns (rc, stdout, stderr). The command runs through the node's agent
+    if it has one, see set_ssh_agent().
 
     :param node: The node to execute command on.
     :param cmd: Command to execute.
@@ -442,7 +544,11 @@ def exec_cmd(node, cmd, timeout=600, sudo=True, disconnect=False):
     if not cmd:
         raise ValueError(u"Empty command parameter")
 
-    ssh = SSH()
+    agent = ssh_agent(node)
+    if agent:
+        return agent.exec_cmd(cmd, timeout, sudo)
+
+    ssh = _new_ssh()
 
     try:
         ssh.connect(node)
@@ -498,7 +604,7 @@ def scp_node(
     :type disconnect: bool
     :raises RuntimeError: If SSH connection failed or SCP transfer failed.
     """
-    ssh = SSH()
+    ssh = _new_ssh()
 
     try:
         ssh.connect(node)
@@ -0,0 +1,304 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Thread-safe pool of SSH connections shared by all SSH users of a node."""
+
+import socket
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import StringIO
+from threading import BoundedSemaphore, Lock
+from time import time, sleep
+
+from paramiko import RSAKey, SSHClient, AutoAddPolicy
+from paramiko.ssh_exception import SSHException, NoValidConnectionsError
+from robot.api import logger
+
+from resources.libraries.python.sshtransport import ssh_transport_mode
+
+__all__ = [
+    u"SSHConnectionPool",
+    u"ssh_pool",
+]
+
+
+class _PoolEntry:
+    """Pooled connection of a node. """
+    def __init__(self, node, max_channels):
+        self.node = node
+        self.client = None
+        self.ever_connected = False
+        self.lock = Lock()
+        self.channels = BoundedSemaphore(max_channels)
+        self.in_use = 0
+        self.pinned = 0
+        self.last_used = 0
+        self.guest = bool(node.get(u"guest", False))
+
+
+class SSHConnectionPool:
+    """Thread-safe pool of SSH connections keyed by (host, port).
+
+    Each node has one transport, and the number of concurrent channels on
+    it is bounded by a semaphore. A connection idle for more than
+    PROBE_INTERVAL seconds is probed before reuse, and a lost connection is
+    re-established with exponential backoff. Idle guest connections are
+    evicted in LRU order when there are too many of them, except the ones
+    pinned by long-lived channels, i.e. shell sessions, agents and streams.
+
+    A node with 'jump' is connected through a direct-tcpip channel over the
+    pooled transport of its jump node instead of a new TCP connection.
+    """
+
+    # sshd MaxSessions defaults to 10, leave room for long-lived channels,
+    # i.e. shell sessions and agents.
+    MAX_CHANNELS_PER_NODE = 8
+    MAX_GUEST_CONNECTIONS = 32
+    PROBE_INTERVAL = 30
+    RECONNECT_BACKOFF = 0.5
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _key(node):
+        return (node[u"host"], node[u"port"])
+
+    def _entry(self, node):
+        key = self._key(node)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _PoolEntry(node, SSHConnectionPool.MAX_CHANNELS_PER_NODE)
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            return entry
+
+    @staticmethod
+    def _alive(entry):
+        if entry.client is None:
+            return False
+        transport = entry.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if time() - entry.last_used < SSHConnectionPool.PROBE_INTERVAL:
+            return True
+        # Liveness probe by a round trip to the server
+        try:
+            transport.open_session(timeout=5).close()
+        except (SSHException, socket.error):
+            return False
+        return True
+
+    def _jump_sock(self, node):
+        """Open a direct-tcpip channel to the node's port on the loopback
+        of its jump host, e.g. QEMU hostfwd port of a guest on a SUT.
+        """
+        jump = self.get(node[u"jump"])
+        try:
+            return jump.get_transport().open_channel(
+                u"direct-tcpip", (u"127.0.0.1", int(node[u"port"])),
+                (u"127.0.0.1", 0), timeout=5)
+        except (SSHException, socket.error) as err:
+            raise IOError(f"Unable to open channel to port {node[u'port']} "
+                          f"via {node[u'host']}") from err
+
+    def _open(self, node):
+        start = time()
+        pkey = None
+        if u"priv_key" in node:
+            pkey = RSAKey.from_private_key(StringIO(node[u"priv_key"]))
+
+        sock = None
+        if node.get(u"jump"):
+            sock = self._jump_sock(node)
+
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        try:
+            client.connect(
+                node[u"host"], username=node[u"username"],
+                password=node.get(u"password"), pkey=pkey,
+                port=node[u"port"], sock=sock
+            )
+        except SSHException as exc:
+            raise IOError(f"Cannot connect to {node[u'host']}") from exc
+        except NoValidConnectionsError as err:
+            raise IOError(
+                f"Unable to connect to port {node[u'port']} on "
+                f"{node[u'host']}"
+            ) from err
+
+        client.get_transport().set_keepalive(10)
+        logger.debug(
+            f"New SSH to {client.get_transport().getpeername()} "
+            f"took {time() - start} seconds: {client}"
+        )
+        return client
+
+    def get(self, node, attempts=5):
+        """Get the connection of a node, connect it if needed.
+
+        The first connection to a node is tried only once, e.g. polling a
+        booting VM should fail fast. A lost connection is re-established
+        with up to 'attempts' retries with exponential backoff.
+
+        :param node: Node in topology.
+        :param attempts: Number of reconnect attempts.
+        :type node: dict
+        :type attempts: int
+        :returns: Connected SSH client.
+        :rtype: SSHClient obj
+        :raises IOError: If cannot connect to host.
+        """
+        entry = self._entry(node)
+        with entry.lock:
+            if self._alive(entry):
+                logger.debug(f"Reusing SSH: {entry.client}")
+            else:
+                if entry.client:
+                    entry.client.close()
+                    entry.client = None
+                tries = attempts + 1 if entry.ever_connected else 1
+                backoff = SSHConnectionPool.RECONNECT_BACKOFF
+                for attempt in range(tries):
+                    try:
+                        entry.client = self._open(node)
+                        break
+                    except IOError:
+                        if attempt == tries - 1:
+                            raise
+                        logger.debug(f"Reconnect {node[u'host']}:{node[u'port']} "
+                                     f"in {backoff} seconds")
+                        sleep(backoff)
+                        backoff *= 2
+                entry.ever_connected = True
+            entry.last_used = time()
+            client = entry.client
+        self._evict()
+        return client
+
+    @contextmanager
+    def channel_slot(self, node):
+        """Context of using a channel of a node's connection, it blocks
+        while the node already has MAX_CHANNELS_PER_NODE channels.
+
+        :param node: Node in topology.
+        :type node: dict
+        """
+        entry = self._entry(node)
+        with entry.channels:
+            with self._lock:
+                entry.in_use += 1
+            try:
+                yield
+            finally:
+                with self._lock:
+                    entry.in_use -= 1
+                    entry.last_used = time()
+
+    def pin(self, node):
+        """Get the connection of a node for a long-lived channel, which
+        doesn't hold a channel slot. The connection is not evicted until
+        it's unpinned.
+
+        :param node: Node in topology.
+        :type node: dict
+        :returns: Connected SSH client.
+        :rtype: SSHClient obj
+        :raises IOError: If cannot connect to host.
+        """
+        entry = self._entry(node)
+        with self._lock:
+            entry.pinned += 1
+        try:
+            return self.get(node)
+        except IOError:
+            self.unpin(node)
+            raise
+
+    def unpin(self, node):
+        """Release a connection pinned by pin().
+
+        :param node: Node in topology.
+        :type node: dict
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(node))
+            if entry and entry.pinned:
+                entry.pinned -= 1
+
+    def disconnect(self, node):
+        """Close the connection of a node. The pool entry and its channel
+        semaphore are kept, so channels in flight still count against the cap.
+
+        :param node: Node in topology.
+        :type node: dict
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(node))
+        if entry is None:
+            return
+        with entry.lock:
+            client, entry.client = entry.client, None
+            # A reconnect is tried only once as the first connection,
+            # e.g. the node is a VM being rebooted.
+            entry.ever_connected = False
+        if client:
+            logger.debug(f"Disconnecting peer: {node[u'host']}, {node[u'port']}")
+            client.close()
+
+    def _evict(self):
+        with self._lock:
+            guests = [entry for entry in self._entries.values()
+                      if entry.guest and entry.client]
+            # 'guests' is in LRU order
+            candidates = guests[:max(0, len(guests) - SSHConnectionPool.MAX_GUEST_CONNECTIONS)]
+        for entry in candidates:
+            with entry.lock:
+                with self._lock:
+                    if entry.in_use or entry.pinned or entry.client is None:
+                        continue
+                    client, entry.client = entry.client, None
+            logger.debug(f"Evict idle SSH: {entry.node[u'host']}:{entry.node[u'port']}")
+            client.close()
+
+    def prewarm(self, nodes):
+        """Connect to nodes in parallel.
+
+        :param nodes: Nodes in topology.
+        :type nodes: list(dict)
+        """
+        if ssh_transport_mode() == u"replay" or not nodes:
+            return
+        start = time()
+        with ThreadPoolExecutor(max_workers=min(16, len(nodes))) as executor:
+            for node, result in zip(nodes, executor.map(self._try_get, nodes)):
+                if result:
+                    logger.warn(f"Prewarm SSH to {node[u'host']}:{node[u'port']} "
+                                f"failed: {result}")
+        logger.debug(f"Prewarm {len(nodes)} SSH connections took {time() - start} seconds")
+
+    def _try_get(self, node):
+        try:
+            self.get(node)
+        except IOError as err:
+            return err
+        return None
+
+
+ssh_pool = SSHConnectionPool()
@@ -0,0 +1,381 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Remote sessions of SSH commands.
+
+A guarded command runs as the leader of its own remote session, so all of
+its processes can be killed if it times out or it's left behind. Long-lived
+channels of a node's pooled connection are persistent shell sessions which
+execute batches of commands, and streams of long-running commands whose
+output is read by the caller.
+"""
+
+import socket
+
+from shlex import quote
+from threading import Lock
+from time import time, sleep
+from uuid import uuid4
+
+from paramiko.ssh_exception import SSHException
+from robot.api import logger
+
+from resources.libraries.python.sshpool import ssh_pool
+from resources.libraries.python.sshstats import ssh_stats
+from resources.libraries.python.sshtransport import SSHTimeout, ssh_recorder, ssh_replay_log
+
+__all__ = [
+    u"new_sid_file",
+    u"session_guard_supported",
+    u"guard_command",
+    u"kill_remote_session",
+    u"ShellSession",
+    u"open_stream",
+    u"close_stream",
+]
+
+
+# Seconds the remote watchdog waits after the local timeout, so the local
+# side normally times out first and kills the session itself.
+_REMOTE_TIMEOUT_GRACE = 5
+
+# A node supports guard_command() if it has util-linux 'setsid -w' and
+# 'pgrep/pkill -s', which e.g. busybox based guests might not have.
+_GUARD_PROBE = u"setsid -w true && pgrep -s 0 . >/dev/null && command -v pkill >/dev/null"
+_GUARD_SUPPORT = dict()
+_GUARD_SUPPORT_LOCK = Lock()
+
+def new_sid_file():
+    """Get a new remote path to save the id of a guarded session.
+
+    :returns: Remote path.
+    :rtype: str
+    """
+    return f"/tmp/cne-{uuid4().hex}.sid"
+
+
+def session_guard_supported(node, transport):
+    """Whether commands on a node can be run in their own remote session by
+    guard_command(). It's probed once per node by a round trip of the
+    transport, and commands are executed as they are if it's not supported.
+
+    :param node: Node in topology.
+    :param transport: Connected transport of the node.
+    :type node: dict
+    :type transport: Transport obj
+    :returns: True if it's supported.
+    :rtype: bool
+    """
+    key = (node[u"host"], node[u"port"])
+    with _GUARD_SUPPORT_LOCK:
+        supported = _GUARD_SUPPORT.get(key)
+    if supported is not None:
+        return supported
+    try:
+        chan = transport.open_session(timeout=5)
+        chan.exec_command(_GUARD_PROBE)
+        start = time()
+        while not chan.exit_status_ready() and time() - start < 10:
+            sleep(0.05)
+        supported = chan.exit_status_ready() and chan.recv_exit_status() == 0
+        chan.close()
+    except (AttributeError, SSHException, socket.error) as err:
+        # Not cached, it's probed again on next command.
+        logger.debug(f"Probe session guard on {node[u'host']}:{node[u'port']} failed: {err}")
+        return False
+    if not supported:
+        logger.debug(f"No setsid/pkill on {node[u'host']}:{node[u'port']}, "
+                     f"timed out commands are not killed remotely")
+    with _GUARD_SUPPORT_LOCK:
+        _GUARD_SUPPORT[key] = supported
+    return supported
+
+
+def guard_command(cmd, timeout, sid_file):
+    """Wrap a command into a new remote session whose id is saved into
+    sid_file, and which is killed as a whole by a watchdog if the command
+    doesn't finish in timeout plus grace seconds.
+
+    :param cmd: Command to guard.
+    :param timeout: Timeout value in seconds of the command.
+    :param sid_file: Remote path to save the session id, see new_sid_file().
+    :type cmd: str
+    :type timeout: int
+    :type sid_file: str
+    :returns: Guarded command.
+    :rtype: str
+    """
+    script = (f"echo $$ >{sid_file}; "
+              f"(sleep {int(timeout) + _REMOTE_TIMEOUT_GRACE} && pkill -KILL -s $$) "
+              f"</dev/null >/dev/null 2>&1 & "
+              f"__wd=$!; sh -c {quote(cmd)}; __rc=$?; "
+              f"pkill -KILL -P $__wd; rm -f {sid_file}; exit $__rc")
+    return f"setsid -w sh -c {quote(script)}"
+
+
+def kill_remote_session(transport, sid_file, sudo):
+    """Kill all processes of a remote session created by guard_command(),
+    through a new channel of the same transport.
+
+    :param transport: Transport the session was created through.
+    :param sid_file: Remote path of the session id, nothing is killed if
+        it's None.
+    :param sudo: Kill with sudo privilege.
+    :type transport: Transport obj
+    :type sid_file: str
+    :type sudo: bool
+    """
+    if sid_file is None:
+        return
+    script = f"[ -s {sid_file} ] && pkill -KILL -s $(cat {sid_file}); rm -f {sid_file}"
+    cmd = f"sh -c {quote(script)}"
+    if sudo:
+        cmd = f"sudo -E -S {cmd}"
+    try:
+        chan = transport.open_session(timeout=5)
+        chan.exec_command(cmd)
+        start = time()
+        while not chan.exit_status_ready() and time() - start < 10:
+            sleep(0.05)
+        chan.close()
+    except (AttributeError, SSHException, socket.error) as err:
+        logger.warn(f"Failed to kill remote session {sid_file}: {err}")
+
+
+class ShellSession:
+    """A persistent remote shell on a node which executes batches of commands.
+
+    A batch is sent by one write, each command runs in a subshell with stdin
+    from /dev/null, and its stdout/stderr/rc are framed by unique markers on
+    both streams, so a batch takes one round trip instead of one channel
+    per command.
+    """
+
+    __MAX_RECV_BUF = 10 * 1024 * 1024
+    __sessions = dict()
+    __sessions_lock = Lock()
+
+    def __init__(self, node, sudo=True):
+        self._node = node
+        self._sudo = sudo
+        self._chan = None
+        self._sid_file = None
+        self.lock = Lock()
+
+    @staticmethod
+    def get(node, sudo=True):
+        """Get the session of a node, create it if not existing.
+
+        :param node: Node in topology.
+        :param sudo: Run the shell with sudo privilege.
+        :type node: dict
+        :type sudo: bool
+        :returns: Shell session.
+        :rtype: ShellSession obj
+        """
+        key = (node[u"host"], node[u"port"], sudo)
+        with ShellSession.__sessions_lock:
+            if key not in ShellSession.__sessions:
+                ShellSession.__sessions[key] = ShellSession(node, sudo)
+            return ShellSession.__sessions[key]
+
+    def _open(self):
+        self.close()
+        client = ssh_pool.pin(self._node)
+        try:
+            chan = client.get_transport().open_session(timeout=5)
+        except (SSHException, socket.error):
+            ssh_pool.unpin(self._node)
+            raise
+        # The shell is a session leader, so commands left running by a
+        # timed out batch can be killed together with it.
+        cmd = u"sh"
+        self._sid_file = None
+        if session_guard_supported(self._node, client.get_transport()):
+            self._sid_file = new_sid_file()
+            script = f"echo $$ >{self._sid_file}; sh; rm -f {self._sid_file}"
+            cmd = f"setsid -w sh -c {quote(script)}"
+        chan.exec_command(f"sudo -E -S {cmd}" if self._sudo else cmd)
+        self._chan = chan
+        logger.trace(f"Open shell session on {self._node[u'host']}:{self._node[u'port']}")
+
+    def close(self):
+        """Close the session, it will be reopened on next use. """
+        if self._chan:
+            self._chan.close()
+            self._chan = None
+            ssh_pool.unpin(self._node)
+
+    @staticmethod
+    def _script(cmds, marker, stop_on_error):
+        lines = [u"__stop=0"]
+        for idx, cmd in enumerate(cmds):
+            lines.append(u"if [ $__stop -eq 0 ]; then")
+            lines.append(f"printf '{marker}:B:{idx}\\n'; printf '{marker}:B:{idx}\\n' >&2")
+            lines.append(f"( {cmd}\n) </dev/null")
+            lines.append(u"__rc=$?")
+            lines.append(f"printf '\\n{marker}:E:{idx}:%d\\n' $__rc; "
+                         f"printf '\\n{marker}:E:{idx}\\n' >&2")
+            if stop_on_error:
+                lines.append(u"[ $__rc -eq 0 ] || __stop=1")
+            lines.append(u"fi")
+        lines.append(f"printf '{marker}:Z\\n'; printf '{marker}:Z\\n' >&2")
+        return u"\n".join(lines) + u"\n"
+
+    @staticmethod
+    def _parse(stdout, stderr, n_cmds, marker):
+        results = list()
+        for idx in range(n_cmds):
+            begin = f"{marker}:B:{idx}\n"
+            out_start = stdout.find(begin)
+            if out_start == -1:
+                # Skipped by stop_on_error
+                break
+            out_start += len(begin)
+            out_end = stdout.index(f"\n{marker}:E:{idx}:", out_start)
+            rc_start = out_end + len(f"\n{marker}:E:{idx}:")
+            ret_code = int(stdout[rc_start:stdout.index(u"\n", rc_start)])
+
+            err_start = stderr.index(begin) + len(begin)
+            err_end = stderr.index(f"\n{marker}:E:{idx}\n", err_start)
+            results.append((ret_code, stdout[out_start:out_end], stderr[err_start:err_end]))
+        return results
+
+    def exec_batch(self, cmds, timeout=600, stop_on_error=False):
+        """Execute a batch of commands in the session.
+
+        :param cmds: Commands to be executed.
+        :param timeout: Timeout value in seconds of the whole batch.
+        :param stop_on_error: Skip the remaining commands after a failed one.
+        :type cmds: list(str)
+        :type timeout: int
+        :type stop_on_error: bool
+        :returns: RC, Stdout, Stderr of each executed command.
+        :rtype: list(tuple(int, str, str))
+        :raises SSHTimeout: If the batch is not finished in timeout time.
+        """
+        marker = f"__CNE_{uuid4().hex}"
+        script = self._script(cmds, marker, stop_on_error)
+        end_marker = f"{marker}:Z\n"
+        with self.lock:
+            if not self._chan or self._chan.closed or self._chan.exit_status_ready():
+                self._open()
+            try:
+                self._chan.sendall(script)
+            except (socket.error, SSHException):
+                # Nothing is executed if the stale session cannot be written
+                self.close()
+                self._open()
+                self._chan.sendall(script)
+
+            stdout = u""
+            stderr = u""
+            start = time()
+            while not (stdout.endswith(end_marker) and stderr.endswith(end_marker)):
+                if self._chan.recv_ready():
+                    stdout += self._chan.recv(self.__MAX_RECV_BUF).decode(
+                        encoding=u'utf-8', errors=u'ignore')
+                elif self._chan.recv_stderr_ready():
+                    stderr += self._chan.recv_stderr(self.__MAX_RECV_BUF).decode(
+                        encoding=u'utf-8', errors=u'ignore')
+                elif self._chan.exit_status_ready():
+                    self.close()
+                    raise SSHException(f"Shell session exited on {self._node[u'host']}")
+                elif time() - start > timeout:
+                    # The session is in unknown state, don't reuse it.
+                    transport = self._chan.get_transport()
+                    self.close()
+                    kill_remote_session(transport, self._sid_file, self._sudo)
+                    raise SSHTimeout(
+                        f"Timeout exception during execution of batch: {cmds}\n"
+                        f"Current contents of stdout buffer: {stdout}\n"
+                        f"Current contents of stderr buffer: {stderr}\n"
+                    )
+                else:
+                    sleep(0.005)
+            duration = time() - start
+
+        results = self._parse(stdout, stderr, len(cmds), marker)
+        logger.trace(f"exec_batch on {self._node[u'host']} took {duration} seconds")
+        recorder = ssh_recorder()
+        for cmd, (ret_code, s_out, s_err) in zip(cmds, results):
+            ssh_stats.record(self._node, cmd, 0, 0, duration / len(results),
+                             len(s_out.encode(u"utf-8")) + len(s_err.encode(u"utf-8")),
+                             len(cmd.encode(u"utf-8")))
+            logger.trace(f"batch cmd: {cmd}\nreturn RC {ret_code}")
+            if ret_code:
+                logger.trace(f"return STDOUT {s_out}")
+                logger.trace(f"return STDERR {s_err}")
+            if recorder:
+                # Record each command as exec_cmd() does, so it can be replayed.
+                rec_cmd = f"sudo -E -S {cmd}" if self._sudo else cmd
+                recorder.record(self._node, rec_cmd, ret_code, s_out, s_err,
+                                duration / len(results))
+        return results
+
+
+def open_stream(node, cmd, timeout=3600, sudo=True):
+    """Start a long-running command on a dedicated channel of the node's
+    pooled connection, its output is read from the channel by the caller.
+
+    The command runs as a session leader under a watchdog, so it's killed
+    as a whole by close_stream(), or after timeout if it's left behind.
+    The connection is pinned in the pool until the stream is closed.
+
+    :param node: The node to execute command on.
+    :param cmd: Command to execute.
+    :param timeout: Seconds after which the remote command is killed.
+    :param sudo: Sudo privilege execution flag.
+    :type node: dict
+    :type cmd: str
+    :type timeout: int
+    :type sudo: bool
+    :returns: Channel, the session id file and the node, None if it's
+        replayed.
+    :rtype: tuple(Channel obj, str, dict)
+    """
+    if ssh_replay_log():
+        return None
+    client = ssh_pool.pin(node)
+    sid_file = None
+    if session_guard_supported(node, client.get_transport()):
+        sid_file = new_sid_file()
+        cmd = guard_command(cmd, timeout, sid_file)
+    try:
+        chan = client.get_transport().open_session(timeout=5)
+        chan.exec_command(f"sudo -E -S {cmd}" if sudo else cmd)
+    except (SSHException, socket.error):
+        ssh_pool.unpin(node)
+        raise
+    logger.trace(f"Open stream on {node[u'host']}:{node[u'port']}: {cmd}")
+    return chan, sid_file, node
+
+
+def close_stream(stream, sudo=True):
+    """Close a stream of open_stream() and kill its remote command.
+
+    :param stream: Channel, the session id file and the node.
+    :param sudo: Sudo privilege execution flag, as the stream was opened.
+    :type stream: tuple(Channel obj, str, dict)
+    :type sudo: bool
+    """
+    if stream is None:
+        return
+    chan, sid_file, node = stream
+    transport = chan.get_transport()
+    chan.close()
+    try:
+        kill_remote_session(transport, sid_file, sudo)
+    finally:
+        ssh_pool.unpin(node)
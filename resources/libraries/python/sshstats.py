@@ -0,0 +1,216 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Latency and throughput statistics of commands executed by the SSH layer."""
+
+import json
+import os
+import re
+
+from threading import Lock
+
+from robot.api import logger
+from robot.libraries.BuiltIn import BuiltIn, RobotNotRunningError
+
+__all__ = [
+    u"SSHStatistics",
+    u"ssh_stats",
+    u"classify_command",
+    u"dump_ssh_statistics",
+]
+
+# Upper bounds in seconds of histogram buckets, the last bucket is unbounded.
+_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+_CMD_MAX_LEN = 200
+
+_PREFIX_RE = re.compile(r"^(sudo\s+(-\S+\s+)*|ip\s+netns\s+exec\s+\S+\s+|env\s+(\S+=\S+\s+)*)")
+
+def classify_command(node, cmd):
+    """Classify a command for aggregation, e.g. 'ovs-vsctl', 'ovs-ofctl',
+    'ip' or 'guest' for all commands executed in guests.
+
+    :param node: Node the command is executed on.
+    :param cmd: Command.
+    :type node: dict
+    :type cmd: str
+    :returns: Command class.
+    :rtype: str
+    """
+    if node.get(u"guest"):
+        return u"guest"
+    cmd = cmd.strip()
+    while True:
+        match = _PREFIX_RE.match(cmd)
+        if not match:
+            break
+        cmd = cmd[match.end():]
+    if not cmd:
+        return u"other"
+    return os.path.basename(cmd.split()[0])
+
+
+class _Aggregate:
+    """Aggregated statistics of a command class. """
+    def __init__(self):
+        self.count = 0
+        self.wait = 0.0
+        self.open = 0.0
+        self.exec = 0.0
+        self.max_exec = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.histogram = [0] * (len(_BUCKETS) + 1)
+
+    def add(self, record):
+        """Add a command record. """
+        self.count += 1
+        self.wait += record[u"wait"]
+        self.open += record[u"open"]
+        self.exec += record[u"exec"]
+        self.max_exec = max(self.max_exec, record[u"exec"])
+        self.bytes_in += record[u"bytes_in"]
+        self.bytes_out += record[u"bytes_out"]
+        idx = 0
+        while idx < len(_BUCKETS) and record[u"exec"] > _BUCKETS[idx]:
+            idx += 1
+        self.histogram[idx] += 1
+
+    def to_dict(self):
+        """Convert to a JSON serializable dict. """
+        return {
+            u"count": self.count,
+            u"wait": round(self.wait, 3),
+            u"open": round(self.open, 3),
+            u"exec": round(self.exec, 3),
+            u"mean_exec": round(self.exec / self.count, 4) if self.count else 0,
+            u"max_exec": round(self.max_exec, 4),
+            u"bytes_in": self.bytes_in,
+            u"bytes_out": self.bytes_out,
+            u"histogram": dict(zip([f"<={b}" for b in _BUCKETS] + [f">{_BUCKETS[-1]}"],
+                                   self.histogram)),
+        }
+
+
+class SSHStatistics:
+    """Collects per command statistics: node, command class, queue wait
+    for a channel, channel open time, execution time, bytes in and out.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._records = list()
+
+    def record(self, node, cmd, wait, open_time, exec_time, bytes_in, bytes_out):
+        """Record an executed command.
+
+        :param node: Node the command is executed on.
+        :param cmd: Command.
+        :param wait: Seconds waiting for a free channel of the node.
+        :param open_time: Seconds opening the channel.
+        :param exec_time: Seconds executing the command.
+        :param bytes_in: Bytes received, i.e. stdout and stderr.
+        :param bytes_out: Bytes sent.
+        :type node: dict
+        :type cmd: str
+        :type wait: float
+        :type open_time: float
+        :type exec_time: float
+        :type bytes_in: int
+        :type bytes_out: int
+        """
+        record = {
+            u"node": f"{node[u'host']}:{node[u'port']}",
+            u"class": classify_command(node, cmd),
+            u"cmd": cmd[:_CMD_MAX_LEN],
+            u"wait": wait,
+            u"open": open_time,
+            u"exec": exec_time,
+            u"bytes_in": bytes_in,
+            u"bytes_out": bytes_out,
+        }
+        with self._lock:
+            self._records.append(record)
+
+    def reset(self):
+        """Drop all the records. """
+        with self._lock:
+            self._records = list()
+
+    def summary(self):
+        """Aggregate records by command class and by node.
+
+        :returns: Aggregated statistics.
+        :rtype: dict
+        """
+        by_class = dict()
+        by_node = dict()
+        with self._lock:
+            records = list(self._records)
+        for record in records:
+            by_class.setdefault(record[u"class"], _Aggregate()).add(record)
+            by_node.setdefault(record[u"node"], _Aggregate()).add(record)
+        return {
+            u"by_class": {k: v.to_dict() for k, v in sorted(by_class.items())},
+            u"by_node": {k: v.to_dict() for k, v in sorted(by_node.items())},
+        }
+
+    def top(self, top_n=20):
+        """Get the slowest commands.
+
+        :param top_n: Number of commands.
+        :type top_n: int
+        :returns: Records of the slowest commands.
+        :rtype: list(dict)
+        """
+        with self._lock:
+            records = list(self._records)
+        return sorted(records, key=lambda r: r[u"exec"], reverse=True)[:int(top_n)]
+
+    def dump(self, path, top_n=20):
+        """Dump the summary and the slowest commands as JSON.
+
+        :param path: File path.
+        :param top_n: Number of the slowest commands.
+        :type path: str
+        :type top_n: int
+        """
+        with open(path, u"w") as dump_file:
+            json.dump({u"summary": self.summary(), u"top": self.top(top_n)},
+                      dump_file, indent=2)
+
+
+ssh_stats = SSHStatistics()
+
+def dump_ssh_statistics(path=None, top_n=20):
+    """Dump SSH statistics as JSON and log the slowest commands.
+
+    :param path: File path, default is 'ssh_stats.json' in robot output dir.
+    :param top_n: Number of the slowest commands to flag.
+    :type path: str
+    :type top_n: int
+    """
+    if not path:
+        try:
+            out_dir = BuiltIn().get_variable_value(u"${OUTPUT DIR}", u".")
+        except RobotNotRunningError:
+            out_dir = u"."
+        path = os.path.join(out_dir, u"ssh_stats.json")
+    ssh_stats.dump(path, top_n)
+
+    for name, agg in ssh_stats.summary()[u"by_class"].items():
+        logger.info(f"{name}: {agg[u'count']} cmds, exec {agg[u'exec']} s, "
+                    f"wait {agg[u'wait']} s, open {agg[u'open']} s")
+    for record in ssh_stats.top(top_n):
+        logger.info(f"slow cmd {record[u'exec']:.3f} s on {record[u'node']}: {record[u'cmd']}")
+    logger.info(f"SSH statistics dumped to {path}")
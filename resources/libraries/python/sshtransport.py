@@ -0,0 +1,259 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Transport under SSH commands: commands are executed through SSH, also
+recorded into a log, replayed from a log without any connection, or run by
+the remote agent of a node.
+"""
+
+import atexit
+import gzip
+import json
+
+from base64 import b64encode
+from collections import deque
+from threading import Lock
+
+from robot.libraries.BuiltIn import BuiltIn, RobotNotRunningError
+
+__all__ = [
+    u"SSHTimeout", u"SSHRecorder", u"SSHReplayLog", u"set_ssh_transport",
+    u"set_ssh_agent", u"ssh_transport_mode", u"ssh_recorder", u"ssh_replay_log",
+    u"ssh_agent",
+]
+
+
+class SSHTimeout(Exception):
+    """This exception is raised when a timeout occurs."""
+
+
+def _open_log(path, mode):
+    if path.endswith(u".gz"):
+        return gzip.open(path, f"{mode}t", encoding=u"utf-8")
+    return open(path, mode, encoding=u"utf-8")
+
+
+class SSHRecorder:
+    """Records executed commands into a JSON lines log.
+
+    Each line is a command with its result and execution time,
+    {"h": host, "p": port, "c": cmd, "rc": rc, "o": stdout, "e": stderr,
+    "t": seconds}. A timed out command is recorded with "rc" as null.
+    A fetched file is recorded as command "scp-get <remote path>" with its
+    content base64 encoded in "f".
+    The log is gzip compressed if the path ends with ".gz", it's closed at
+    interpreter exit, so an aborted run still leaves a complete gzip stream.
+    """
+
+    def __init__(self, path):
+        self._lock = Lock()
+        self._file = _open_log(path, u"w")
+        atexit.register(self.close)
+
+    def _write(self, entry):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(json.dumps(entry, separators=(u",", u":")) + u"\n")
+            self._file.flush()
+
+    def record(self, node, cmd, ret_code, stdout, stderr, duration):
+        """Append a command and its result to the log.
+
+        :param node: Node the command is executed on.
+        :param cmd: Executed command.
+        :param ret_code: Return code, None for a timed out command.
+        :param stdout: Command stdout.
+        :param stderr: Command stderr.
+        :param duration: Command execution time in seconds.
+        :type node: dict
+        :type cmd: str
+        :type ret_code: int
+        :type stdout: str
+        :type stderr: str
+        :type duration: float
+        """
+        self._write({u"h": node[u"host"], u"p": node[u"port"], u"c": cmd,
+                     u"rc": ret_code, u"o": stdout, u"e": stderr,
+                     u"t": round(duration, 4)})
+
+    def record_file(self, node, remote_path, local_path, duration):
+        """Append a fetched file and its content to the log.
+
+        :param node: Node the file is fetched from.
+        :param remote_path: Remote path of the file.
+        :param local_path: Local path the file is saved to.
+        :param duration: Transfer time in seconds.
+        :type node: dict
+        :type remote_path: str
+        :type local_path: str
+        :type duration: float
+        """
+        with open(local_path, u"rb") as local_file:
+            content = b64encode(local_file.read()).decode(u"ascii")
+        self._write({u"h": node[u"host"], u"p": node[u"port"],
+                     u"c": f"scp-get {remote_path}", u"rc": 0, u"o": u"", u"e": u"",
+                     u"f": content, u"t": round(duration, 4)})
+
+    def close(self):
+        """Close the log, it's safe to be called more than once. """
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class SSHReplayLog:
+    """Recorded results which are indexed by (host, port, cmd).
+
+    Results of the same command are replayed in the recorded order,
+    and the last one is repeated once they are used up, e.g. by a
+    polling loop which iterates more times than it was recorded.
+    """
+
+    def __init__(self, path, speedup=1.0):
+        self.speedup = float(speedup)
+        self._lock = Lock()
+        self._entries = dict()
+        with _open_log(path, u"r") as log_file:
+            for line in log_file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = (entry[u"h"], entry[u"p"], entry[u"c"])
+                self._entries.setdefault(key, deque()).append(entry)
+
+    def lookup(self, node, cmd):
+        """Get next recorded result of a command.
+
+        :param node: Node the command is executed on.
+        :param cmd: Command.
+        :type node: dict
+        :type cmd: str
+        :returns: Recorded entry.
+        :rtype: dict
+        :raises RuntimeError: If the command was not recorded.
+        """
+        key = (node[u"host"], node[u"port"], cmd)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise RuntimeError(f"No recorded result on {node[u'host']} for: {cmd}")
+            if len(entries) > 1:
+                return entries.popleft()
+            return entries[0]
+
+
+class _Transport:
+    """Record/replay configuration which is loaded once from robot variables
+    "${SSH_RECORD}", "${SSH_REPLAY}" and "${SSH_REPLAY_SPEEDUP}", and the
+    lookup of node agents.
+    """
+    loaded = False
+    recorder = None
+    replay = None
+    agent = None
+
+
+def set_ssh_transport(record=None, replay=None, speedup=1.0):
+    """Select the transport under exec_cmd()/scp_node().
+
+    By default commands are executed through SSH. With 'record', each
+    command is still executed through SSH, and also recorded into the log.
+    With 'replay', no connection is made at all, results are replayed from
+    the log, and the recorded execution time is compressed by 'speedup',
+    0 means not waiting at all.
+
+    :param record: Path of the log to record into.
+    :param replay: Path of the log to replay from.
+    :param speedup: Time compression factor of replay.
+    :type record: str
+    :type replay: str
+    :type speedup: float
+    """
+    if record and replay:
+        raise RuntimeError(u"Cannot record and replay SSH at the same time")
+    if _Transport.recorder:
+        _Transport.recorder.close()
+    _Transport.recorder = SSHRecorder(record) if record else None
+    _Transport.replay = SSHReplayLog(replay, speedup) if replay else None
+    _Transport.loaded = True
+
+
+def set_ssh_agent(get_agent):
+    """Run commands of exec_cmd()/exec_cmd_batch() by the remote agent of
+    a node which has one, see agent.get_agent().
+
+    :param get_agent: Function which gets the agent of a node, or None if
+        the node doesn't use an agent.
+    :type get_agent: callable
+    """
+    _Transport.agent = get_agent
+
+
+def _load_transport():
+    if _Transport.loaded:
+        return
+    try:
+        builtin = BuiltIn()
+        record = builtin.get_variable_value(u"${SSH_RECORD}")
+        replay = builtin.get_variable_value(u"${SSH_REPLAY}")
+        speedup = builtin.get_variable_value(u"${SSH_REPLAY_SPEEDUP}", 1.0)
+    except RobotNotRunningError:
+        record, replay, speedup = None, None, 1.0
+    set_ssh_transport(record, replay, speedup)
+
+
+def ssh_transport_mode():
+    """Get current transport mode.
+
+    :returns: 'ssh', 'record' or 'replay'.
+    :rtype: str
+    """
+    _load_transport()
+    if _Transport.replay:
+        return u"replay"
+    if _Transport.recorder:
+        return u"record"
+    return u"ssh"
+
+
+def ssh_recorder():
+    """Get the recorder of executed commands.
+
+    :returns: Recorder, None if commands are not recorded.
+    :rtype: SSHRecorder obj
+    """
+    _load_transport()
+    return _Transport.recorder
+
+
+def ssh_replay_log():
+    """Get the log which commands are replayed from.
+
+    :returns: Replay log, None if commands are not replayed.
+    :rtype: SSHReplayLog obj
+    """
+    _load_transport()
+    return _Transport.replay
+
+
+def ssh_agent(node):
+    """Get the agent which commands of a node run through.
+
+    :param node: Node in topology.
+    :type node: dict
+    :returns: Agent client, None if the node doesn't use an agent.
+    :rtype: AgentClient obj
+    """
+    return _Transport.agent(node) if _Transport.agent else None
@@ -0,0 +1,188 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Extended statistics of a vswitch, i.e. OVS interface statistics and
+DPDK ethdev xstats and mempool usage from the DPDK telemetry v2 socket.
+
+A snapshot is taken before and after a test, and the counters which grew
+in between tell where packets were lost.
+"""
+
+import json
+import re
+
+from shlex import quote
+
+__all__ = [
+    u"TELEMETRY_SOCKETS",
+    u"telemetry_cmd",
+    u"parse_telemetry",
+    u"INTERFACE_STATISTICS_CMD",
+    u"parse_interface_statistics",
+    u"diff_xstats",
+    u"drop_counters",
+    u"queue_packets",
+]
+
+TELEMETRY_SOCKETS = u"/var/run/dpdk/*/dpdk_telemetry.v2"
+
+INTERFACE_STATISTICS_CMD = u"ovs-vsctl --format=json --columns=name,statistics list Interface"
+
+# Telemetry v2 client which runs on the SUT, python3 is there anyway for
+# dpdk-devbind.py. Each reply is a single seqpacket of a JSON object keyed
+# by the command.
+_CLIENT = u"""
+import glob, json, socket, sys
+def query(sock, cmd, maxlen):
+    sock.send(cmd.encode())
+    reply = json.loads(sock.recv(maxlen).decode())
+    return reply.get(cmd.split(",")[0]) or {}
+out = dict()
+for path in glob.glob(sys.argv[1]):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        sock.connect(path)
+        maxlen = json.loads(sock.recv(1024).decode()).get("max_output_len", 16384)
+        ethdev = dict()
+        for port in query(sock, "/ethdev/list", maxlen) or []:
+            info = query(sock, "/ethdev/info,%d" % port, maxlen)
+            name = info.get("name", "port%d" % port)
+            ethdev[name] = query(sock, "/ethdev/xstats,%d" % port, maxlen)
+        mempool = dict()
+        for pool in query(sock, "/mempool/list", maxlen) or []:
+            mempool[pool] = query(sock, "/mempool/info,%s" % pool, maxlen)
+        out[path] = {"ethdev": ethdev, "mempool": mempool}
+    except (OSError, ValueError) as err:
+        out[path] = {"error": str(err)}
+    finally:
+        sock.close()
+print(json.dumps(out))
+"""
+
+# Counters which count lost or delayed packets, e.g. rx_missed_errors,
+# rx_dropped, ovs_tx_retries and ovs_tx_failure_drops.
+_DROP_RE = re.compile(r"drop|miss|error|retr|discard|fail|no_?buf|nombuf", re.IGNORECASE)
+_QUEUE_RE = re.compile(r"^(rx|tx)_q(\d+)_?(?:good_)?packets$")
+
+def telemetry_cmd(sockets=TELEMETRY_SOCKETS):
+    """Build the command which queries all DPDK telemetry v2 sockets.
+
+    :param sockets: Glob of telemetry socket paths.
+    :type sockets: str
+    :returns: Command.
+    :rtype: str
+    """
+    return f"python3 -c {quote(_CLIENT)} {quote(sockets)}"
+
+def parse_telemetry(output):
+    """Parse the output of telemetry_cmd(), it's merged over sockets.
+
+    :param output: Command output.
+    :type output: str
+    :returns: 'ethdev' xstats by device name, and 'mempool' with 'size'
+        and 'in_use' of each pool.
+    :rtype: dict
+    :raises RuntimeError: If the output is not valid.
+    """
+    try:
+        data = json.loads(output)
+    except ValueError as err:
+        raise RuntimeError(f"Invalid telemetry output: {output[:200]}") from err
+    ethdev = dict()
+    mempool = dict()
+    for path, reply in data.items():
+        if u"error" in reply:
+            raise RuntimeError(f"Telemetry {path} failed: {reply[u'error']}")
+        ethdev.update(reply.get(u"ethdev", dict()))
+        for name, info in reply.get(u"mempool", dict()).items():
+            size = info.get(u"size", 0)
+            free = info.get(u"common_pool_count", size) + info.get(u"total_cache_count", 0)
+            mempool[name] = {u"size": size, u"in_use": max(0, size - free)}
+    return {u"ethdev": ethdev, u"mempool": mempool}
+
+def parse_interface_statistics(output):
+    """Parse the JSON output of INTERFACE_STATISTICS_CMD.
+
+    :param output: Command output.
+    :type output: str
+    :returns: Statistics by interface name.
+    :rtype: dict
+    """
+    data = json.loads(output)
+    names = data[u"headings"]
+    stats = dict()
+    for row in data[u"data"]:
+        columns = dict(zip(names, row))
+        # An OVSDB map is ["map", [[key, value], ...]]
+        stats[columns[u"name"]] = {key: value for key, value in columns[u"statistics"][1]
+                                   if isinstance(value, int)}
+    return stats
+
+def diff_xstats(before, after):
+    """Diff two snapshots of VirtualSwitch.get_xstats().
+
+    :param before: Snapshot before a test.
+    :param after: Snapshot after a test.
+    :type before: dict
+    :type after: dict
+    :returns: Same groups as snapshots with the increase of each counter
+        which changed, and mempool usage after the test with 'in_use_delta'.
+    :rtype: dict
+    """
+    delta = dict()
+    for group in (u"interfaces", u"ethdev"):
+        delta[group] = dict()
+        for name, counters in after.get(group, dict()).items():
+            old = before.get(group, dict()).get(name, dict())
+            changed = {key: value - old.get(key, 0) for key, value in counters.items()
+                       if isinstance(value, int) and value != old.get(key, 0)}
+            if changed:
+                delta[group][name] = changed
+    delta[u"mempool"] = dict()
+    for name, usage in after.get(u"mempool", dict()).items():
+        old = before.get(u"mempool", dict()).get(name, dict())
+        delta[u"mempool"][name] = dict(usage, in_use_delta=usage[u"in_use"] -
+                                       old.get(u"in_use", usage[u"in_use"]))
+    return delta
+
+def drop_counters(delta):
+    """Get the counters of lost packets which grew, largest first.
+
+    :param delta: Diff of snapshots, see diff_xstats().
+    :type delta: dict
+    :returns: Device name, counter name and increase of each counter.
+    :rtype: list(tuple(str, str, int))
+    """
+    drops = list()
+    for group in (u"interfaces", u"ethdev"):
+        for name, counters in delta.get(group, dict()).items():
+            drops += [(name, key, value) for key, value in counters.items()
+                      if value > 0 and _DROP_RE.search(key)]
+    return sorted(drops, key=lambda d: d[2], reverse=True)
+
+def queue_packets(counters):
+    """Get per queue packets from counters, e.g. rx_q0_packets of ethdev
+    xstats or rx_q0_good_packets of vhost-user interfaces.
+
+    :param counters: Counters of a device.
+    :type counters: dict
+    :returns: Packets by (direction, queue id).
+    :rtype: dict
+    """
+    queues = dict()
+    for key, value in counters.items():
+        match = _QUEUE_RE.match(key)
+        if match:
+            queues[(match.group(1), int(match.group(2)))] = value
+    return queues
@@ -0,0 +1,269 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""RFC 2544 style throughput search, i.e. no-drop rate (NDR) and
+partial-drop rate (PDR) over a sweep of frame sizes.
+"""
+
+from robot.api import logger
+
+from resources.libraries.python.pktgen import get_queue_counters, run_pktgen
+from resources.libraries.python.timeline import traced
+
+__all__ = [
+    u"TrialResult",
+    u"IperfUdpGenerator",
+    u"PktgenGenerator",
+    u"search_ndr_pdr",
+    u"execute_throughput_search",
+]
+
+# Ethernet header and FCS
+_ETH_OVERHEAD = 18
+# IPv4 and UDP headers
+_IPV4_UDP_OVERHEAD = 28
+# Preamble, SFD and inter frame gap on the wire
+_WIRE_OVERHEAD = 20
+
+class TrialResult:
+    """Result of a trial at an offered rate. """
+
+    def __init__(self, offered_pps, tx_packets, rx_packets, duration):
+        self.offered_pps = offered_pps
+        self.tx_packets = tx_packets
+        self.rx_packets = rx_packets
+        self.duration = duration
+
+    @property
+    def loss_ratio(self):
+        """Ratio of packets sent but not received. """
+        if self.tx_packets <= 0:
+            return 1.0
+        return max(0.0, (self.tx_packets - self.rx_packets) / self.tx_packets)
+
+    @property
+    def tx_pps(self):
+        """Rate which the generator really achieved. """
+        return self.tx_packets / self.duration
+
+    def __str__(self):
+        return (f"offered {self.offered_pps:.0f} pps, sent {self.tx_pps:.0f} pps, "
+                f"loss {self.loss_ratio * 100:.3f}%")
+
+
+class IperfUdpGenerator:
+    """Rate controlled UDP generator by iperf3 in guests, loss is measured by
+    interface counters of the sender and the receiver guests.
+    """
+
+    def __init__(self, client, client_vif, server, server_vif, duration=10, port=5201):
+        # pylint: disable=too-many-arguments
+        self.client = client
+        self.client_vif = client_vif
+        self.server = server
+        self.server_vif = server_vif
+        self.server_ip = server_vif.if_addr.ipv4
+        self.duration = duration
+        self.port = port
+
+    def start(self):
+        """Start the receiver side. """
+        self.server.start_iperf_server(ipv4=True, port=self.port)
+
+    def stop(self):
+        """Stop the receiver side. """
+        self.server.stop_iperf_server()
+
+    def trial(self, frame_size, rate_pps):
+        """Send frames at an offered rate for the duration.
+
+        :param frame_size: Ethernet frame size in bytes including FCS.
+        :param rate_pps: Offered rate in packets per second.
+        :type frame_size: int
+        :type rate_pps: float
+        :returns: Trial result.
+        :rtype: TrialResult obj
+        """
+        payload = frame_size - _ETH_OVERHEAD - _IPV4_UDP_OVERHEAD
+        tx_start = self.client.get_vif_statistics(self.client_vif, u"tx_packets")
+        rx_start = self.server.get_vif_statistics(self.server_vif, u"rx_packets")
+        result = self.client.run_iperf_client(self.server_ip, int(rate_pps * payload * 8 / 1000),
+                                              'udp', port=self.port, duration=self.duration,
+                                              length=payload)
+        tx_packets = self.client.get_vif_statistics(self.client_vif, u"tx_packets") - tx_start
+        rx_packets = self.server.get_vif_statistics(self.server_vif, u"rx_packets") - rx_start
+        logger.debug(f"iperf udp {frame_size}B at {rate_pps:.0f} pps: {result}, "
+                     f"lost {result.lost_packets}/{result.packets}")
+        return TrialResult(rate_pps, tx_packets, rx_packets, self.duration)
+
+
+class PktgenGenerator:
+    """Rate controlled small packet generator by pktgen in guests, loss is
+    measured by pktgen sent packets and the receiver's per queue counters.
+    It has the same trial() interface as IperfUdpGenerator.
+    """
+
+    def __init__(self, client, client_vif, server, server_vif, duration=10, flows=1,
+                 burst=1):
+        # pylint: disable=too-many-arguments
+        self.client = client
+        self.client_vif = client_vif
+        self.server = server
+        self.server_vif = server_vif
+        self.duration = duration
+        self.flows = flows
+        self.burst = burst
+
+    def start(self):
+        """Nothing to start, received packets are only counted. """
+
+    def stop(self):
+        """Nothing to stop, pktgen threads stop after each trial. """
+
+    def trial(self, frame_size, rate_pps):
+        """Send frames at an offered rate for the duration.
+
+        :param frame_size: Ethernet frame size in bytes including FCS.
+        :param rate_pps: Offered rate in packets per second.
+        :type frame_size: int
+        :type rate_pps: float
+        :returns: Trial result.
+        :rtype: TrialResult obj
+        """
+        rx_start = sum(v for (d, _), v in
+                       get_queue_counters(self.server, self.server_vif).items() if d == u"rx")
+        result = run_pktgen(self.client, self.client_vif, self.server_vif, frame_size,
+                            self.flows, self.burst, int(rate_pps), self.duration)
+        rx_packets = sum(v for (d, _), v in
+                         get_queue_counters(self.server, self.server_vif).items()
+                         if d == u"rx") - rx_start
+        logger.debug(f"pktgen {frame_size}B at {rate_pps:.0f} pps: {result}")
+        return TrialResult(rate_pps, result.tx_packets, rx_packets, self.duration)
+
+
+def search_ndr_pdr(trial, max_rate, pdr_loss=0.005, precision=0.01, max_trials=20):
+    """Search the no-drop rate and the partial-drop rate.
+
+    The first trial is at max_rate, then the next rate is the rate which
+    was received by the previous trial, and it falls back to binary search
+    once that rate is known to be too high or too low. The PDR is searched
+    first, and its lower bound is the upper bound of the NDR search.
+
+    :param trial: Callable which runs a trial at a rate and returns TrialResult.
+    :param max_rate: Maximal offered rate, e.g. line rate.
+    :param pdr_loss: Loss ratio allowed by PDR, e.g. 0.005 is 0.5%.
+    :param precision: Search stops when the interval is narrower than
+        precision * upper bound.
+    :param max_trials: Maximal trials of each search.
+    :type trial: callable
+    :type max_rate: float
+    :type pdr_loss: float
+    :type precision: float
+    :type max_trials: int
+    :returns: NDR and PDR in the trial's rate unit.
+    :rtype: tuple(float, float)
+    """
+    trials = dict()
+    def run(rate):
+        if rate not in trials:
+            trials[rate] = trial(rate)
+            logger.debug(f"trial {trials[rate]}")
+        return trials[rate]
+
+    def passed_rate(result):
+        # A generator may not reach the offered rate, and only the rate it
+        # really achieved is proven.
+        if result.tx_pps < result.offered_pps * 0.95:
+            logger.warn(f"Generator limited trial: {result}")
+            return min(result.offered_pps, result.tx_pps)
+        return result.offered_pps
+
+    def search(loss, low, high):
+        result = run(high)
+        if result.loss_ratio <= loss:
+            return passed_rate(result)
+        rate = min(high, max(low, result.tx_pps * (1 - result.loss_ratio)))
+        for _ in range(max_trials):
+            if high - low <= precision * high:
+                break
+            if rate <= low or rate >= high:
+                rate = (low + high) / 2
+            result = run(rate)
+            if result.loss_ratio <= loss:
+                low = passed_rate(result)
+                if low < rate:
+                    break
+            else:
+                high = rate
+            rate = (low + high) / 2
+        return low
+
+    pdr = search(pdr_loss, 0.0, max_rate)
+    ndr = search(0.0, 0.0, pdr) if pdr > 0 else 0.0
+    return ndr, pdr
+
+
+@traced("throughput")
+def execute_throughput_search(vt, frame_sizes=(64, 128, 256, 512, 1024, 1518),
+                              pdr_loss=0.005, line_rate_gbps=10, duration=10,
+                              generator=u"iperf", flows=1):
+    """Given an input verify topology, search NDR/PDR of the first allow pair
+    over frame sizes by iperf3 UDP or kernel pktgen in guests.
+
+    :param vt: Input verify topology.
+    :param frame_sizes: Ethernet frame sizes in bytes, frames larger than
+        1518 need jumbo MTU on VMs and uplinks.
+    :param pdr_loss: Loss ratio allowed by PDR.
+    :param line_rate_gbps: Line rate which bounds the search.
+    :param duration: Duration in seconds of each trial.
+    :param generator: Traffic generator, 'iperf' or 'pktgen'.
+    :param flows: Number of flows, only for pktgen.
+    :type vt: VerifyTopology obj
+    :type frame_sizes: list(int)
+    :type pdr_loss: float
+    :type line_rate_gbps: float
+    :type duration: int
+    :type generator: str
+    :type flows: int
+    :returns: NDR/PDR in pps and L2 Mbps of each frame size.
+    :rtype: list(str)
+    """
+    # pylint: disable=too-many-arguments
+    if not vt.allow or not vt.allow[0].get_deps():
+        raise RuntimeError("No allowed entry is found.")
+    sep = vt.allow[0].sep
+    dep = vt.allow[0].get_deps()[0]
+    if generator == u"pktgen":
+        trial_gen = PktgenGenerator(sep.guest, sep.vif, dep.guest, dep.vif, int(duration),
+                                    int(flows))
+    elif generator == u"iperf":
+        trial_gen = IperfUdpGenerator(sep.guest, sep.vif, dep.guest, dep.vif, int(duration))
+    else:
+        raise RuntimeError(f"Unsupported traffic generator: {generator}")
+
+    results = list()
+    trial_gen.start()
+    try:
+        for frame_size in [int(f) for f in frame_sizes]:
+            max_pps = float(line_rate_gbps) * 1e9 / ((frame_size + _WIRE_OVERHEAD) * 8)
+            ndr, pdr = search_ndr_pdr(lambda rate, size=frame_size: trial_gen.trial(size, rate),
+                                      max_pps, float(pdr_loss))
+            results.append(f"{frame_size}B NDR {ndr:.0f} pps "
+                           f"{ndr * frame_size * 8 / 1e6:.1f} Mbps, "
+                           f"PDR({float(pdr_loss) * 100:g}%) {pdr:.0f} pps "
+                           f"{pdr * frame_size * 8 / 1e6:.1f} Mbps")
+            logger.info(results[-1])
+    finally:
+        trial_gen.stop()
+    return results
@@ -0,0 +1,209 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timeline profiler which exports Chrome trace-event JSON.
+
+Enable it by the robot listener, e.g.::
+
+    $ robot --listener resources.libraries.python.timeline.TimelineListener ...
+
+A 'timeline_<suite>.json' is exported into robot output directory for each
+suite, and it can be viewed by https://ui.perfetto.dev or chrome://tracing.
+Each node is a process track, and spans of different threads on the same
+node are on different thread tracks.
+"""
+
+import json
+import os
+import re
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, get_ident
+from time import time
+
+from robot.libraries.BuiltIn import BuiltIn, RobotNotRunningError
+
+__all__ = [
+    u"Timeline",
+    u"timeline",
+    u"traced",
+    u"TimelineListener",
+]
+
+_MAIN_TRACK = u"main"
+
+
+class Timeline:
+    """Collects spans as trace-event 'complete' events. """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = Lock()
+        self._events = list()
+        self._meta = list()
+        self._tracks = dict()
+        self._threads = dict()
+
+    def _ids(self, track):
+        # Caller must hold the lock
+        if track not in self._tracks:
+            pid = len(self._tracks) + 1
+            self._tracks[track] = pid
+            self._meta.append({u"name": u"process_name", u"ph": u"M", u"pid": pid,
+                               u"args": {u"name": track}})
+            self._meta.append({u"name": u"process_sort_index", u"ph": u"M", u"pid": pid,
+                               u"args": {u"sort_index": pid}})
+        ident = get_ident()
+        if ident not in self._threads:
+            self._threads[ident] = len(self._threads) + 1
+        return self._tracks[track], self._threads[ident]
+
+    def add(self, name, cat, start, end, track=_MAIN_TRACK, args=None):
+        """Add a finished span.
+
+        :param name: Span name.
+        :param cat: Category, e.g. keyword, pal, vm, ssh.
+        :param start: Start time in seconds since epoch.
+        :param end: End time in seconds since epoch.
+        :param track: Track name, normally a node.
+        :param args: Extra information shown with the span.
+        :type name: str
+        :type cat: str
+        :type start: float
+        :type end: float
+        :type track: str
+        :type args: dict
+        """
+        with self._lock:
+            pid, tid = self._ids(track)
+            event = {u"name": name, u"cat": cat, u"ph": u"X",
+                     u"ts": int(start * 1000000), u"dur": int((end - start) * 1000000),
+                     u"pid": pid, u"tid": tid}
+            if args:
+                event[u"args"] = args
+            self._events.append(event)
+
+    @contextmanager
+    def span(self, name, cat=u"", track=_MAIN_TRACK, args=None):
+        """Context of a span, it's a no-op if the timeline is not enabled.
+
+        :param name: Span name.
+        :param cat: Category.
+        :param track: Track name, normally a node.
+        :param args: Extra information shown with the span.
+        :type name: str
+        :type cat: str
+        :type track: str
+        :type args: dict
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(name, cat, start, time(), track, args)
+
+    def mark(self):
+        """Get current position of the timeline.
+
+        :returns: Position which can be passed to export().
+        :rtype: int
+        """
+        with self._lock:
+            return len(self._events)
+
+    def export(self, path, since=0):
+        """Export spans as Chrome trace-event JSON.
+
+        :param path: File path.
+        :param since: Only export spans finished after the position.
+        :type path: str
+        :type since: int
+        """
+        with self._lock:
+            events = self._meta + self._events[since:]
+        with open(path, u"w") as trace_file:
+            json.dump({u"traceEvents": events, u"displayTimeUnit": u"ms"}, trace_file)
+
+
+timeline = Timeline()
+
+def traced(cat, track=None):
+    """Decorator which wraps a function call into a span.
+
+    :param cat: Category.
+    :param track: Callable which returns the track name from the call's
+        arguments, main track is used if it's None.
+    :type cat: str
+    :type track: callable
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not timeline.enabled:
+                return func(*args, **kwargs)
+            name = func.__qualname__
+            with timeline.span(name, cat, track(*args, **kwargs) if track else _MAIN_TRACK):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TimelineListener:
+    """Robot listener which wraps suites, tests and keywords into spans and
+    exports a timeline for each suite.
+    """
+    # Hook signatures are defined by the listener API.
+    # pylint: disable=unused-argument
+    ROBOT_LISTENER_API_VERSION = 2
+
+    def __init__(self):
+        timeline.enabled = True
+        self._suites = list()
+        self._starts = list()
+
+    def start_suite(self, name, attrs):
+        """Listener hook. """
+        self._suites.append((timeline.mark(), time()))
+
+    def end_suite(self, name, attrs):
+        """Listener hook. """
+        mark, start = self._suites.pop()
+        timeline.add(name, u"suite", start, time())
+        try:
+            out_dir = BuiltIn().get_variable_value(u"${OUTPUT DIR}", u".")
+        except RobotNotRunningError:
+            out_dir = u"."
+        fname = re.sub(r"[^\w.-]+", u"_", attrs[u"longname"])
+        timeline.export(os.path.join(out_dir, f"timeline_{fname}.json"), mark)
+
+    def start_test(self, name, attrs):
+        """Listener hook. """
+        self._starts.append(time())
+
+    def end_test(self, name, attrs):
+        """Listener hook. """
+        timeline.add(name, u"test", self._starts.pop(), time())
+
+    def start_keyword(self, name, attrs):
+        """Listener hook. """
+        self._starts.append(time())
+
+    def end_keyword(self, name, attrs):
+        """Listener hook. """
+        timeline.add(attrs.get(u"kwname") or name, u"keyword", self._starts.pop(), time(),
+                     args={u"library": attrs.get(u"libname", u"")})
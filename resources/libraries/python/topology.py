@@ -22,10 +22,15 @@ from yaml import safe_load
 from robot.api import logger
 from robot.libraries.BuiltIn import BuiltIn
 from resources.libraries.python.constants import Constants
-from resources.libraries.python.vif import VhostUserInterface, InterfaceAddress
-from resources.libraries.python.ssh import exec_cmd, kill_process
+from resources.libraries.python.vif import VhostUserInterface, VethInterface, \
+                                          InterfaceAddress
+from resources.libraries.python.agent import get_agent, kill_process, read_file
+from resources.libraries.python.ssh import exec_cmd
+from resources.libraries.python.sshpool import ssh_pool
+from resources.libraries.python.timeline import timeline
 from resources.libraries.python.vm import VirtualMachine
-from resources.libraries.python.vswitch import OvsDpdk, OvsNative
+from resources.libraries.python.netns import NetnsEndpoint
+from resources.libraries.python.vswitch import OvsDpdk, OvsNative, OvsNativeLocal
 
 __all__ = [
     u"init_topology",
@@ -37,6 +42,10 @@ _TMP_DIR = "temp"
 _TEP_NETV4 = IPv4Network("10.111.0.0/16")
 _TEP_NETV6 = IPv6Network('2001:1000:1000:1000:0:0:0a6f:0000/112')
 
+def _tep_addr(node_idx):
+    return InterfaceAddress(list(_TEP_NETV4.hosts())[node_idx + 1], _TEP_NETV4,
+                            list(_TEP_NETV6.hosts())[node_idx + 1], _TEP_NETV6)
+
 def _atoi(s):
     try:
         return int(s)
@@ -52,6 +61,10 @@ class Node():
         self.ssh_info['port'] = node_spec['port']
         self.ssh_info['username'] = node_spec['username']
         self.ssh_info['password'] = node_spec['password']
+        if str(node_spec.get('use_agent', False)).lower() != 'false':
+            self.ssh_info['use_agent'] = True
+            # Push the agent at init, so its startup is not paid by test cases.
+            get_agent(self.ssh_info)
 
 class Numa():
     """Define attributes for a NUMA node. """
@@ -71,15 +84,43 @@ class SUT(Node):
     OVSDPDK_PNIC_NUMA_CPU_NUM = 1
     OVSDPDK_NORM_NUMA_CPU_NUM = 1
     MAX_VM_PER_NUMA = 2
+    MAX_NETNS_ENDPOINTS = 254
 
     def __init__(self, name, node_spec):
         super().__init__(name, node_spec)
 
+        node_idx = int(node_spec['id'])
+        self._discover_resources(node_spec)
+        self._init_test_dirs(node_spec)
+        self.vswitch = self._create_vswitch(node_idx, node_spec, _tep_addr(node_idx))
+        self.vswitch.stop_vswitch()
+        self.vswitch.start_vswitch()
+
+        host_ssh_info = {
+            'host': node_spec['host'],
+            'port': node_spec['port'],
+            'username': node_spec['username'],
+            'password': node_spec['password'],
+            'use_agent': self.ssh_info.get('use_agent', False),
+            'guest_ssh_jump': str(node_spec.get('guest_ssh_jump', True)).lower() != 'false',
+            }
+
+        self._create_vms(node_idx, node_spec, host_ssh_info)
+        self._create_netns_endpoints(node_idx, node_spec, host_ssh_info)
+
+    def _discover_resources(self, node_spec):
+        """Collect CPUs and free hugepages of each NUMA node, and the NUMA
+        node of uplinks, after stale processes are destroyed.
+
+        :param node_spec: Node specification.
+        :type node_spec: dict
+        """
         self.huge_mnt = node_spec.get('huge_mnt', SUT.HUGE_MNT)
         self.userspace_tso = node_spec.get('userspace_tso', True)
         self.numas = list()
         self.hugepage_size = int(node_spec.get('hugepage_size', SUT.HUGEPAGE_SIZE))
         self.hugepage_size *= 1024 # To KB
+        self.vhost_sock_dir = "/var/run/openvswitch"
 
         cmd = "lscpu -p"
         _, stdout, _ = exec_cmd(self.ssh_info, cmd)
@@ -103,9 +144,9 @@ class SUT(Node):
         # Construct NUMA core list mapping
         for numa_id in range(self.n_numa):
             numa = Numa(numa_id)
-            cmd = f"cat /sys/devices/system/node/node{numa_id}/" \
-                  f"hugepages/hugepages-{self.hugepage_size}kB/free_hugepages"
-            ret_code, stdout, stderr = exec_cmd(self.ssh_info, cmd)
+            path = f"/sys/devices/system/node/node{numa_id}/" \
+                   f"hugepages/hugepages-{self.hugepage_size}kB/free_hugepages"
+            ret_code, stdout, stderr = read_file(self.ssh_info, path)
             stdout = stdout.strip()
             if ret_code:
                 # Current numa node doesn't have any hugepage requested.
@@ -116,7 +157,7 @@ class SUT(Node):
                     # In some system without numa enabled, normalized to 0
                     free_hugepages = 0
             except ValueError:
-                logger.error(f"Reading numa hugepage failed : {cmd} {stdout}")
+                logger.error(f"Reading numa hugepage failed : {path} {stdout}")
                 sys.exit()
             numa.avail_mem = self.hugepage_size * free_hugepages
             self.numas.append(numa)
@@ -130,8 +171,8 @@ class SUT(Node):
         uplinks_spec = node_spec.get("interfaces", dict())
         for iface in uplinks_spec.keys():
             iface_spec = uplinks_spec[iface]
-            cmd = f"cat /sys/bus/pci/devices/{iface_spec['pci_address']}/numa_node"
-            _, stdout, _ = exec_cmd(self.ssh_info, cmd)
+            _, stdout, _ = read_file(self.ssh_info, f"/sys/bus/pci/devices/"
+                                     f"{iface_spec['pci_address']}/numa_node")
             try:
                 numa_id = int(stdout)
                 if numa_id < 0:
@@ -144,108 +185,128 @@ class SUT(Node):
                 self.pnic_numa_id = numa_id
             else:
                 if numa_id != self.pnic_numa_id:
-                    logger.warn(f"uplink interfaces CANNOT be on different numa nodes")
+                    logger.warn("uplink interfaces CANNOT be on different numa nodes")
                     sys.exit()
 
+    def _init_test_dirs(self, node_spec):
+        """Locate the test root directory, and recreate the tmp directory.
+
+        :param node_spec: Node specification.
+        :type node_spec: dict
+        """
         self.test_root_dir = node_spec.get("test_root_dir")
         if not self.test_root_dir:
             (_, stdout, _) = exec_cmd(self.ssh_info, 'echo ~')
             self.test_root_dir = os.path.join(str(stdout).strip(), "TEST_ROOT/")
 
-        self.test_tmp_dir = os.path.join(self.test_root_dir, _TMP_DIR)
+        self.test_tmp_dir = self._test_tmp_dir()
         exec_cmd(self.ssh_info, f"rm -rf {self.test_tmp_dir}")
         exec_cmd(self.ssh_info, f"mkdir -p {self.test_tmp_dir}")
 
-        self.vhost_sock_dir = "/var/run/openvswitch"
-        self.vms = list()
+    def _test_tmp_dir(self):
+        return os.path.join(self.test_root_dir, _TMP_DIR)
 
-        guest_vcpu_idx = 0
+    def _reserve_ovsdpdk_resources(self, node_spec):
+        """Reserve hugepages and PMD cores of each NUMA node for OVS-DPDK.
 
-        node_idx = int(node_spec['id'])
+        :param node_spec: Node specification.
+        :type node_spec: dict
+        :returns: Socket memory, hugepage mount and cpu mask parameters.
+        :rtype: dict
+        """
+        aux_params = dict()
+        socket_mem_str = ''
+        # 'numas' is sored by id
+        for numa in self.numas:
+            socket_mem = max(SUT.OVSDPDK_MEM_PER_SOCKET, self.hugepage_size)
+            if numa.avail_mem <= socket_mem:
+                logger.warn(f"numa node:{numa.numa_id} mem:{numa.avail_mem} "
+                            f"is not enough for ovsdpdk socket_mem:{socket_mem}. "
+                            f"skip this numa node.")
+                # Prevent alloacte vm on this numa node
+                numa.avail_mem = 0
+                socket_mem = 0
+            else:
+                # If the left mem is not enough for a VM, no side effect
+                numa.avail_mem -= socket_mem
+            socket_mem_str += f"{int(socket_mem/1024)},"
+        socket_mem_str = socket_mem_str.rstrip(',')
+
+        cpu_mask = 0
+        pnic_numa_cpu_num = int(node_spec.get('pnic_numa_cpu_num',
+                                              SUT.OVSDPDK_PNIC_NUMA_CPU_NUM))
+        norm_numa_cpu_num = int(node_spec.get('norm_numa_cpu_num',
+                                              SUT.OVSDPDK_NORM_NUMA_CPU_NUM))
+        for numa in self.numas:
+            if not numa.avail_mem:
+                # Bypass numa nodes which have no socket_mem allocated.
+                continue
+
+            if numa.numa_id == self.pnic_numa_id:
+                if len(numa.avail_cpus) < pnic_numa_cpu_num:
+                    logger.warn(f"pnic numa node:{numa.numa_id} "
+                                f"have have no {pnic_numa_cpu_num} cpus")
+                    sys.exit()
+                for _ in range(pnic_numa_cpu_num):
+                    cpu = numa.avail_cpus.pop(0)
+                    cpu_mask |= 1 << cpu
+            else:
+                if len(numa.avail_cpus) < norm_numa_cpu_num:
+                    logger.warn(f"norm numa node:{numa.numa_id} "
+                                f"have have no {pnic_numa_cpu_num} cpus")
+                    sys.exit()
+                for _ in range(norm_numa_cpu_num):
+                    cpu = numa.avail_cpus.pop(0)
+                    cpu_mask |= 1 << cpu
+
+        aux_params['socket_mem'] = socket_mem_str
+        aux_params['huge_mnt'] = self.huge_mnt
+        aux_params['cpu_mask'] = hex(cpu_mask)
+        aux_params['userspace_tso'] = self.userspace_tso
+        aux_params['driver'] = node_spec.get('driver', 'vfio-pci')
+        return aux_params
+
+    def _create_vswitch(self, node_idx, node_spec, tep_addr):
+        """Create the virtual switch of the datapath type.
+
+        :param node_idx: Node index.
+        :param node_spec: Node specification.
+        :param tep_addr: Tunnel endpoint address.
+        :type node_idx: int
+        :type node_spec: dict
+        :type tep_addr: InterfaceAddress obj
+        :returns: Virtual switch.
+        :rtype: VirtualSwitch obj
+        """
+        # pylint: disable=unused-argument
         dp_type = node_spec.get("dp_type", "ovs-dpdk")
         dpdk_devbind_dir = os.path.join(self.test_root_dir, "bin/")
         ovs_bin_dir = os.path.join(self.test_root_dir, f"bin/{dp_type}/")
 
-        tep_ipv4 = list(_TEP_NETV4.hosts())[node_idx + 1]
-        tep_ipv6 = list(_TEP_NETV6.hosts())[node_idx + 1]
-        tep_addr = InterfaceAddress(tep_ipv4, _TEP_NETV4,
-                                    tep_ipv6, _TEP_NETV6)
         if dp_type == "ovs-dpdk":
-            ovs_native = False
-            aux_params = dict()
-            socket_mem_str = ''
-            # 'numas' is sored by id
-            for numa in self.numas:
-                socket_mem = max(SUT.OVSDPDK_MEM_PER_SOCKET, self.hugepage_size)
-                if numa.avail_mem <= socket_mem:
-                    logger.warn(f"numa node:{numa.numa_id} mem:{numa.avail_mem} "
-                                f"is not enough for ovsdpdk socket_mem:{socket_mem}. "
-                                f"skip this numa node.")
-                    # Prevent alloacte vm on this numa node
-                    numa.avail_mem = 0
-                    socket_mem = 0
-                else:
-                    # If the left mem is not enough for a VM, no side effect
-                    numa.avail_mem -= socket_mem
-                socket_mem_str += f"{int(socket_mem/1024)},"
-            socket_mem_str = socket_mem_str.rstrip(',')
-
-            cpu_mask = 0
-            pnic_numa_cpu_num = int(node_spec.get('pnic_numa_cpu_num',
-                                                  SUT.OVSDPDK_PNIC_NUMA_CPU_NUM))
-            norm_numa_cpu_num = int(node_spec.get('norm_numa_cpu_num',
-                                                  SUT.OVSDPDK_NORM_NUMA_CPU_NUM))
-            for numa in self.numas:
-                if not numa.avail_mem:
-                    # Bypass numa nodes which have no socket_mem allocated.
-                    continue
-
-                if numa.numa_id == self.pnic_numa_id:
-                    if len(numa.avail_cpus) < pnic_numa_cpu_num:
-                        logger.warn(f"pnic numa node:{numa.numa_id} "
-                                    f"have have no {pnic_numa_cpu_num} cpus")
-                        sys.exit()
-                    for _ in range(pnic_numa_cpu_num):
-                        cpu = numa.avail_cpus.pop(0)
-                        cpu_mask |= 1 << cpu
-                else:
-                    if len(numa.avail_cpus) < norm_numa_cpu_num:
-                        logger.warn(f"norm numa node:{numa.numa_id} "
-                                    f"have have no {pnic_numa_cpu_num} cpus")
-                        sys.exit()
-                    for _ in range(norm_numa_cpu_num):
-                        cpu = numa.avail_cpus.pop(0)
-                        cpu_mask |= 1 << cpu
-
-            aux_params['socket_mem'] = socket_mem_str
-            aux_params['huge_mnt'] = self.huge_mnt
-            aux_params['cpu_mask'] = hex(cpu_mask)
-            aux_params['userspace_tso'] = self.userspace_tso
-            aux_params['driver'] = node_spec.get('driver', 'vfio-pci')
-            self.vswitch = OvsDpdk(self.ssh_info, node_spec.get("interfaces", dict()),
-                                   tep_addr,
-                                   ovs_bin_dir, dpdk_devbind_dir,
-                                   aux_params)
-        elif dp_type == "ovs-native":
-            ovs_native = True
-            self.vswitch = OvsNative(self.ssh_info, node_spec.get("interfaces", dict()),
-                                     tep_addr,
-                                     ovs_bin_dir, dpdk_devbind_dir)
-        else:
-            raise RuntimeError(f"Do not support {dp_type} type datapath")
-
-
-        self.vswitch.stop_vswitch()
-        self.vswitch.start_vswitch()
-
-        host_ssh_info = {
-            'host': node_spec['host'],
-            'port': node_spec['port'],
-            'username': node_spec['username'],
-            'password': node_spec['password'],
-            }
-
-
+            return OvsDpdk(self.ssh_info, node_spec.get("interfaces", dict()),
+                           tep_addr,
+                           ovs_bin_dir, dpdk_devbind_dir,
+                           self._reserve_ovsdpdk_resources(node_spec))
+        if dp_type == "ovs-native":
+            return OvsNative(self.ssh_info, node_spec.get("interfaces", dict()),
+                             tep_addr,
+                             ovs_bin_dir, dpdk_devbind_dir)
+        raise RuntimeError(f"Do not support {dp_type} type datapath")
+
+    def _create_vms(self, node_idx, node_spec, host_ssh_info):
+        """Create VMs on each NUMA node with enough free hugepages and CPUs,
+        each VM has VirtualMachine.VM_VIFS_NUM vhost-user VIFs.
+
+        :param node_idx: Node index.
+        :param node_spec: Node specification.
+        :param host_ssh_info: SSH information of the host.
+        :type node_idx: int
+        :type node_spec: dict
+        :type host_ssh_info: dict
+        """
+        self.vms = list()
+        ovs_native = node_spec.get("dp_type", "ovs-dpdk") == "ovs-native"
         vm_mem_size = int(node_spec.get('vm_mem_size', VirtualMachine.VM_MEM_SIZE))
         vm_mem_size *= 1024 # To KB
         vm_cpu_num = int(node_spec.get('vm_cpu_num', VirtualMachine.VM_CPU_NUM))
@@ -296,7 +357,7 @@ class SUT(Node):
 
                     vif.if_addr = if_addr
                     vif.sock = os.path.join(self.vhost_sock_dir, vif_name)
-                    if dp_type == "ovs-native":
+                    if ovs_native:
                         path = os.path.join(self.test_tmp_dir, f"{vm_name}_{vif_name}")
                         vif.qemu_script_ifup = f"{path}_ifup"
                         vif.qemu_script_ifdown = f"{path}_ifdown"
@@ -307,6 +368,46 @@ class SUT(Node):
                 numa.vms.append(vm)
                 guest_idx += 1
 
+    def _create_netns_endpoints(self, node_idx, node_spec, host_ssh_info):
+        """Create netns endpoints, each of them has a single VIF.
+        The VIF is in the same subnet as the 1st VIF of VMs, and its address
+        is 172.168.{100 + node_idx}.{ep_idx}.
+
+        :param node_idx: Node index.
+        :param node_spec: Node specification.
+        :param host_ssh_info: SSH information of the host.
+        :type node_idx: int
+        :type node_spec: dict
+        :type host_ssh_info: dict
+        """
+        self.netns_endpoints = list()
+        netns_num = int(node_spec.get('netns_endpoint_num', 0))
+        internal = node_spec.get('netns_attach', 'veth') == 'internal'
+        if netns_num > SUT.MAX_NETNS_ENDPOINTS:
+            raise RuntimeError(f"netns_endpoint_num {netns_num} exceeds "
+                               f"{SUT.MAX_NETNS_ENDPOINTS}")
+        numa_id = self.pnic_numa_id if self.pnic_numa_id else 0
+        for ep_idx in range(1, netns_num + 1):
+            ep_name = 'ep_{0:02d}_{1:03d}'.format(node_idx, ep_idx)
+            endpoint = NetnsEndpoint(ep_name, host_ssh_info, numa_id)
+
+            vif_name = 'nsv{0:02d}{1:03d}'.format(node_idx, ep_idx)
+            ipv4 = IPv4Address('172.168.{0}.{1}'.format(100 + node_idx, ep_idx))
+            ipv4_network = IPv4Network(f"{ipv4}/16", strict=False)
+            ipv6 = IPv6Address('2001:1000:1000:1000:0:0:' \
+                    'aca8:{0:02x}{1:02x}'.format(100 + node_idx, ep_idx))
+            ipv6_network = IPv6Network(f"{ipv6}/112", strict=False)
+            mac = '00:00:01:{0:02x}:00:{1:02x}'.format(node_idx, ep_idx)
+            vif = VethInterface(name=vif_name,
+                                idx=0,
+                                mac=mac,
+                                ofp=f"{Constants.OFP_NETNS_BASE + ep_idx}",
+                                netns=ep_name,
+                                internal=internal)
+            vif.if_addr = InterfaceAddress(ipv4, ipv4_network, ipv6, ipv6_network)
+            endpoint.add_vif(vif)
+            self.netns_endpoints.append(endpoint)
+
     def get_vms(self):
         """Get all the virtual machines on the SUT.
         :returns: virtual machines.
@@ -317,6 +418,60 @@ class SUT(Node):
             vms += numa.vms
         return vms
 
+    def get_netns_endpoints(self):
+        """Get all the netns endpoints on the SUT.
+        :returns: netns endpoints.
+        :rtype: list(NetnsEndpoint obj)
+        """
+        return self.netns_endpoints
+
+    def get_guests(self, guest_type='vm'):
+        """Get guests on the SUT by guest type.
+        :param guest_type: 'vm', 'netns' or 'all'.
+        :type guest_type: str
+        :returns: guests.
+        :rtype: list(Guest obj)
+        """
+        if guest_type == 'vm':
+            return self.get_vms()
+        if guest_type == 'netns':
+            return self.get_netns_endpoints()
+        if guest_type == 'all':
+            return self.get_vms() + self.get_netns_endpoints()
+        raise RuntimeError(f"Do not support {guest_type} type guest")
+
+class LocalSUT(SUT):
+    """Define a logical SUT which runs in a network namespace of a Linux box.
+    Multiple logical SUTs can share the same box, their uplinks are veth
+    pairs attached to a linux bridge in the root namespace, so no NIC,
+    hugepage or QEMU is required. Only netns endpoints are supported as guests.
+    """
+    FABRIC_NAME = 'cne-fabric'
+
+    def _discover_resources(self, node_spec):
+        # No hugepage or NIC is required
+        self.huge_mnt = None
+        self.userspace_tso = False
+        self.hugepage_size = 0
+        self.numas = [Numa(0)]
+        self.pnic_numa_id = 0
+        self.vhost_sock_dir = None
+
+    def _test_tmp_dir(self):
+        # Logical SUTs share the same box, so each of them has its own tmp dir.
+        return os.path.join(self.test_root_dir, _TMP_DIR, self.name)
+
+    def _create_vswitch(self, node_idx, node_spec, tep_addr):
+        netns = node_spec.get('netns', f"sut{node_idx}")
+        return OvsNativeLocal(self.ssh_info, node_spec.get("interfaces", dict()),
+                              tep_addr, os.path.join(self.test_root_dir, "bin/ovs-native/"),
+                              os.path.join(self.test_root_dir, "bin/"),
+                              netns, node_spec.get('fabric', LocalSUT.FABRIC_NAME))
+
+    def _create_vms(self, node_idx, node_spec, host_ssh_info):
+        # Only netns endpoints are supported as guests
+        self.vms = list()
+
 def load_topo_from_yaml():
     """Load topology from file defined in "${TOPOLOGY_PATH}" variable.
     Then constructs all the components defined in the config file.
@@ -330,9 +485,18 @@ def load_topo_from_yaml():
     with open(topo_path) as work_file:
         nodes_spec = safe_load(work_file.read())[u"nodes"]
 
+    # Connect to all SUTs in parallel before building them one by one
+    ssh_pool.prewarm([{key: node_spec[key] for key in ('host', 'port', 'username', 'password')}
+                      for node_spec in nodes_spec.values() if node_spec['type'] == 'SUT'])
+
     for name, node_spec in nodes_spec.items():
         if node_spec['type'] == 'SUT':
-            sut = SUT(name, node_spec)
+            with timeline.span(f"{name} init", "topology",
+                               f"{node_spec['host']}:{node_spec['port']}"):
+                if node_spec.get("dp_type") == "ovs-native-local":
+                    sut = LocalSUT(name, node_spec)
+                else:
+                    sut = SUT(name, node_spec)
             suts.append(sut)
 
 # pylint:disable=global-variable-undefined
@@ -0,0 +1,232 @@
+# Copyright(c) 2017-2021 CloudNetEngine. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Repeated trials of a measurement with warm-up discard and 95%
+confidence intervals.
+
+A trial is repeated until the confidence interval is tight enough or the
+maximal repetitions are reached, and a measurement whose coefficient of
+variation is too high is flagged as noisy.
+"""
+
+import math
+import statistics
+
+from robot.api import logger
+
+__all__ = [
+    u"Measurement",
+    u"run_trials",
+    u"t95_quantile",
+]
+
+# Two-sided 95% quantiles of Student's t distribution by degrees of freedom,
+# the normal quantile is used beyond the table.
+_T95 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042)
+_Z95 = 1.960
+
+def t95_quantile(dof):
+    """Get the two-sided 95% quantile of Student's t distribution.
+
+    :param dof: Degrees of freedom, a fractional one is rounded down, and
+        an infinite one gives the normal quantile.
+    :type dof: float
+    :returns: Quantile.
+    :rtype: float
+    """
+    if dof > len(_T95):
+        return _Z95
+    dof = max(1, int(dof))
+    return _T95[dof - 1] if dof <= len(_T95) else _Z95
+
+
+class Measurement:
+    """Statistics of samples of a metric, it's printed as a result line.
+
+    :param name: Metric name, e.g. 'tcp ipv4 throughput'.
+    :param unit: Metric unit, e.g. 'Kbits/sec'.
+    :param samples: Values of measured trials.
+    :param discarded: Values of warm-up trials.
+    :param noisy_cv: Coefficient of variation above which it's noisy.
+    :param results: Raw trial results which samples are taken from.
+    :type name: str
+    :type unit: str
+    :type samples: list(float)
+    :type discarded: list(float)
+    :type noisy_cv: float
+    :type results: list
+    """
+
+    def __init__(self, name, unit, samples, discarded=(), noisy_cv=0.1, results=()):
+        # pylint: disable=too-many-arguments
+        self.name = name
+        self.unit = unit
+        self.samples = list(samples)
+        self.discarded = list(discarded)
+        self.noisy_cv = noisy_cv
+        self.results = list(results)
+
+    @property
+    def n(self): # pylint: disable=invalid-name
+        """Number of samples. """
+        return len(self.samples)
+
+    @property
+    def mean(self):
+        """Mean of samples. """
+        return statistics.mean(self.samples) if self.samples else 0.0
+
+    @property
+    def median(self):
+        """Median of samples. """
+        return statistics.median(self.samples) if self.samples else 0.0
+
+    @property
+    def stddev(self):
+        """Sample standard deviation, 0 with less than 2 samples. """
+        return statistics.stdev(self.samples) if self.n > 1 else 0.0
+
+    @property
+    def ci95(self):
+        """Half width of the 95% confidence interval of the mean, None with
+        less than 2 samples.
+        """
+        if self.n < 2:
+            return None
+        return t95_quantile(self.n - 1) * self.stddev / math.sqrt(self.n)
+
+    @property
+    def ci95_ratio(self):
+        """Half width of the 95% confidence interval relative to the mean. """
+        if self.ci95 is None or not self.mean:
+            return math.inf
+        return self.ci95 / abs(self.mean)
+
+    @property
+    def cv(self): # pylint: disable=invalid-name
+        """Coefficient of variation. """
+        return self.stddev / abs(self.mean) if self.mean else 0.0
+
+    @property
+    def noisy(self):
+        """If variation of samples is higher than expected. """
+        return self.n > 1 and self.cv > self.noisy_cv
+
+    def derive(self, name, unit, value):
+        """Build a measurement of another metric from the same raw results.
+
+        :param name: Metric name.
+        :param unit: Metric unit.
+        :param value: Callable which takes a metric value from a raw result.
+        :type name: str
+        :type unit: str
+        :type value: callable
+        :returns: Derived measurement without discarded samples.
+        :rtype: Measurement obj
+        """
+        return Measurement(name, unit, [value(r) for r in self.results],
+                           noisy_cv=self.noisy_cv, results=self.results)
+
+    def to_dict(self):
+        """Convert to a JSON serializable dict. """
+        return {u"name": self.name, u"unit": self.unit, u"samples": self.samples,
+                u"discarded": self.discarded, u"n": self.n, u"mean": self.mean,
+                u"median": self.median, u"stddev": self.stddev, u"ci95": self.ci95,
+                u"noisy": self.noisy}
+
+    def __str__(self):
+        if self.n < 2:
+            return f"{self.name}: {self.mean:.2f} {self.unit}"
+        noisy = u", NOISY" if self.noisy else u""
+        return (f"{self.name}: median {self.median:.2f} {self.unit}, "
+                f"mean {self.mean:.2f} +/- {self.ci95:.2f} (95% CI), "
+                f"stddev {self.stddev:.2f}, n={self.n}{noisy}")
+
+
+def run_trials(trial, name, unit=u"", value=float, repetitions=5, warmup=1,
+               min_repetitions=3, ci_target=0.05, noisy_cv=0.1, max_failures=2):
+    """Run a trial repeatedly and build a measurement of its results.
+
+    Warm-up trials are run first and their results are discarded, then it
+    stops once there are min_repetitions samples and the 95% confidence
+    interval is within ci_target of the mean, or after repetitions samples.
+    A trial whose raw result has 'error' set, e.g. a failed iperf run, is
+    logged and not taken as a sample.
+
+    :param trial: Callable which runs a trial and returns its raw result.
+    :param name: Metric name.
+    :param unit: Metric unit, or callable which takes it from a raw result.
+    :param value: Callable which takes the metric value from a raw result.
+    :param repetitions: Maximal number of measured trials.
+    :param warmup: Number of discarded trials.
+    :param min_repetitions: Minimal number of measured trials.
+    :param ci_target: Relative half width of the 95% CI to stop at.
+    :param noisy_cv: Coefficient of variation above which it's noisy.
+    :param max_failures: Maximal number of failed trials.
+    :type trial: callable
+    :type name: str
+    :type unit: str or callable
+    :type value: callable
+    :type repetitions: int
+    :type warmup: int
+    :type min_repetitions: int
+    :type ci_target: float
+    :type noisy_cv: float
+    :type max_failures: int
+    :returns: Measurement of trials.
+    :rtype: Measurement obj
+    :raises RuntimeError: If more than max_failures trials failed.
+    """
+    # pylint: disable=too-many-arguments
+    repetitions = max(1, int(repetitions))
+    min_repetitions = min(repetitions, max(2, int(min_repetitions)))
+    failures = list()
+
+    def run():
+        result = trial()
+        error = getattr(result, u"error", None)
+        if not error:
+            return result
+        failures.append(error)
+        logger.warn(f"{name} trial failed: {error}")
+        if len(failures) > int(max_failures):
+            raise RuntimeError(f"{name}: {len(failures)} trials failed, last: {error}")
+        return None
+
+    discarded = list()
+    while len(discarded) < int(warmup):
+        result = run()
+        if result is not None:
+            discarded.append(value(result))
+
+    samples = list()
+    results = list()
+    while len(samples) < repetitions:
+        result = run()
+        if result is None:
+            continue
+        results.append(result)
+        samples.append(value(result))
+        if len(samples) >= min_repetitions and \
+                Measurement(name, unit, samples).ci95_ratio <= float(ci_target):
+            break
+
+    measurement = Measurement(name, unit(results[-1]) if callable(unit) else unit, samples,
+                              discarded, float(noisy_cv), results)
+    if measurement.noisy:
+        logger.warn(f"Noisy measurement: {measurement}")
+    logger.debug(f"{name} samples {measurement.samples}, discarded {measurement.discarded}")
+    return measurement
@@ -20,6 +20,7 @@ __all__ = [
     u"InterfaceAddress",
     u"VhostUserInterface",
     u"TapInterface",
+    u"VethInterface",
 ]
 
 class InterfaceAddress():
@@ -75,3 +76,19 @@ class TapInterface(VirtualInterface):
     """Define TAP interface class."""
     def __init__(self, name, ofp):
         super().__init__(name, None, None, ofp)
+
+class VethInterface(VirtualInterface):
+    """Define interface class for network namespace endpoints.
+    The interface is either a veth pair whose peer end is moved into
+    the namespace, or an OVS internal port moved into the namespace.
+    """
+    def __init__(self, name, idx, mac, ofp, netns, internal=False):
+        super().__init__(name, idx, mac, ofp)
+        self.netns = netns
+        self.internal = internal
+        self.qpair = 1
+        # Device name inside the namespace
+        if internal:
+            self.dev_name = name
+        else:
+            self.dev_name = f"eth{idx}"
@@ -23,13 +23,19 @@ from io import StringIO
 
 from robot.api import logger
 
+from resources.libraries.python.agent import get_agent
 from resources.libraries.python.guest import Guest
 from resources.libraries.python.ssh import SSHTimeout
+from resources.libraries.python.timeline import traced
 
 __all__ = [
     u"VirtualMachine",
 ]
 
+def _vm_track(vm, *_args, **_kwargs):
+    # pylint: disable=protected-access
+    return f"{vm._host_ssh_info['host']}:{vm._host_ssh_info['port']}"
+
 class VirtualMachine(Guest):
     """QEMU utilities."""
 
@@ -79,7 +85,13 @@ class VirtualMachine(Guest):
             'port': self._qemu_opt['ssh_fwd_port'],
             'username': 'cne',
             'password': 'cne',
+            'use_agent': host_ssh_info.get('use_agent', False),
+            'guest': True,
         }
+        if host_ssh_info.get('guest_ssh_jump', True):
+            # Tunnel guest SSH through the host transport, so no TCP
+            # connection and handshake from the management node per guest.
+            self._ssh_info['jump'] = host_ssh_info
         self._vhost_id = 0
         self.numa_id = 0
         self._ssh = None
@@ -303,6 +315,7 @@ class VirtualMachine(Guest):
             return {}
         return json.loads(stdout.split('\n', 1)[0])
 
+    @traced("vm", track=_vm_track)
     def _wait_until_vm_boot(self, timeout=300):
         """Wait until QEMU VM is booted.
 
@@ -332,6 +345,7 @@ class VirtualMachine(Guest):
         logger.trace('VM {0} booted on {1}'.format(self._qemu_opt['disk_image'],
                                                    self._host_ssh_info['host']))
 
+    @traced("vm", track=_vm_track)
     def qemu_start(self):
         """Start QEMU and wait until VM boot.
 
@@ -375,10 +389,12 @@ class VirtualMachine(Guest):
         logger.trace('QEMU running')
         # Wait until VM boot
         self._wait_until_vm_boot()
+        get_agent(self._ssh_info)
 
         self.qemu_set_affinity()
         self.configure()
 
+    @traced("vm", track=_vm_track)
     def qemu_quit(self):
         """Quit the QEMU emulator."""
         out = self._qemu_qmp_exec('quit')
@@ -387,6 +403,7 @@ class VirtualMachine(Guest):
             raise RuntimeError('QEMU quit failed on {0}, error: {1}'.format(
                 self._host_ssh_info['host'], json.dumps(err)))
 
+    @traced("vm", track=_vm_track)
     def qemu_system_powerdown(self):
         """Power down the system (if supported)."""
         out = self._qemu_qmp_exec('system_powerdown')
@@ -397,6 +414,7 @@ class VirtualMachine(Guest):
                 'error: {1}'.format(self._host_ssh_info['host'], json.dumps(err))
             )
 
+    @traced("vm", track=_vm_track)
     def qemu_guest_poweroff(self):
         """Poweroff the system."""
         self.execute("poweroff")
@@ -404,6 +422,7 @@ class VirtualMachine(Guest):
 
         self.qemu_clear_socks()
 
+    @traced("vm", track=_vm_track)
     def qemu_system_reset(self):
         """Reset the system."""
         out = self._qemu_qmp_exec('system_reset')
@@ -16,20 +16,26 @@
 
 import os
 import re
+from shlex import quote
 
 from robot.api import logger
 from robot.libraries.BuiltIn import BuiltIn
 
 from resources.libraries.python.constants import Constants
-from resources.libraries.python.ssh import exec_cmd, kill_process
+from resources.libraries.python.agent import kill_pidfile, kill_process, write_file
+from resources.libraries.python.ssh import exec_cmd, exec_cmd_batch
+from resources.libraries.python.telemetry import INTERFACE_STATISTICS_CMD, \
+    parse_interface_statistics, parse_telemetry, telemetry_cmd
 from resources.libraries.python.vif import TapInterface
 
 __all__ = [
     u"VirtualSwitch",
     u"OvsDpdk",
     u"OvsNative",
+    u"OvsNativeLocal",
     u"Uplink",
     u"TunnelPort",
+    u"parse_pmd_stats",
 ]
 
 class Uplink():
@@ -97,6 +103,24 @@ def _bridge_add_vif(br, vif):
     _bridge_add_vni(br, vif)
 
 
+def parse_pmd_stats(output):
+    """Parse 'ovs-appctl dpif-netdev/pmd-stats-show', integer counters are
+    summed over all PMD threads and the main thread, averages and cycle
+    percentages are dropped.
+
+    :param output: Output of pmd-stats-show.
+    :type output: str
+    :returns: Counters by name, e.g. {'emc hits': 100}.
+    :rtype: dict
+    """
+    stats = dict()
+    for match in re.finditer(r"^\s+([a-z][a-z .]*?):\s*(\d+)\s*(?:\(.*\))?$", output, re.M):
+        name = match.group(1)
+        if name.startswith(u"avg"):
+            continue
+        stats[name] = stats.get(name, 0) + int(match.group(2))
+    return stats
+
 class VirtualSwitch():
     """Defines basic methods and attirbutes of a virtual switch."""
     def __init__(self, ssh_info, uplinks_spec, tep_addr, ovs_bin_dir, dpdk_devbind_dir):
@@ -110,7 +134,7 @@ class VirtualSwitch():
         iface_keys = sorted(uplinks_spec.keys())
         for iface in iface_keys:
             iface_spec = uplinks_spec[iface]
-            uplink = Uplink(iface_spec['pci_address'])
+            uplink = Uplink(iface_spec.get('pci_address'))
             if iface_spec.get("n_queue_pair"):
                 uplink.n_queue_pair = iface_spec.get("n_queue_pair")
             if iface_spec.get("n_rxq_desc"):
@@ -122,6 +146,12 @@ class VirtualSwitch():
         self._ovs_bin_dir = ovs_bin_dir
         self._dpdk_devbind_full_cmd = os.path.join(dpdk_devbind_dir, "dpdk-devbind.py")
 
+    def _ovs_cmd(self, cmd):
+        return f"{self._ovs_bin_dir}/{cmd}"
+
+    def _host_cmd(self, cmd): # pylint: disable=no-self-use
+        return cmd
+
     def execute(self, cmd, timeout=30):
         """Execute an OVS command.
 
@@ -133,7 +163,7 @@ class VirtualSwitch():
         :rtype: tuple(int, str, str)
         """
         ret_code, stdout, stderr = \
-            exec_cmd(self.ssh_info, f"{self._ovs_bin_dir}/{cmd}", timeout, sudo=True)
+            exec_cmd(self.ssh_info, self._ovs_cmd(cmd), timeout, sudo=True)
         logger.trace(stdout)
 
         if ret_code is None or int(ret_code) != 0:
@@ -142,15 +172,20 @@ class VirtualSwitch():
         return (ret_code, stdout, stderr)
 
     def execute_batch(self, cmds, timeout=30):
-        """Execute a batch of OVS commands.
+        """Execute a batch of OVS commands by one round trip.
+        It stops at the first failed command.
 
         :param cmds: OVS commands.
-        :param timeout: Timeout value in seconds.
+        :param timeout: Timeout value in seconds for each command.
         :type cmds: list(str)
         :type timeout: int
         """
-        for cmd in cmds:
-            self.execute(cmd, timeout)
+        results = exec_cmd_batch(self.ssh_info, [self._ovs_cmd(cmd) for cmd in cmds],
+                                 timeout * len(cmds), sudo=True, stop_on_error=True)
+        for cmd, (ret_code, stdout, _) in zip(cmds, results):
+            logger.trace(stdout)
+            if ret_code is None or int(ret_code) != 0:
+                raise RuntimeError(f"Execute OVS cmd failed on {self.ssh_info['host']} : {cmd}")
 
     def execute_host(self, cmd, timeout=30, exp_fail=False):
         """Execute a command on a host which the vswitch resides.
@@ -166,7 +201,7 @@ class VirtualSwitch():
         :rtype: tuple(int, str, str)
         """
         ret_code, stdout, stderr = \
-            exec_cmd(self.ssh_info, cmd, timeout, sudo=True)
+            exec_cmd(self.ssh_info, self._host_cmd(cmd), timeout, sudo=True)
         logger.trace(stdout)
 
         if ret_code is None or int(ret_code) != 0:
@@ -177,15 +212,20 @@ class VirtualSwitch():
         return (ret_code, stdout, stderr)
 
     def execute_host_batch(self, cmds, timeout=30):
-        """Execute a batch of commands on a host which the vswitch resides.
+        """Execute a batch of commands on a host which the vswitch resides
+        by one round trip. It stops at the first failed command.
 
         :param cmds: Commands.
-        :param timeout: Timeout value in seconds.
+        :param timeout: Timeout value in seconds for each command.
         :type cmds: list(str)
         :type timeout: int
         """
-        for cmd in cmds:
-            self.execute_host(cmd, timeout)
+        results = exec_cmd_batch(self.ssh_info, [self._host_cmd(cmd) for cmd in cmds],
+                                 timeout * len(cmds), sudo=True, stop_on_error=True)
+        for cmd, (ret_code, stdout, _) in zip(cmds, results):
+            logger.trace(stdout)
+            if ret_code is None or int(ret_code) != 0:
+                raise RuntimeError(f"Execute host cmd failed on {self.ssh_info['host']} : {cmd}")
 
     def kill_process(self, proc_name):
         """Kill a process on a host which the vswitch resides.
@@ -195,6 +235,20 @@ class VirtualSwitch():
         """
         kill_process(self.ssh_info, proc_name)
 
+    def write_host_file(self, path, data, mode=None):
+        """Write a file on a host which the vswitch resides.
+
+        :param path: File path.
+        :param data: File content.
+        :param mode: File permission bits.
+        :type path: str
+        :type data: str
+        :type mode: int
+        """
+        ret_code, _, stderr = write_file(self.ssh_info, path, data, mode)
+        if ret_code is None or int(ret_code) != 0:
+            raise RuntimeError(f"Write file {path} failed on {self.ssh_info['host']} : {stderr}")
+
     def get_bridge(self, br_name):
         """Get a Bridge object by a bridge name.
 
@@ -372,6 +426,54 @@ class VirtualSwitch():
         br = self.get_bridge(br_name)
         _bridge_add_vif(br, vif)
 
+    def _create_netns_interface_impl(self, br_name, vif):
+        """Create an interface on a bridge and move it into a namespace.
+
+        :param br_name: Bridge name.
+        :param vif: Virtual interface.
+        :type br_name: str
+        :type vif: VethInterface obj
+        """
+        # There might be stale interface left on the host.
+        self.execute_host(f"ip link del {vif.name}", exp_fail=None)
+        if vif.internal:
+            self.execute(f"ovs-vsctl add-port {br_name} {vif.name} "
+                         f"-- set Interface {vif.name} type=internal "
+                         f"ofport_request={vif.ofp}")
+            self.execute_host(f"ip link set {vif.name} netns {vif.netns}")
+        else:
+            cmds = [f"ip link add {vif.name} type veth peer name {vif.dev_name} "
+                    f"netns {vif.netns}",
+                    f"ip link set {vif.name} up"]
+            self.execute_host_batch(cmds)
+            self.execute(f"ovs-vsctl add-port {br_name} {vif.name} "
+                         f"-- set Interface {vif.name} ofport_request={vif.ofp}")
+
+    def create_netns_interface(self, br_name, vif):
+        """Create an interface for a netns endpoint on a bridge.
+
+        :param br_name: Bridge name.
+        :param vif: Virtual interface.
+        :type br_name: str
+        :type vif: VethInterface obj
+        """
+        self._create_netns_interface_impl(br_name, vif)
+        br = self.get_bridge(br_name)
+        _bridge_add_vif(br, vif)
+
+    def delete_netns_interface(self, br_name, vif):
+        """Delete an interface of a netns endpoint from a bridge.
+
+        :param br_name: Bridge name.
+        :param vif: Virtual interface.
+        :type br_name: str
+        :type vif: VethInterface obj
+        """
+        self.delete_interface(br_name, vif.name)
+        if not vif.internal:
+            # Deleting one end of a veth pair also deletes its peer.
+            self.execute_host(f"ip link del {vif.name}", exp_fail=None)
+
     def _create_uplink_bond_impl(self, br):
         pass
 
@@ -438,6 +540,48 @@ class VirtualSwitch():
             self.execute(f"ovs-ofctl mod-port {br_name} {self.uplinks[idx].name} down")
         self._set_bond_member_up_impl(self.uplinks[idx].name, up)
 
+    def clear_pmd_stats(self):
+        """Clear PMD statistics, a vswitch without PMD threads has nothing
+        to clear.
+        """
+
+    def get_pmd_stats(self): # pylint: disable=no-self-use
+        """Get PMD statistics summed over all PMD threads.
+
+        :returns: Counters by name, empty if the vswitch has no PMD threads.
+        :rtype: dict
+        """
+        return dict()
+
+    def get_interface_statistics(self):
+        """Get statistics of all OVS interfaces.
+
+        :returns: Counters by interface name.
+        :rtype: dict
+        """
+        (_, stdout, _) = self.execute(INTERFACE_STATISTICS_CMD)
+        return parse_interface_statistics(stdout)
+
+    def get_xstats(self):
+        """Get a snapshot of extended statistics, see diff_xstats().
+
+        :returns: 'interfaces' statistics of OVS, and 'ethdev' and
+            'mempool' of DPDK if the vswitch is DPDK based.
+        :rtype: dict
+        """
+        return {u"interfaces": self.get_interface_statistics(), u"ethdev": dict(),
+                u"mempool": dict()}
+
+    def host_sampling_cmds(self):
+        """Get commands which a host sampler runs every interval besides
+        reading /proc, i.e. counters of each uplink.
+
+        :returns: Commands by sampler section name.
+        :rtype: dict
+        """
+        return {f"uplink {uplink.name}": self._host_cmd(f"ethtool -S {uplink.name}")
+                for uplink in self.uplinks if uplink.name}
+
     def start_vswitch(self):
         """Start a virtual switch. """
 
@@ -503,6 +647,39 @@ class OvsDpdk(VirtualSwitch):
                      f"{ifs_set}")
         # No need to track pseudo bond uplink in br
 
+    def clear_pmd_stats(self):
+        self.execute("ovs-appctl dpif-netdev/pmd-stats-clear")
+
+    def get_pmd_stats(self):
+        (_, stdout, _) = self.execute("ovs-appctl dpif-netdev/pmd-stats-show")
+        return parse_pmd_stats(stdout)
+
+    def get_xstats(self):
+        xstats = super().get_xstats()
+        (ret_code, stdout, _) = self.execute_host(telemetry_cmd(), exp_fail=None)
+        try:
+            if ret_code is None or int(ret_code) != 0:
+                raise RuntimeError(u"telemetry client failed")
+            telemetry = parse_telemetry(stdout)
+        except RuntimeError as err:
+            logger.warn(f"No DPDK telemetry on {self.ssh_info['host']}: {err}")
+            return xstats
+        # ethdev of a PCI device is named by its PCI address
+        names = {uplink.pci_addr: uplink.name for uplink in self.uplinks}
+        xstats[u"ethdev"] = {names.get(dev, dev): counters
+                             for dev, counters in telemetry[u"ethdev"].items()}
+        xstats[u"mempool"] = telemetry[u"mempool"]
+        return xstats
+
+    def host_sampling_cmds(self):
+        # DPDK uplinks are not kernel netdevs, and PMD cycles tell how busy
+        # a polling core really is.
+        cmds = {f"uplink {uplink.name}":
+                self._ovs_cmd(f"ovs-vsctl get Interface {uplink.name} statistics")
+                for uplink in self.uplinks if uplink.name}
+        cmds[u"pmd"] = self._ovs_cmd("ovs-appctl dpif-netdev/pmd-stats-show")
+        return cmds
+
     def start_vswitch(self):
         ### Firstly bind uplink interfaces to specified driver
         driver = self._aux_params['driver']
@@ -567,27 +744,21 @@ class OvsNative(VirtualSwitch):
         # configuration for JUMBO test.
         # Each vhost user interface has its own ifup/ifdown scripts,
         # as we neeed to set ofp while qemu cannot pass those params.
-        self.execute_host(
-            "sh -c 'cat << EOF > {}\n"
-            "#!/bin/sh\n"
-            "\n"
-            "{}/ovs-vsctl add-port {} $1 "
-            "-- set Interface $1 ofport_request={}\n"
-            "ip link set $1 up\n"
-            "ip link set $1 mtu 9000\n"
-            "EOF'"\
-            .format(vif.qemu_script_ifup, self._ovs_bin_dir, br_name, vif.ofp))
-        self.execute_host(f"chmod u+x {vif.qemu_script_ifup}")
-
-        self.execute_host(
-            "sh -c 'cat << EOF > {}\n"
-            "#!/bin/sh\n"
-            "\n"
-            "ip link set $1 down\n"
-            "{}/ovs-vsctl del-port {} $1\n"
-            "EOF'"\
-            .format(vif.qemu_script_ifdown, self._ovs_bin_dir, br_name))
-        self.execute_host(f"chmod u+x {vif.qemu_script_ifdown}")
+        self.write_host_file(vif.qemu_script_ifup,
+                             f"#!/bin/sh\n"
+                             f"\n"
+                             f"{self._ovs_bin_dir}/ovs-vsctl add-port {br_name} $1 "
+                             f"-- set Interface $1 ofport_request={vif.ofp}\n"
+                             f"ip link set $1 up\n"
+                             f"ip link set $1 mtu 9000\n",
+                             mode=0o744)
+
+        self.write_host_file(vif.qemu_script_ifdown,
+                             f"#!/bin/sh\n"
+                             f"\n"
+                             f"ip link set $1 down\n"
+                             f"{self._ovs_bin_dir}/ovs-vsctl del-port {br_name} $1\n",
+                             mode=0o744)
 
     def _create_uplink_interface_impl(self, br_name, uplink):
         # using 1 rxq/txq pair
@@ -707,3 +878,91 @@ class OvsNative(VirtualSwitch):
                     f"--log-file --pidfile --detach"]
 
         self.execute_batch(cmds, timeout=100)
+
+
+class OvsNativeLocal(OvsNative):
+    """Methods for kernel datapath virtual switch of a logical SUT.
+    The logical SUT runs in a network namespace on a single Linux box,
+    all the OVS daemons and host commands are running in the namespace,
+    and uplinks are veth pairs whose peers are attached to a linux bridge,
+    i.e. the fabric, in the root namespace.
+    """
+    def __init__(self, ssh_info, uplinks_spec, tep_addr, ovs_bin_dir, dpdk_devbind_dir,
+                 netns, fabric):
+        super().__init__(ssh_info, uplinks_spec, tep_addr, ovs_bin_dir, dpdk_devbind_dir)
+        self.netns = netns
+        self._fabric = fabric
+        self._run_dir = f"/var/run/openvswitch-{netns}"
+        if not self.uplinks:
+            self.uplinks.append(Uplink(None))
+        for idx, uplink in enumerate(self.uplinks, 1):
+            uplink.name = f"uplink{idx}"
+
+    def _ovs_cmd(self, cmd):
+        return f"ip netns exec {self.netns} env OVS_RUNDIR={self._run_dir} " \
+               f"OVS_LOGDIR={self._run_dir} OVS_DBDIR={self._run_dir} " \
+               f"{self._ovs_bin_dir}/{cmd}"
+
+    def _host_cmd(self, cmd):
+        return f"ip netns exec {self.netns} sh -c {quote(cmd)}"
+
+    def _execute_root(self, cmd, exp_fail=False):
+        """Execute a command in the root namespace of the host. """
+        ret_code, stdout, stderr = exec_cmd(self.ssh_info, cmd, 30, sudo=True)
+        logger.trace(stdout)
+
+        if ret_code is None or int(ret_code) != 0:
+            if exp_fail is not None and not exp_fail:
+                raise RuntimeError(f"Execute root cmd failed on {self.ssh_info['host']} : {cmd}")
+
+        return (ret_code, stdout, stderr)
+
+    def _peer_name(self, uplink):
+        return f"{self.netns}-{uplink.name[len('uplink'):]}"
+
+    def _create_uplink_bond_impl(self, br):
+        raise RuntimeError("Do not support bond on ovs-native-local datapath")
+
+    def _delete_uplink_impl(self, uplink):
+        # Uplink veth pairs live as long as the logical SUT.
+        if uplink not in self.uplinks:
+            super()._delete_uplink_impl(uplink)
+
+    def start_vswitch(self):
+        cmds = [f"ip netns add {self.netns}",
+                "modprobe openvswitch",
+                f"mkdir -p {self._run_dir}"]
+        for cmd in cmds:
+            self._execute_root(cmd)
+        # The fabric is shared by all logical SUTs on the box.
+        self._execute_root(f"ip link add {self._fabric} type bridge", exp_fail=None)
+        self._execute_root(f"ip link set {self._fabric} up")
+
+        for uplink in self.uplinks:
+            peer = self._peer_name(uplink)
+            self._execute_root(f"ip link del {peer}", exp_fail=None)
+            cmds = [f"ip link add {peer} type veth peer name {uplink.name} "
+                    f"netns {self.netns}",
+                    f"ip link set {peer} master {self._fabric}",
+                    f"ip link set {peer} up"]
+            for cmd in cmds:
+                self._execute_root(cmd)
+
+        self.execute_host("ip link set lo up")
+
+        cmds = [f"ovsdb-tool create {self._run_dir}/conf.db " \
+                    f"{self._ovs_bin_dir}/vswitch.ovsschema",
+                f"ovsdb-server --remote=punix:{self._run_dir}/db.sock " \
+                    f"--pidfile --detach --log-file {self._run_dir}/conf.db",
+                "ovs-vsctl --no-wait init",
+                "ovs-vswitchd --log-file --pidfile --detach"]
+        self.execute_batch(cmds, timeout=100)
+
+    def stop_vswitch(self):
+        # Other logical SUTs share the same host, so only kill our own daemons.
+        for daemon in ["ovs-vswitchd", "ovsdb-server"]:
+            kill_pidfile(self.ssh_info, f"{self._run_dir}/{daemon}.pid")
+        for uplink in self.uplinks:
+            self._execute_root(f"ip link del {self._peer_name(uplink)}", exp_fail=None)
+        self._execute_root(f"ip netns del {self.netns}", exp_fail=None)
+        self._execute_root(f"rm -rf {self._run_dir}")